@@ -130,3 +130,12 @@ class InvalidToken(AuthException):
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid token"
         )
+
+
+class NotEnoughPermissions(AuthException):
+    """Недостаточно прав"""
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Not enough permissions"
+        )
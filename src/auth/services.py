@@ -12,7 +12,8 @@ from src.models.users import User
 from src.auth.utils import create_access_token, create_refresh_token, decode_jwt, verify_password
 from src.auth.exceptions import (
     InvalidCredentials, InactiveUser, MissingAccessToken, InvalidAccessToken,
-    InvalidTokenPayload, MissingRefreshToken, InvalidRefreshToken, UserNotFound
+    InvalidTokenPayload, MissingRefreshToken, InvalidRefreshToken, UserNotFound,
+    NotEnoughPermissions
 )
 
 
@@ -125,3 +126,11 @@ async def get_current_user_profile(
     user: User = Depends(get_current_user),
 ):
     return user.profile
+
+
+async def get_current_superuser(
+    user: User = Depends(get_current_user),
+) -> User:
+    if not user.is_superuser:
+        raise NotEnoughPermissions()
+    return user
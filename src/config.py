@@ -25,6 +25,40 @@ class DbSettings(BaseSettings):
 class CelerySettings(BaseSettings):
     broker_url: str = Field(..., alias="CELERY_BROKER_URL")
     backend_url: str = Field(..., alias="CELERY_RESULT_BACKEND")
+    # Одна подзадача на раздел эссе + chord; иначе всё эссе в одной задаче
+    essay_fan_out: bool = Field(True, alias="ESSAY_FAN_OUT")
+    section_max_retries: int = Field(3, alias="SECTION_MAX_RETRIES")
+    # Очереди по стоимости: короткие эссе и планы отдельно от длинных эссе
+    short_queue: str = Field("refagent.short", alias="CELERY_SHORT_QUEUE")
+    long_queue: str = Field("refagent.long", alias="CELERY_LONG_QUEUE")
+    short_max_pages: int = Field(10, alias="CELERY_SHORT_MAX_PAGES")
+    # Введение и список литературы генерируются заранее, сразу после плана
+    speculative_sections: bool = Field(False, alias="SPECULATIVE_SECTIONS")
+    section_draft_ttl_hours: int = Field(24, alias="SECTION_DRAFT_TTL_HOURS")
+    # Потоковая генерация глав: частичный текст в БД не чаще раза в STREAM_FLUSH_SECONDS,
+    # SSE /essays/{id}/stream проверяет изменения раз в STREAM_POLL_SECONDS
+    stream_sections: bool = Field(False, alias="STREAM_SECTIONS")
+    stream_flush_seconds: float = Field(2.0, alias="STREAM_FLUSH_SECONDS")
+    stream_poll_seconds: float = Field(1.0, alias="STREAM_POLL_SECONDS")
+    # Long-poll /status?wait=: LISTEN/NOTIFY на общем соединении asyncpg процесса API
+    status_listen: bool = Field(True, alias="STATUS_LISTEN")
+    status_max_wait_seconds: float = Field(30.0, alias="STATUS_MAX_WAIT_SECONDS")
+    # Heartbeat генерации (essays.updated_at) и reaper зависших эссе (celery beat)
+    essay_heartbeat_seconds: float = Field(60.0, alias="ESSAY_HEARTBEAT_SECONDS")
+    essay_heartbeat_timeout_seconds: float = Field(900.0, alias="ESSAY_HEARTBEAT_TIMEOUT_SECONDS")
+    essay_max_attempts: int = Field(3, alias="ESSAY_MAX_ATTEMPTS")
+    essay_reaper_batch: int = Field(100, alias="ESSAY_REAPER_BATCH")
+    essay_reaper_interval_seconds: float = Field(60.0, alias="ESSAY_REAPER_INTERVAL_SECONDS")
+    # Сколько хранится ответ на запрос с Idempotency-Key
+    idempotency_ttl_hours: int = Field(24, alias="IDEMPOTENCY_TTL_HOURS")
+    # Transactional outbox: задачи публикует relay_outbox пачками (beat и API после ответа)
+    outbox_batch: int = Field(100, alias="OUTBOX_BATCH")
+    outbox_relay_interval_seconds: float = Field(5.0, alias="OUTBOX_RELAY_INTERVAL_SECONDS")
+    # Планировщик: эссе ждут в QUEUED, пока есть общий и пользовательский слоты
+    scheduler_max_in_flight: int = Field(20, alias="SCHEDULER_MAX_IN_FLIGHT")
+    user_max_in_flight: int = Field(2, alias="USER_MAX_IN_FLIGHT")
+    superuser_max_in_flight: int = Field(10, alias="SUPERUSER_MAX_IN_FLIGHT")
+    scheduler_interval_seconds: float = Field(10.0, alias="SCHEDULER_INTERVAL_SECONDS")
 
 class RefPrintSettings(BaseSettings):
     save_dir: Path = Field( BASE_DIR / "saved_docs", alias='SAVE_DIR')
@@ -53,10 +87,69 @@ class RefAgentSettings(BaseSettings):
     model_name: str = Field(..., alias="MODEL_NAME")
     temperature: float = Field(..., alias="TEMPERATURE")
     validation_max_retries: int = Field(..., alias="VALIDATION_MAX_RETRIES")
+    # Допустимая нехватка объёма раздела перед продолжением текста
+    validation_length_tolerance: float = Field(0.3, alias="VALIDATION_LENGTH_TOLERANCE")
     chars: int | None = Field(None, alias="CHARS")
     full_chars: int | None = Field(None, alias="FULL_CHARS")
     words: int | None = Field(None, alias="WORDS")
-    
+    # Параллельная генерация разделов внутри одного эссе
+    concurrent_generation: bool = Field(True, alias="CONCURRENT_GENERATION")
+    section_max_in_flight: int = Field(4, alias="SECTION_MAX_IN_FLIGHT")
+    # Сколько планов одновременно генерирует один процесс API
+    plan_max_concurrency: int = Field(16, alias="PLAN_MAX_CONCURRENCY")
+    # Глава длиннее стольких страниц пишется параллельными частями (0 — никогда)
+    chapter_part_max_pages: int = Field(5, alias="CHAPTER_PART_MAX_PAGES")
+    # До скольких страниц введение, заключение и литература пишутся одним вызовом
+    front_matter_max_pages: int = Field(20, alias="FRONT_MATTER_MAX_PAGES")
+    # Пул OpenAI-совместимых endpoint: "name|base_url|api_key|weight;..." (пусто — api.openai.com)
+    openai_endpoints: str = Field("", alias="OPENAI_ENDPOINTS")
+    # Исключение endpoint из пула по последним PROVIDER_WINDOW вызовам
+    provider_window: int = Field(50, alias="PROVIDER_WINDOW")
+    provider_max_error_rate: float = Field(0.5, alias="PROVIDER_MAX_ERROR_RATE")
+    provider_max_p95_seconds: float = Field(180.0, alias="PROVIDER_MAX_P95_SECONDS")
+    provider_eject_seconds: float = Field(30.0, alias="PROVIDER_EJECT_SECONDS")
+    # Дублирование медленных вызовов: дубль после перцентиля недавних задержек,
+    # не больше HEDGE_MAX_RATIO от всех вызовов
+    hedge_enabled: bool = Field(False, alias="HEDGE_ENABLED")
+    hedge_percentile: float = Field(0.95, alias="HEDGE_PERCENTILE")
+    hedge_max_ratio: float = Field(0.05, alias="HEDGE_MAX_RATIO")
+    hedge_min_delay_seconds: float = Field(1.0, alias="HEDGE_MIN_DELAY_SECONDS")
+    hedge_window: int = Field(200, alias="HEDGE_WINDOW")
+    hedge_other_endpoint: bool = Field(True, alias="HEDGE_OTHER_ENDPOINT")
+    # Маршрутизация моделей: агент[:до N символов]=модель; остальное — MODEL_NAME.
+    # Если ожидаемое время ответа больше SLO — запасная быстрая модель.
+    model_routes: str = Field("plan=gpt-4o-mini,references=gpt-4o-mini", alias="MODEL_ROUTES")
+    model_fallback: str = Field("gpt-4o-mini", alias="MODEL_FALLBACK")
+    model_latency_slo_seconds: float = Field(120.0, alias="MODEL_LATENCY_SLO_SECONDS")
+    # USD за 1M входных/выходных токенов — для статистики стоимости маршрутов
+    model_prices: str = Field("gpt-4o=2.5/10,gpt-4o-mini=0.15/0.6", alias="MODEL_PRICES")
+    model_stats_path: Path = Field(BASE_DIR / "cache" / "model_routes.sqlite3", alias="MODEL_STATS_PATH")
+    # Кеш ответов LLM (SQLite, LRU + TTL); агенты подключаются через LLM_CACHE_AGENTS
+    llm_cache_enabled: bool = Field(False, alias="LLM_CACHE_ENABLED")
+    llm_cache_path: Path = Field(BASE_DIR / "cache" / "llm_cache.sqlite3", alias="LLM_CACHE_PATH")
+    llm_cache_max_entries: int = Field(10000, alias="LLM_CACHE_MAX_ENTRIES")
+    llm_cache_ttl_seconds: int = Field(7 * 24 * 3600, alias="LLM_CACHE_TTL_SECONDS")
+    llm_cache_agents: str = Field("plan,introduction,conclusion,references,front_matter", alias="LLM_CACHE_AGENTS")
+    # Общий бюджет OpenAI (token bucket): none, sqlite (один узел) или postgres (кластер)
+    rate_limit_backend: str = Field("none", alias="RATE_LIMIT_BACKEND")
+    rate_limit_sqlite_path: Path = Field(BASE_DIR / "cache" / "rate_limit.sqlite3", alias="RATE_LIMIT_SQLITE_PATH")
+    openai_rpm: int = Field(500, alias="OPENAI_RPM")
+    openai_tpm: int = Field(200000, alias="OPENAI_TPM")
+    rate_limit_completion_tokens: int = Field(2000, alias="RATE_LIMIT_COMPLETION_TOKENS")
+    rate_limit_max_throttles: int = Field(5, alias="RATE_LIMIT_MAX_THROTTLES")
+    # Потолок max_tokens: целевой объём раздела + запас; калибровка символов на токен по языкам
+    token_budget_margin: float = Field(0.25, alias="TOKEN_BUDGET_MARGIN")
+    token_calibration_path: Path = Field(BASE_DIR / "cache" / "token_calibration.sqlite3", alias="TOKEN_CALIBRATION_PATH")
+    # Общий на процесс пул HTTP-соединений к OpenAI
+    http_max_connections: int = Field(100, alias="HTTP_MAX_CONNECTIONS")
+    http_max_keepalive: int = Field(20, alias="HTTP_MAX_KEEPALIVE")
+    http_keepalive_expiry: float = Field(60.0, alias="HTTP_KEEPALIVE_EXPIRY")
+    http_timeout: float = Field(600.0, alias="HTTP_TIMEOUT")
+
+    @property
+    def cached_agents(self) -> set[str]:
+        return {name.strip() for name in self.llm_cache_agents.split(",") if name.strip()}
+
     
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(env_file=BASE_DIR / '.env', env_file_encoding='utf-8', extra='ignore')
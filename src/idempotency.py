@@ -0,0 +1,81 @@
+import hashlib
+import json
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from fastapi import HTTPException, Response, status
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.config import settings
+from src.models.idempotency import IdempotencyKey
+
+
+def fingerprint(payload: object) -> str:
+    """Хеш тела запроса: тот же ключ с другими параметрами — ошибка клиента."""
+    return hashlib.sha256(json.dumps(jsonable_encoder(payload), sort_keys=True).encode()).hexdigest()
+
+
+def _expired_before() -> datetime:
+    return datetime.now(timezone.utc) - timedelta(hours=settings.celery.idempotency_ttl_hours)
+
+
+async def idempotent(session: AsyncSession, response: Response, user_id: int, key: str | None,
+                     endpoint: str, payload: object, handler: Callable[[], Awaitable[dict]]) -> dict:
+    """
+    Выполняет handler() один раз на (пользователь, Idempotency-Key).
+
+    Ключ записывается до вызова (уникальный индекс: из двух одновременных
+    запросов проходит один, второй получает 409). Готовый ответ сохраняется
+    и отдаётся повторам с заголовком Idempotent-Replayed. Если handler упал,
+    ключ удаляется, и запрос можно повторить. Без ключа — обычный вызов.
+    """
+    if key is None:
+        return await handler()
+
+    # Просроченный ключ (IDEMPOTENCY_TTL_HOURS) можно использовать заново
+    await session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.key == key,
+        IdempotencyKey.created_at < _expired_before(),
+    ))
+    digest = fingerprint(payload)
+    stored = (await session.execute(
+        select(IdempotencyKey.endpoint, IdempotencyKey.fingerprint, IdempotencyKey.response).where(
+            IdempotencyKey.user_id == user_id, IdempotencyKey.key == key,
+        )
+    )).first()
+    if stored is not None:
+        await session.rollback()
+        if (stored.endpoint, stored.fingerprint) != (endpoint, digest):
+            raise HTTPException(status_code=422,
+                                detail="Idempotency-Key уже использован для другого запроса")
+        if stored.response is None:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="Запрос с этим Idempotency-Key ещё выполняется")
+        response.headers["Idempotent-Replayed"] = "true"
+        return json.loads(stored.response)
+
+    record = IdempotencyKey(user_id=user_id, key=key, endpoint=endpoint, fingerprint=digest)
+    session.add(record)
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                            detail="Запрос с этим Idempotency-Key ещё выполняется")
+    record_id = record.id
+
+    try:
+        result = await handler()
+    except BaseException:
+        await session.rollback()
+        await session.execute(delete(IdempotencyKey).where(IdempotencyKey.id == record_id))
+        await session.commit()
+        raise
+
+    await session.execute(update(IdempotencyKey).where(IdempotencyKey.id == record_id)
+                          .values(response=json.dumps(jsonable_encoder(result))))
+    await session.commit()
+    return result
@@ -4,10 +4,13 @@ from fastapi import FastAPI
 
 from fastapi.middleware.cors import CORSMiddleware
 from src.database import init_db
+from src.refagent.agents.base import aclose_agents
+from src.notifications import aclose_essay_listener
 from src.auth.router import router as auth_router
 from src.routes.profile import router as profile_router
 from src.routes.essay import router as essay_router
 from src.routes.refprint import router as refprint_router
+from src.routes.metrics import router as metrics_router
 from src.config import settings
 
 
@@ -16,6 +19,8 @@ from src.config import settings
 async def lifespan(app: FastAPI):
     await init_db()
     yield
+    await aclose_essay_listener()
+    await aclose_agents()
     
 app = FastAPI(lifespan=lifespan)
 
@@ -36,6 +41,7 @@ app.include_router(prefix=settings.api_v1_prefix, router=auth_router)
 app.include_router(prefix=settings.api_v1_prefix, router=profile_router)
 app.include_router(prefix=settings.api_v1_prefix, router=essay_router)
 app.include_router(prefix=settings.api_v1_prefix, router=refprint_router)
+app.include_router(prefix=settings.api_v1_prefix, router=metrics_router)
 
 
 @app.get("/")
@@ -1,4 +1,6 @@
-from src.models.essay import Essay, EssayMetadata
+from src.models.essay import Essay, EssayMetadata, EssaySection, SectionDraft
 from src.models.users import User
 from src.models.tokens import RefreshToken
-from src.models.profile import Profile
\ No newline at end of file
+from src.models.profile import Profile
+from src.models.idempotency import IdempotencyKey
+from src.models.outbox import TaskOutbox
\ No newline at end of file
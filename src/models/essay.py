@@ -1,15 +1,17 @@
 from datetime import datetime
 from sqlalchemy.orm import Mapped, mapped_column, relationship
-from sqlalchemy import Enum, String, Integer, ForeignKey, DateTime, Text
+from sqlalchemy import Enum, String, Integer, ForeignKey, DateTime, Text, UniqueConstraint, Index
 from src.db_base import Base
 
 
 
 class EnumStatus(str, Enum):
     PENDING = "PENDING"
+    PLAN_PENDING = "PLAN_PENDING"
     PLAN_GENERATED = "PLAN_GENERATED"
     STARTED = "STARTED"
     IN_PROGRESS = "IN_PROGRESS"
+    QUEUED = "QUEUED"
     GENERATING = "GENERATING"
     GENERATED = "GENERATED"
     COMPLETED = "COMPLETED"
@@ -28,14 +30,19 @@ class EnumLanguage(str, Enum):
 
 class Essay(Base):
     __tablename__ = 'essays'
+    # Reaper ищет GENERATING-эссе с истёкшим heartbeat (updated_at)
+    __table_args__ = (Index('ix_essays_status_updated_at', 'status', 'updated_at'),)
     
     topic: Mapped[str] = mapped_column(String(255), nullable=False)  # обязательное
     task_id: Mapped[str] = mapped_column(String(255), nullable=True)
     page_count: Mapped[int] = mapped_column(Integer, default=20, nullable=False)  # теперь необязательное
     status: Mapped[str] = mapped_column(String(255), nullable=False, default=EnumStatus.PENDING)
+    # Попытки генерации: запуск пользователем и перезапуски reaper (ESSAY_MAX_ATTEMPTS)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
     language: Mapped[str] = mapped_column(String(255), nullable=False, default=EnumLanguage.RU)
 
     chapter_count: Mapped[int] = mapped_column(Integer, nullable=False)
+    plan: Mapped[str] = mapped_column(Text, nullable=True)
     
     introduction: Mapped[str] = mapped_column(Text, nullable=True)
     introduction_chars_count: Mapped[int] = mapped_column(Integer, nullable=False)
@@ -58,6 +65,18 @@ class Essay(Base):
         uselist=True
     )
     
+    sections: Mapped[list['EssaySection']] = relationship(
+        back_populates='essay',
+        cascade='all, delete-orphan',
+        uselist=True
+    )
+
+    drafts: Mapped[list['SectionDraft']] = relationship(
+        back_populates='essay',
+        cascade='all, delete-orphan',
+        uselist=True
+    )
+
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=True)
     user: Mapped['User'] = relationship(back_populates='essays') # type: ignore
 
@@ -74,6 +93,47 @@ class Chapter(Base):
     essay: Mapped['Essay'] = relationship(back_populates='chapters')
 
 
+class EssaySection(Base):
+    """
+    Прогресс генерации раздела эссе (чекпоинт): introduction, conclusion, references, chapter:<id>.
+
+    status: PENDING — в очереди, GENERATING — пишется, GENERATED — готов,
+    FAILURE — попытка упала. Уникальный индекс (essay_id, section) служит
+    и для выборки прогресса всего эссе одним запросом.
+    """
+    __tablename__ = 'essay_sections'
+    __table_args__ = (UniqueConstraint('essay_id', 'section'),)
+
+    section: Mapped[str] = mapped_column(String(64), nullable=False)
+    status: Mapped[str] = mapped_column(String(255), nullable=False, default=EnumStatus.PENDING)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    started_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    finished_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
+    chars: Mapped[int] = mapped_column(Integer, nullable=True)
+    model: Mapped[str] = mapped_column(String(255), nullable=True)
+
+    essay_id: Mapped[int] = mapped_column(ForeignKey('essays.id'))
+    essay: Mapped['Essay'] = relationship(back_populates='sections')
+
+
+class SectionDraft(Base):
+    """
+    Раздел, сгенерированный заранее, сразу после плана (SPECULATIVE_SECTIONS).
+    Принимается generate_essay, если тема, язык и объём не изменились.
+    """
+    __tablename__ = 'section_drafts'
+    __table_args__ = (UniqueConstraint('essay_id', 'section'),)
+
+    section: Mapped[str] = mapped_column(String(64), nullable=False)
+    topic: Mapped[str] = mapped_column(String(255), nullable=False)
+    language: Mapped[str] = mapped_column(String(255), nullable=False)
+    chars: Mapped[int] = mapped_column(Integer, nullable=False)
+    content: Mapped[str] = mapped_column(Text, nullable=False)
+
+    essay_id: Mapped[int] = mapped_column(ForeignKey('essays.id'))
+    essay: Mapped['Essay'] = relationship(back_populates='drafts')
+
+
 class EssayMetadata(Base):
     __tablename__ = 'essay_metadata'
     
@@ -0,0 +1,21 @@
+from sqlalchemy import ForeignKey, Integer, String, Text, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.db_base import Base
+
+
+class IdempotencyKey(Base):
+    """
+    Ответ на запрос с заголовком Idempotency-Key. Повтор запроса с тем же
+    ключом получает сохранённый ответ вместо повторной генерации.
+    response пуст, пока первый запрос ещё выполняется.
+    """
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (UniqueConstraint("user_id", "key"),)
+
+    key: Mapped[str] = mapped_column(String(255), nullable=False)
+    endpoint: Mapped[str] = mapped_column(String(255), nullable=False)
+    fingerprint: Mapped[str] = mapped_column(String(64), nullable=False)
+    response: Mapped[str] = mapped_column(Text, nullable=True)
+
+    user_id: Mapped[int] = mapped_column(Integer, ForeignKey("users.id"), nullable=False)
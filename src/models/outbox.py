@@ -0,0 +1,27 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, Index, Integer, String, Text
+from sqlalchemy.orm import Mapped, mapped_column
+
+from src.db_base import Base
+
+
+class TaskOutbox(Base):
+    """
+    Задача Celery, которую нужно опубликовать (transactional outbox).
+
+    Строка пишется в той же транзакции, что и смена статуса эссе; публикует
+    её relay_outbox. task_id выдаётся заранее, поэтому эссе ссылается на
+    задачу ещё до публикации.
+    """
+    __tablename__ = "task_outbox"
+    # relay выбирает неопубликованные строки по порядку id
+    __table_args__ = (Index("ix_task_outbox_published_at_id", "published_at", "id"),)
+
+    task_name: Mapped[str] = mapped_column(String(255), nullable=False)
+    task_id: Mapped[str] = mapped_column(String(255), nullable=False, unique=True)
+    args: Mapped[str] = mapped_column(Text, nullable=False)
+    options: Mapped[str] = mapped_column(Text, nullable=False)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    published_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=True)
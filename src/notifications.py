@@ -0,0 +1,147 @@
+import asyncio
+import time
+import weakref
+from typing import Awaitable, Callable
+
+import asyncpg
+from sqlalchemy import text
+
+from src.config import settings
+
+
+# Канал Postgres, в который воркеры сообщают id эссе при смене статуса/прогресса
+ESSAY_CHANNEL = "essay_events"
+
+
+def notify_essay(db, essay_id: int):
+    """
+    Ставит NOTIFY по эссе в текущую транзакцию: слушатели получат его
+    только после commit, вместе с изменениями. Вне Postgres — ничего.
+    """
+    if db.get_bind().dialect.name != "postgresql":
+        return
+    db.execute(text("SELECT pg_notify(:channel, :payload)"),
+               {"channel": ESSAY_CHANNEL, "payload": str(essay_id)})
+
+
+async def anotify_essay(session, essay_id: int):
+    """notify_essay для AsyncSession (маршруты API)."""
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    await session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                          {"channel": ESSAY_CHANNEL, "payload": str(essay_id)})
+
+
+class EssayListener:
+    """
+    Одно общее на event loop соединение asyncpg с LISTEN essay_events.
+
+    Запросы long-poll ждут уведомления по своему эссе вместо опроса БД;
+    соединение одно на процесс API, сколько бы клиентов ни ждало.
+    """
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self._conn: asyncpg.Connection | None = None
+        self._lock = asyncio.Lock()
+        self._waiters: dict[int, set[asyncio.Future]] = {}
+        self._retry_at = 0.0
+
+    def _on_notify(self, connection, pid, channel, payload):
+        try:
+            essay_id = int(payload)
+        except ValueError:
+            return
+        for waiter in self._waiters.pop(essay_id, ()):
+            if not waiter.done():
+                waiter.set_result(True)
+
+    async def connect(self) -> bool:
+        """Подключается при первом ожидании; после ошибки — не чаще раза в 30 секунд."""
+        if self._conn is not None and not self._conn.is_closed():
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        async with self._lock:
+            if self._conn is not None and not self._conn.is_closed():
+                return True
+            try:
+                self._conn = await asyncpg.connect(self.dsn, timeout=5)
+                await self._conn.add_listener(ESSAY_CHANNEL, self._on_notify)
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                print(f"[ERROR] Essay listener unavailable, falling back to polling: {e}")
+                self._conn = None
+                self._retry_at = time.monotonic() + 30
+                return False
+        return True
+
+    def subscribe(self, essay_id: int) -> asyncio.Future:
+        """Future, который завершится при следующем уведомлении по эссе."""
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(essay_id, set()).add(waiter)
+        return waiter
+
+    def unsubscribe(self, essay_id: int, waiter: asyncio.Future):
+        waiters = self._waiters.get(essay_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                del self._waiters[essay_id]
+
+    async def close(self):
+        if self._conn is not None and not self._conn.is_closed():
+            await self._conn.close()
+        self._conn = None
+
+
+_listeners: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, EssayListener]" = weakref.WeakKeyDictionary()
+
+
+def get_essay_listener() -> EssayListener | None:
+    """Слушатель текущего event loop или None, если STATUS_LISTEN выключен."""
+    if not settings.celery.status_listen:
+        return None
+    loop = asyncio.get_running_loop()
+    listener = _listeners.get(loop)
+    if listener is None:
+        db = settings.db
+        listener = EssayListener(f"postgresql://{db.user}:{db.password}@{db.host}:{db.port}/{db.name}")
+        _listeners[loop] = listener
+    return listener
+
+
+async def aclose_essay_listener():
+    listener = _listeners.pop(asyncio.get_running_loop(), None)
+    if listener is not None:
+        await listener.close()
+
+
+async def wait_for_essay_change(essay_id: int, timeout: float, initial: object,
+                                snapshot: Callable[[], Awaitable[object]]) -> bool:
+    """
+    Ждёт, пока snapshot() эссе отличится от initial, не дольше timeout секунд.
+
+    С LISTEN/NOTIFY — ожидание уведомления (подписка оформляется до
+    повторной проверки снимка, чтобы не пропустить изменение). Без него
+    (не Postgres, слушатель недоступен) — опрос snapshot() раз
+    в STREAM_POLL_SECONDS.
+    """
+    listener = get_essay_listener()
+    if listener is not None and await listener.connect():
+        waiter = listener.subscribe(essay_id)
+        try:
+            if await snapshot() != initial:
+                return True
+            await asyncio.wait_for(waiter, timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            listener.unsubscribe(essay_id, waiter)
+
+    deadline = time.monotonic() + timeout
+    while (remaining := deadline - time.monotonic()) > 0:
+        if await snapshot() != initial:
+            return True
+        await asyncio.sleep(min(settings.celery.stream_poll_seconds, remaining))
+    return await snapshot() != initial
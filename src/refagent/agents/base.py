@@ -0,0 +1,428 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+import openai
+from langchain_openai import ChatOpenAI
+
+from src.config import settings
+from src.refagent.budget import TokenBudget, close_document, get_calibration, token_budget, visible_chars
+from src.refagent.cache import cache_key, get_llm_cache
+from src.refagent.ratelimit import estimate_tokens, get_rate_limiter
+from src.refagent.hedging import get_hedge_executor, get_hedger
+from src.refagent.http import aclose_http_clients, get_async_http_client, get_http_client
+from src.refagent.model_routing import RouteChoice, get_route_stats, select_model
+from src.refagent.providers import FAILOVER_ERRORS, Endpoint, get_provider_pool
+from src.refagent.validation import aensure_valid_document, ensure_valid_document
+
+
+_models_lock = threading.Lock()
+_models: dict[tuple, ChatOpenAI] = {}
+_loop_models: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[tuple, ChatOpenAI]]" = \
+    weakref.WeakKeyDictionary()
+
+
+# Модели, выбранные маршрутизатором внутри track_models() текущего контекста
+_used_models: ContextVar[list[str] | None] = ContextVar("used_models", default=None)
+
+
+@contextmanager
+def track_models():
+    """Собирает модели, на которые агенты направили вызовы внутри блока."""
+    models: list[str] = []
+    token = _used_models.set(models)
+    try:
+        yield models
+    finally:
+        _used_models.reset(token)
+
+
+def _running_loop() -> asyncio.AbstractEventLoop | None:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _is_closed(chat_model: ChatOpenAI) -> bool:
+    clients = (chat_model.http_client, chat_model.http_async_client)
+    return any(client is not None and client.is_closed for client in clients)
+
+
+def _build_chat_model(model: str, temperature: float | None, endpoint: Endpoint,
+                      loop: asyncio.AbstractEventLoop | None) -> ChatOpenAI:
+    kwargs = dict(
+        openai_api_key=endpoint.api_key,
+        model=model,
+        http_client=get_http_client(),
+    )
+    if endpoint.base_url:
+        kwargs["base_url"] = endpoint.base_url
+    if len(get_provider_pool().endpoints) > 1:
+        # Повтор на другом endpoint быстрее, чем встроенные повторы клиента на том же
+        kwargs["max_retries"] = 0
+    if loop is not None:
+        kwargs["http_async_client"] = get_async_http_client()
+    if temperature is not None:
+        kwargs["temperature"] = temperature
+    return ChatOpenAI(**kwargs)
+
+
+def get_chat_model(model: str, temperature: float | None = None,
+                   endpoint: Endpoint | None = None) -> ChatOpenAI:
+    """
+    Возвращает общий ChatOpenAI для (model, temperature, endpoint);
+    endpoint по умолчанию — первый в пуле OPENAI_ENDPOINTS.
+
+    Все модели используют один пул HTTP-соединений, поэтому задачи воркера
+    не создают клиентов заново и переиспользуют keep-alive соединения.
+    Вне event loop модель общая на процесс, внутри — на текущий loop
+    (асинхронный клиент нельзя переиспользовать между loop).
+    """
+    endpoint = endpoint or get_provider_pool().endpoints[0]
+    loop = _running_loop()
+    if loop is None:
+        cache, key = _models, (os.getpid(), model, temperature, endpoint)
+    else:
+        cache, key = _loop_models.setdefault(loop, {}), (model, temperature, endpoint)
+
+    chat_model = cache.get(key)
+    if chat_model is None or _is_closed(chat_model):
+        with _models_lock:
+            chat_model = cache.get(key)
+            if chat_model is None or _is_closed(chat_model):
+                chat_model = _build_chat_model(model, temperature, endpoint, loop)
+                cache[key] = chat_model
+    return chat_model
+
+
+async def aclose_agents():
+    """Сбрасывает кеш моделей и закрывает HTTP-клиенты (остановка приложения)."""
+    pid = os.getpid()
+    with _models_lock:
+        for key in [key for key in _models if key[0] == pid]:
+            del _models[key]
+        _loop_models.pop(asyncio.get_running_loop(), None)
+    await aclose_http_clients()
+
+
+class BaseAgent:
+    """
+    Базовый класс агентов refagent.
+
+    Наследники формируют промпт и вызывают invoke/ainvoke; модель и HTTP-клиент
+    берутся из общего кеша. Ответы агентов, чьё cache_name перечислено
+    в LLM_CACHE_AGENTS, кешируются по (model, temperature, prompt).
+    Перед вызовом модели агент берёт бюджет у общего лимитера (RATE_LIMIT_BACKEND)
+    и при 429 ждёт своей очереди, а не падает. Размер ответа ограничен
+    токен-бюджетом раздела (src.refagent.budget). Агенты разделов
+    (validates_document) проверяют ответ и дёшево чинят его
+    (src.refagent.validation), прежде чем вернуть или закешировать.
+    Модель каждого вызова выбирается по MODEL_ROUTES (src.refagent.model_routing),
+    если она не задана агенту явно.
+    """
+
+    cache_name: str = ""
+    validates_document: bool = False
+    check_length: bool = True
+
+    def __init__(self, model: str | None = None,
+                 temperature: float | None = settings.refagent.temperature):
+        self.model_name = model or settings.refagent.model_name
+        self.routed = model is None
+        self.temperature = temperature
+        self.model = get_chat_model(self.model_name, temperature)
+
+    def _cache(self):
+        if self.cache_name not in settings.refagent.cached_agents:
+            return None
+        return get_llm_cache()
+
+    def _reserve(self, prompt: str, budget: TokenBudget | None) -> int:
+        completion = budget.max_tokens if budget else settings.refagent.rate_limit_completion_tokens
+        return estimate_tokens(prompt, completion)
+
+    @staticmethod
+    def _limits(budget: TokenBudget | None) -> dict:
+        return {"max_tokens": budget.max_tokens} if budget else {}
+
+    def _route(self, prompt: str, budget: TokenBudget | None) -> RouteChoice:
+        if not self.routed:
+            choice = RouteChoice(self.cache_name or "default", self.model_name)
+        else:
+            limiter = get_rate_limiter()
+            queue_wait = limiter.estimate_wait(self._reserve(prompt, budget)) if limiter is not None else 0.0
+            choice = select_model(self.cache_name, budget, self.model_name, queue_wait)
+        models = _used_models.get()
+        if models is not None:
+            models.append(choice.model)
+        return choice
+
+    @staticmethod
+    def _observe(choice: RouteChoice, budget: TokenBudget | None, result, latency: float):
+        """Калибровка символов на токен и статистика маршрута по ответу модели."""
+        usage = getattr(result, "usage_metadata", None) or {}
+        if budget is not None and usage.get("output_tokens"):
+            get_calibration().record(budget.language, len(result.content), usage["output_tokens"])
+        get_route_stats().record(choice, latency, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+
+    def _request(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice,
+                 endpoint: Endpoint | None = None):
+        """
+        Один вызов модели через пул endpoint: при сетевой ошибке или 5xx
+        вызов повторяется на следующем endpoint, пока они не кончатся.
+        """
+        pool, tried = get_provider_pool(), []
+        while True:
+            endpoint = endpoint or pool.choose(exclude=tried)
+            started = time.monotonic()
+            try:
+                result = get_chat_model(choice.model, self.temperature, endpoint).invoke(
+                    prompt, **self._limits(budget)
+                )
+            except FAILOVER_ERRORS:
+                pool.record(endpoint, ok=False, latency=time.monotonic() - started)
+                tried.append(endpoint.name)
+                if len(set(tried)) >= len(pool.endpoints):
+                    raise
+                endpoint = None
+                continue
+            latency = time.monotonic() - started
+            pool.record(endpoint, ok=True, latency=latency)
+            return result, latency
+
+    async def _arequest(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice,
+                        endpoint: Endpoint | None = None):
+        pool, tried = get_provider_pool(), []
+        while True:
+            endpoint = endpoint or pool.choose(exclude=tried)
+            started = time.monotonic()
+            try:
+                result = await get_chat_model(choice.model, self.temperature, endpoint).ainvoke(
+                    prompt, **self._limits(budget)
+                )
+            except FAILOVER_ERRORS:
+                pool.record(endpoint, ok=False, latency=time.monotonic() - started)
+                tried.append(endpoint.name)
+                if len(set(tried)) >= len(pool.endpoints):
+                    raise
+                endpoint = None
+                continue
+            latency = time.monotonic() - started
+            pool.record(endpoint, ok=True, latency=latency)
+            return result, latency
+
+    def _hedge_endpoint(self, primary: Endpoint) -> Endpoint:
+        if settings.refagent.hedge_other_endpoint:
+            return get_provider_pool().choose(exclude=[primary.name])
+        return primary
+
+    def _hedge(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice, endpoint: Endpoint):
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            limiter.acquire(self._reserve(prompt, budget))
+        return self._request(prompt, budget, choice, endpoint)
+
+    def _hedged_request(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice):
+        """
+        Вызов с дублированием (HEDGE_ENABLED): если ответа нет дольше
+        перцентиля недавних задержек маршрута, тот же запрос уходит ещё раз
+        (по умолчанию на другой endpoint) и побеждает первый ответ.
+        """
+        hedger, key = get_hedger(), (choice.route, choice.model)
+        delay = hedger.begin(key)
+        if delay is None:
+            result, latency = self._request(prompt, budget, choice)
+            hedger.observe(key, latency)
+            return result, latency
+
+        executor = get_hedge_executor()
+        primary = get_provider_pool().choose()
+        first = executor.submit(self._request, prompt, budget, choice, primary)
+        pending, hedge = {first}, None
+        if not wait(pending, timeout=delay).done and hedger.allow():
+            hedge = executor.submit(self._hedge, prompt, budget, choice, self._hedge_endpoint(primary))
+            pending.add(hedge)
+
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = error or future.exception()
+                    continue
+                # Проигравший синхронный запрос не прервать: он дорабатывает в фоне
+                for loser in pending:
+                    loser.cancel()
+                if future is hedge:
+                    hedger.record_win()
+                result, latency = future.result()
+                hedger.observe(key, latency)
+                return result, latency
+        raise error
+
+    async def _ahedge(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice, endpoint: Endpoint):
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            await limiter.aacquire(self._reserve(prompt, budget))
+        return await self._arequest(prompt, budget, choice, endpoint)
+
+    async def _ahedged_request(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice):
+        """Асинхронный вызов с дублированием: проигравший запрос отменяется."""
+        hedger, key = get_hedger(), (choice.route, choice.model)
+        delay = hedger.begin(key)
+        if delay is None:
+            result, latency = await self._arequest(prompt, budget, choice)
+            hedger.observe(key, latency)
+            return result, latency
+
+        primary = get_provider_pool().choose()
+        first = asyncio.ensure_future(self._arequest(prompt, budget, choice, primary))
+        pending, hedge = {first}, None
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if not done and hedger.allow():
+            hedge = asyncio.ensure_future(self._ahedge(prompt, budget, choice, self._hedge_endpoint(primary)))
+            pending.add(hedge)
+
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if task is hedge:
+                        hedger.record_win()
+                    result, latency = task.result()
+                    hedger.observe(key, latency)
+                    return result, latency
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _call(self, prompt: str, budget: TokenBudget | None = None,
+              choice: RouteChoice | None = None) -> str:
+        choice = choice or self._route(prompt, budget)
+        limiter = get_rate_limiter()
+        for attempt in range(settings.refagent.rate_limit_max_throttles + 1):
+            if limiter is not None:
+                limiter.acquire(self._reserve(prompt, budget))
+            try:
+                result, latency = self._hedged_request(prompt, budget, choice)
+                self._observe(choice, budget, result, latency)
+                return result.content
+            except openai.RateLimitError:
+                if limiter is None or attempt == settings.refagent.rate_limit_max_throttles:
+                    raise
+                limiter.throttle()
+
+    async def _acall(self, prompt: str, budget: TokenBudget | None = None,
+                     choice: RouteChoice | None = None) -> str:
+        choice = choice or await asyncio.to_thread(self._route, prompt, budget)
+        limiter = get_rate_limiter()
+        for attempt in range(settings.refagent.rate_limit_max_throttles + 1):
+            if limiter is not None:
+                await limiter.aacquire(self._reserve(prompt, budget))
+            try:
+                result, latency = await self._ahedged_request(prompt, budget, choice)
+                await asyncio.to_thread(self._observe, choice, budget, result, latency)
+                return result.content
+            except openai.RateLimitError:
+                if limiter is None or attempt == settings.refagent.rate_limit_max_throttles:
+                    raise
+                await asyncio.to_thread(limiter.throttle)
+
+    def _validated(self, text: str, prompt: str, budget: TokenBudget | None, choice: RouteChoice) -> str:
+        if not self.validates_document or budget is None:
+            return text
+        return ensure_valid_document(
+            text, budget, check_length=self.check_length,
+            continue_text=lambda continuation, missing: self._call(
+                continuation, token_budget(budget.language, 0, missing), choice
+            ),
+            regenerate=lambda: self._call(prompt, budget, choice),
+        )
+
+    def _generate(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice) -> str:
+        return self._validated(self._call(prompt, budget, choice), prompt, budget, choice)
+
+    async def _agenerate(self, prompt: str, budget: TokenBudget | None, choice: RouteChoice) -> str:
+        text = await self._acall(prompt, budget, choice)
+        if not self.validates_document or budget is None:
+            return text
+        return await aensure_valid_document(
+            text, budget, check_length=self.check_length,
+            continue_text=lambda continuation, missing: self._acall(
+                continuation, token_budget(budget.language, 0, missing), choice
+            ),
+            regenerate=lambda: self._acall(prompt, budget, choice),
+        )
+
+    def invoke(self, prompt: str, budget: TokenBudget | None = None) -> str:
+        """Вызывает модель; budget ограничивает ответ через max_tokens."""
+        choice = self._route(prompt, budget)
+        cache = self._cache()
+        if cache is None:
+            return self._generate(prompt, budget, choice)
+        key = cache_key(choice.model, self.temperature, prompt)
+        return cache.get_or_call(key, lambda: self._generate(prompt, budget, choice))
+
+    async def ainvoke(self, prompt: str, budget: TokenBudget | None = None) -> str:
+        choice = await asyncio.to_thread(self._route, prompt, budget)
+        cache = self._cache()
+        if cache is None:
+            return await self._agenerate(prompt, budget, choice)
+        key = cache_key(choice.model, self.temperature, prompt)
+        return await cache.aget_or_call(key, lambda: self._agenerate(prompt, budget, choice))
+
+    def stream(self, prompt: str, budget: TokenBudget, on_chunk: Callable[[str], None]) -> str:
+        """
+        Как invoke, но куски ответа по мере генерации отдаются в on_chunk
+        (без кеша). Готовый ответ проверяется так же, как в invoke.
+        """
+        text = self.invoke_streaming(prompt, budget, on_chunk)
+        return self._validated(text, prompt, budget, self._route(prompt, budget))
+
+    def invoke_streaming(self, prompt: str, budget: TokenBudget,
+                         on_chunk: Callable[[str], None] | None = None) -> str:
+        """
+        Потоковый вызов модели: on_chunk получает куски ответа по мере
+        генерации. Как только видимый текст превысил budget.max_chars, поток
+        закрывается, незаконченный абзац отрезается и конверт документа
+        закрывается — модель не тратит токены сверх бюджета.
+        """
+        choice = self._route(prompt, budget)
+        limiter = get_rate_limiter()
+        if limiter is not None:
+            limiter.acquire(self._reserve(prompt, budget))
+
+        text = ""
+        started = time.monotonic()
+        pool = get_provider_pool()
+        endpoint = pool.choose()
+        stream = get_chat_model(choice.model, self.temperature, endpoint).stream(prompt, **self._limits(budget))
+        try:
+            for chunk in stream:
+                text += chunk.content
+                if on_chunk is not None:
+                    on_chunk(chunk.content)
+                if visible_chars(text) >= budget.max_chars:
+                    break
+        except FAILOVER_ERRORS:
+            # Начатый поток на другой endpoint не переносится: только учёт здоровья
+            pool.record(endpoint, ok=False, latency=time.monotonic() - started)
+            raise
+        finally:
+            stream.close()
+        pool.record(endpoint, ok=True, latency=time.monotonic() - started)
+        get_route_stats().record(choice, time.monotonic() - started)
+        return close_document(text)
@@ -1,23 +1,34 @@
-from langchain_openai import ChatOpenAI
+import asyncio
+import contextvars
+import math
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from lxml import etree
+
 from src.config import settings
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import PLAN_ITEM_CHARS, TokenBudget, token_budget
+from src.refagent.validation import merge_documents, parse_document, render_document
 
-class ChapterAgent:
-    def __init__(self, model=settings.refagent.model_name):
-        self.model = ChatOpenAI(
-            openai_api_key=settings.refagent.openai_api_key,
-            temperature=settings.refagent.temperature,
-            model=model
-        )
 
-    def write_chapter(self, topic: str, chapter_title: str,
+class ChapterAgent(BaseAgent):
+    """
+    Пишет главу реферата. Длинная глава (больше CHAPTER_PART_MAX_PAGES страниц)
+    пишется по частям: короткий план подразделов, затем части параллельно,
+    склейка в один <document> с перенумерацией формул.
+    """
+    cache_name = "chapter"
+    validates_document = True
+
+    def prompt(self, topic: str, chapter_title: str,
                             position: int,
                             language: str = "ru", 
                             chars: int = settings.refagent.chars or 1500, 
                             full_chars: int = settings.refagent.full_chars or 2000,
                             words: int = settings.refagent.words or 300
-    ):
-
-        prompt = f"""
+    ) -> str:
+        return f"""
 Ты — ИИ, который пишет главы академического реферата.
 
 Глава: "{chapter_title}"
@@ -56,7 +67,161 @@ class ChapterAgent:
 </document>
 """
 
+    @staticmethod
+    def parts_count(chars: int) -> int:
+        """На сколько частей делить главу объёмом chars (1 — писать целиком)."""
+        max_pages = settings.refagent.chapter_part_max_pages
+        if max_pages <= 0:
+            return 1
+        part_chars = (settings.refagent.chars or 1500) * max_pages
+        return max(math.ceil(chars / part_chars), 1)
+
+    def outline_prompt(self, topic: str, chapter_title: str, language: str, parts: int) -> str:
+        return f"""
+Ты — ИИ, который составляет план главы академического реферата.
+
+Глава: "{chapter_title}"
+Тема реферата: "{topic}"
+Язык: {language}
+
+Раздели главу ровно на {parts} подразделов, которые вместе полностью её раскрывают,
+без повторов между подразделами. Перечисли только названия подразделов.
+Не используй markdown.
+
+Выведи результат строго в формате:
+
+<ul>
+    <li>Название подраздела</li>
+    ...
+</ul>
+"""
+
+    @staticmethod
+    def parse_outline(text: str, parts: int) -> list[str]:
+        """Названия подразделов; если модель вернула не то число пунктов — нейтральные заголовки."""
+        parser = etree.XMLParser(recover=True, resolve_entities=False)
+        root = etree.fromstring(f"<root>{text or ''}</root>".encode("utf-8"), parser)
+        titles = [] if root is None else [
+            " ".join("".join(item.itertext()).split()) for item in root.iter("li")
+        ]
+        titles = [title for title in titles if title]
+        if len(titles) != parts:
+            return [f"Часть {index}" for index in range(1, parts + 1)]
+        return titles
+
+    def part_prompt(self, topic: str, chapter_title: str, outline: list[str], index: int,
+                    language: str, chars: int, full_chars: int, words: int) -> str:
+        plan = "\n".join(f"{number}. {title}" for number, title in enumerate(outline, start=1))
+        return f"""
+Ты — ИИ, который пишет главы академического реферата.
+
+Глава: "{chapter_title}"
+Тема реферата: "{topic}"
+Язык: {language}
+План главы:
+{plan}
+
+Напиши только подраздел {index + 1}: "{outline[index]}".
+Объём: {chars} символов.
+Объём с пробелами: {full_chars} символов.
+Объём: {words} слов.
+
+Требования:
+- начни с заголовка <h3>{outline[index]}</h3>, затем текст подраздела
+- не пересказывай остальные подразделы плана, не пиши вступление и выводы ко всей главе
+- академический стиль, без воды и повторов, без выдуманных фактов
+- Не добавляй тег <meta> или что-либо кроме <content> и <formulas>
+- В тексте используй только теги: h3, p, ul, ol, table
+- Если есть математические выражения, вставляй <formula id="fX"/> в тексте
+- Все формулы должны быть в блоке <formulas> в виде <latex id="fX">...</latex>
+- Если формул нет — блок <formulas> оставь пустым, но не убирай его
+- Формат ответа строго XML/HTML, без лишних пояснений и текста
+- Не используй markdown
+
+Выведи результат строго в формате:
+
+<document>
+    <content>
+        ...
+    </content>
+    <formulas>
+    </formulas>
+</document>
+"""
+
+    def _part_prompts(self, topic: str, chapter_title: str, outline: list[str], language: str,
+                      chars: int, full_chars: int, words: int) -> list[tuple[str, TokenBudget]]:
+        parts = len(outline)
+        sizes = (chars // parts, full_chars // parts, words // parts)
+        return [
+            (self.part_prompt(topic, chapter_title, outline, index, language, *sizes),
+             token_budget(language, sizes[0], sizes[1]))
+            for index in range(parts)
+        ]
+
+    @staticmethod
+    def _merge(texts: list[str]) -> str:
+        return render_document(merge_documents([parse_document(text) for text in texts]))
+
+    def write_parts(self, topic: str, chapter_title: str, language: str, parts: int,
+                    chars: int, full_chars: int, words: int) -> str:
+        """План подразделов, затем части в пуле потоков (SECTION_MAX_IN_FLIGHT)."""
+        outline = self.parse_outline(self.invoke(
+            self.outline_prompt(topic, chapter_title, language, parts),
+            token_budget(language, PLAN_ITEM_CHARS * parts),
+        ), parts)
+        prompts = self._part_prompts(topic, chapter_title, outline, language, chars, full_chars, words)
+        # Контекст вызывающего (track_models) переносится в потоки пула
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=max(min(settings.refagent.section_max_in_flight, parts), 1)) as pool:
+            texts = list(pool.map(lambda item: context.copy().run(self.invoke, *item), prompts))
+        return self._merge(texts)
+
+    async def awrite_parts(self, topic: str, chapter_title: str, language: str, parts: int,
+                           chars: int, full_chars: int, words: int) -> str:
+        outline = self.parse_outline(await self.ainvoke(
+            self.outline_prompt(topic, chapter_title, language, parts),
+            token_budget(language, PLAN_ITEM_CHARS * parts),
+        ), parts)
+        prompts = self._part_prompts(topic, chapter_title, outline, language, chars, full_chars, words)
+        semaphore = asyncio.Semaphore(max(settings.refagent.section_max_in_flight, 1))
+
+        async def _write(prompt: str, budget: TokenBudget) -> str:
+            async with semaphore:
+                return await self.ainvoke(prompt, budget)
+
+        texts = await asyncio.gather(*(_write(*item) for item in prompts))
+        return self._merge(list(texts))
 
-        result = self.model.invoke(prompt)
+    def write_chapter(self, topic: str, chapter_title: str,
+                            position: int,
+                            language: str = "ru",
+                            chars: int = settings.refagent.chars or 1500,
+                            full_chars: int = settings.refagent.full_chars or 2000,
+                            words: int = settings.refagent.words or 300,
+                            on_chunk: Callable[[str], None] | None = None
+    ) -> str:
+        """on_chunk — получать текст по мере генерации (только для главы в один вызов)."""
+        parts = self.parts_count(chars)
+        if parts > 1:
+            return self.write_parts(topic, chapter_title, language, parts, chars, full_chars, words)
+        prompt = self.prompt(topic, chapter_title, position, language, chars, full_chars, words)
+        budget = token_budget(language, chars, full_chars)
+        if on_chunk is not None:
+            return self.stream(prompt, budget, on_chunk)
+        return self.invoke(prompt, budget)
 
-        return result.content
+    async def awrite_chapter(self, topic: str, chapter_title: str,
+                            position: int,
+                            language: str = "ru",
+                            chars: int = settings.refagent.chars or 1500,
+                            full_chars: int = settings.refagent.full_chars or 2000,
+                            words: int = settings.refagent.words or 300
+    ) -> str:
+        parts = self.parts_count(chars)
+        if parts > 1:
+            return await self.awrite_parts(topic, chapter_title, language, parts, chars, full_chars, words)
+        return await self.ainvoke(
+            self.prompt(topic, chapter_title, position, language, chars, full_chars, words),
+            token_budget(language, chars, full_chars),
+        )
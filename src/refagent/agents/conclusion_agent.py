@@ -1,22 +1,20 @@
-from langchain_openai import ChatOpenAI
 from src.config import settings
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import token_budget
 
-class ConclusionAgent:
-    def __init__(self, model=settings.refagent.model_name):
-        self.model = ChatOpenAI(
-            openai_api_key=settings.refagent.openai_api_key,
-            temperature=settings.refagent.temperature,
-            model=model
-        )
 
-    def write(self, 
+class ConclusionAgent(BaseAgent):
+    cache_name = "conclusion"
+    validates_document = True
+
+    def prompt(self, 
                     topic: str, 
                     language: str = "ru", 
                     chars: int = settings.refagent.chars or 1500, 
                     full_chars: int = settings.refagent.full_chars or 2000,
                     words: int = settings.refagent.words or 300
-):
-        prompt = f"""
+) -> str:
+        return f"""
 Ты — ИИ для написания Заключения академического реферата.
 
 Тема: "{topic}"
@@ -53,6 +51,22 @@ class ConclusionAgent:
 </document>
 """
 
+    def write(self,
+              topic: str,
+              language: str = "ru",
+              chars: int = settings.refagent.chars or 1500,
+              full_chars: int = settings.refagent.full_chars or 2000,
+              words: int = settings.refagent.words or 300
+    ) -> str:
+        return self.invoke(self.prompt(topic, language, chars, full_chars, words),
+                           token_budget(language, chars, full_chars))
 
-        result = self.model.invoke(prompt)
-        return result.content
+    async def awrite(self,
+                     topic: str,
+                     language: str = "ru",
+                     chars: int = settings.refagent.chars or 1500,
+                     full_chars: int = settings.refagent.full_chars or 2000,
+                     words: int = settings.refagent.words or 300
+    ) -> str:
+        return await self.ainvoke(self.prompt(topic, language, chars, full_chars, words),
+                                  token_budget(language, chars, full_chars))
@@ -0,0 +1,102 @@
+from lxml import etree
+
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import REFERENCE_CHARS, TokenBudget, token_budget
+from src.refagent.validation import render_document, validate_document
+
+
+SECTION_TITLES = {
+    "introduction": "Введение",
+    "conclusion": "Заключение",
+    "references": "Список литературы",
+}
+
+
+class FrontMatterAgent(BaseAgent):
+    """
+    Введение, заключение и список литературы одним запросом к модели.
+
+    Для коротких эссе эти разделы занимают около страницы, и отдельный
+    вызов на каждый стоит дороже самого текста. write() возвращает только
+    разделы, которые удалось разобрать; недостающие догенерирует вызывающий.
+    """
+    cache_name = "front_matter"
+
+    @staticmethod
+    def references_count(chars: int) -> int:
+        return max(chars // REFERENCE_CHARS, 5)
+
+    def prompt(self, topic: str, language: str, sections: dict[str, int]) -> str:
+        requirements = []
+        if "introduction" in sections:
+            requirements.append(
+                f"<introduction> — Введение, объём {sections['introduction']} символов: "
+                "актуальность темы, цель и задачи исследования."
+            )
+        if "conclusion" in sections:
+            requirements.append(
+                f"<conclusion> — Заключение, объём {sections['conclusion']} символов: "
+                "краткие выводы по теме, без новых фактов."
+            )
+        if "references" in sections:
+            requirements.append(
+                f"<references> — Список литературы из {self.references_count(sections['references'])} "
+                "реальных проверяемых источников в виде <ol> по ГОСТ Р 7.0.5-2008."
+            )
+        blocks = "\n".join(
+            f"    <{name}>\n        <document>\n            <content>...</content>\n"
+            f"            <formulas></formulas>\n        </document>\n    </{name}>"
+            for name in sections
+        )
+        return f"""
+Ты — академический модуль, который пишет вспомогательные разделы реферата.
+Тема: "{topic}"
+Язык: {language}
+
+Напиши разделы:
+{chr(10).join("- " + item for item in requirements)}
+
+Требования:
+- академический стиль, без выдуманных фактов
+- не добавляй заголовки "Введение", "Заключение" — сразу начинай контент
+- в тексте используй только теги: h2, h3, p, ul, ol, table
+- формулы — как <formula id="fX"/>, их LaTeX — в блоке <formulas> этого же раздела
+- формат ответа строго XML, без markdown и пояснений
+
+Выведи результат строго в формате:
+
+<sections>
+{blocks}
+</sections>
+"""
+
+    def budget(self, language: str, sections: dict[str, int]) -> TokenBudget:
+        chars = sum(sections.values())
+        return token_budget(language, chars)
+
+    def split(self, text: str, language: str, sections: dict[str, int]) -> dict[str, str]:
+        """Разбирает общий ответ на разделы; неразборчивые разделы пропускаются."""
+        parser = etree.XMLParser(recover=True, resolve_entities=False)
+        root = etree.fromstring((text or "<sections/>").encode("utf-8"), parser)
+        parts = {}
+        if root is None:
+            return parts
+        for name, chars in sections.items():
+            node = root if root.tag == name else root.find(f".//{name}")
+            if node is None:
+                continue
+            document = node.find("document")
+            raw = etree.tostring(document if document is not None else node, encoding="unicode")
+            result = validate_document(raw, token_budget(language, chars), check_length=False)
+            if result.usable:
+                parts[name] = render_document(result.root)
+        return parts
+
+    def write(self, topic: str, language: str, sections: dict[str, int]) -> dict[str, str]:
+        """sections — {имя раздела: объём в символах} для introduction/conclusion/references."""
+        text = self.invoke(self.prompt(topic, language, sections), self.budget(language, sections))
+        return self.split(text, language, sections)
+
+    async def awrite(self, topic: str, language: str, sections: dict[str, int]) -> dict[str, str]:
+        text = await self.ainvoke(self.prompt(topic, language, sections), self.budget(language, sections))
+        return self.split(text, language, sections)
@@ -1,20 +1,18 @@
-from langchain_openai import ChatOpenAI
 from src.config import settings
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import token_budget
 
-class IntroductionAgent:
-    def __init__(self, model=settings.refagent.model_name):
-        self.model = ChatOpenAI(
-            openai_api_key=settings.refagent.openai_api_key,
-            temperature=settings.refagent.temperature,
-            model=model
-        )
 
-    def write(self, 
+class IntroductionAgent(BaseAgent):
+    cache_name = "introduction"
+    validates_document = True
+
+    def prompt(self, 
               topic: str, 
               language: str = "ru", 
               chars: int = settings.refagent.chars or 1500
     ) -> str:
-        prompt = f"""
+        return f"""
 Ты — академический модуль для написания Введения реферата. 
 Тема: "{topic}"
 Язык: {language}
@@ -48,5 +46,16 @@ class IntroductionAgent:
 </document>
 """
 
-        result = self.model.invoke(prompt)
-        return result.content
+    def write(self,
+              topic: str,
+              language: str = "ru",
+              chars: int = settings.refagent.chars or 1500
+    ) -> str:
+        return self.invoke(self.prompt(topic, language, chars), token_budget(language, chars))
+
+    async def awrite(self,
+                     topic: str,
+                     language: str = "ru",
+                     chars: int = settings.refagent.chars or 1500
+    ) -> str:
+        return await self.ainvoke(self.prompt(topic, language, chars), token_budget(language, chars))
@@ -1,17 +1,12 @@
-from langchain_openai import ChatOpenAI
-from src.config import settings
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import PLAN_ITEM_CHARS, token_budget
 
 
-class PlanAgent:
-    def __init__(self, model=settings.refagent.model_name):
-        self.model = ChatOpenAI(
-            openai_api_key=settings.refagent.openai_api_key,
-            temperature=settings.refagent.temperature,
-            model=model
-        )
+class PlanAgent(BaseAgent):
+    cache_name = "plan"
 
-    def generate_plan(self, topic: str, language: str = "ru", chapters_count: int = 3) -> str:
-        prompt = f"""
+    def prompt(self, topic: str, language: str = "ru", chapters_count: int = 3) -> str:
+        return f"""
 Ты — интеллектуальный агент, который составляет план академического реферата
 строго в формате XML.
 
@@ -39,5 +34,10 @@ class PlanAgent:
 - Не используй markdown
 """
 
-        result = self.model.invoke(prompt)
-        return result.content
+    def generate_plan(self, topic: str, language: str = "ru", chapters_count: int = 3) -> str:
+        return self.invoke(self.prompt(topic, language, chapters_count),
+                           token_budget(language, PLAN_ITEM_CHARS * (chapters_count + 2)))
+
+    async def agenerate_plan(self, topic: str, language: str = "ru", chapters_count: int = 3) -> str:
+        return await self.ainvoke(self.prompt(topic, language, chapters_count),
+                                  token_budget(language, PLAN_ITEM_CHARS * (chapters_count + 2)))
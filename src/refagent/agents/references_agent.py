@@ -1,11 +1,19 @@
-from langchain_openai import ChatOpenAI
+from src.refagent.agents.base import BaseAgent
+from src.refagent.budget import REFERENCE_CHARS, token_budget
 
-class ReferencesAgent:
-    def __init__(self, model="gpt-4o-mini"):
-        self.model = ChatOpenAI(model=model)
 
-    def write(self, topic: str, language: str = "ru", count: int = 10):
-        prompt = f"""
+class ReferencesAgent(BaseAgent):
+    cache_name = "references"
+    validates_document = True
+    # Объём списка литературы задаётся числом источников, а не символами
+    check_length = False
+
+    # Модель выбирается по MODEL_ROUTES (по умолчанию references=gpt-4o-mini)
+    def __init__(self, model=None, temperature=None):
+        super().__init__(model=model, temperature=temperature)
+
+    def prompt(self, topic: str, language: str = "ru", count: int = 10) -> str:
+        return f"""
 Ты — интеллектуальный агент, который составляет список корректных и проверяемых источников для академического реферата.
 
 Тема: "{topic}"
@@ -34,7 +42,11 @@ class ReferencesAgent:
 </document>
 """
 
+    def write(self, topic: str, language: str = "ru", count: int = 10) -> str:
+        return self.invoke(self.prompt(topic, language, count),
+                           token_budget(language, REFERENCE_CHARS * count))
 
+    async def awrite(self, topic: str, language: str = "ru", count: int = 10) -> str:
+        return await self.ainvoke(self.prompt(topic, language, count),
+                                  token_budget(language, REFERENCE_CHARS * count))
 
-        result = self.model.invoke(prompt)
-        return result.content
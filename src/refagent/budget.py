@@ -0,0 +1,141 @@
+import os
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from src.config import settings
+
+
+# Стартовые оценки символов на токен до накопления статистики: кириллица
+# токенизируется плотнее латиницы, кыргызский — ещё плотнее русского.
+DEFAULT_CHARS_PER_TOKEN = {"ru": 3.0, "en": 4.0, "kg": 2.6}
+# Разметка <document>/<content>/<p>... поверх текста
+MARKUP_TOKENS = 200
+# Сколько токенов нужно накопить по языку, прежде чем доверять калибровке
+MIN_CALIBRATION_TOKENS = 5000
+# Символов на одну запись списка литературы и на один пункт плана
+REFERENCE_CHARS = 250
+PLAN_ITEM_CHARS = 200
+
+
+@dataclass(frozen=True)
+class TokenBudget:
+    """Целевой объём ответа агента и потолок max_tokens для вызова модели."""
+    language: str
+    target_chars: int
+    max_chars: int
+    max_tokens: int
+
+
+class TokenCalibration:
+    """
+    Наблюдаемое соотношение символов на токен по языкам.
+
+    Суммы символов и токенов ответов хранятся в SQLite-файле узла и
+    переживают перезапуск воркеров. Файл создаётся при первой записи.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS token_calibration ("
+                "language TEXT PRIMARY KEY, chars INTEGER NOT NULL, tokens INTEGER NOT NULL)"
+            )
+            yield conn
+        finally:
+            conn.close()
+
+    def chars_per_token(self, language: str) -> float:
+        default = DEFAULT_CHARS_PER_TOKEN.get(language, min(DEFAULT_CHARS_PER_TOKEN.values()))
+        if not self.path.exists():
+            return default
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT chars, tokens FROM token_calibration WHERE language = ?", (language,)
+            ).fetchone()
+        if not row or row[1] < MIN_CALIBRATION_TOKENS:
+            return default
+        return row[0] / row[1]
+
+    def record(self, language: str, chars: int, tokens: int):
+        if chars <= 0 or tokens <= 0:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO token_calibration (language, chars, tokens) VALUES (?, ?, ?) "
+                "ON CONFLICT(language) DO UPDATE SET "
+                "chars = token_calibration.chars + excluded.chars, "
+                "tokens = token_calibration.tokens + excluded.tokens",
+                (language, chars, tokens),
+            )
+
+
+_calibrations: dict[int, TokenCalibration] = {}
+
+
+def get_calibration() -> TokenCalibration:
+    pid = os.getpid()
+    calibration = _calibrations.get(pid)
+    if calibration is None:
+        calibration = TokenCalibration(settings.refagent.token_calibration_path)
+        _calibrations[pid] = calibration
+    return calibration
+
+
+def token_budget(language: str, chars: int, full_chars: int | None = None) -> TokenBudget:
+    """
+    Переводит объём раздела (chars/full_chars из chars_to_page) в потолок токенов.
+
+    full_chars — символы с пробелами; если не передан (или меньше, чем
+    следует из chars), выводится из chars по пропорциям страницы chars_to_page.
+    """
+    language = str(getattr(language, "value", language))
+    chars_per_page = settings.refagent.chars or 1500
+    full_chars_per_page = settings.refagent.full_chars or 2000
+    full_chars = max(full_chars or 0, int(chars * full_chars_per_page / chars_per_page))
+
+    max_chars = int(full_chars * (1 + settings.refagent.token_budget_margin))
+    chars_per_token = get_calibration().chars_per_token(language)
+    return TokenBudget(
+        language=language,
+        target_chars=full_chars,
+        max_chars=max_chars,
+        max_tokens=int(max_chars / chars_per_token) + MARKUP_TOKENS,
+    )
+
+
+def visible_chars(text: str) -> int:
+    """Длина текста без XML-разметки — ей меряется объём раздела."""
+    return len(re.sub(r"<[^>]+>", "", text))
+
+
+_BLOCK_END = re.compile(r"</(p|h1|h2|h3|ul|ol|table)>", re.IGNORECASE)
+
+
+def close_document(text: str) -> str:
+    """
+    Аккуратно завершает ответ, оборванный по бюджету: отрезает незаконченный
+    абзац и закрывает конверт <document><content>...<formulas>.
+    """
+    if "</document>" in text:
+        return text
+    if "</content>" not in text:
+        ends = list(_BLOCK_END.finditer(text))
+        if ends:
+            text = text[:ends[-1].end()]
+        text += "\n    </content>"
+    if "<formulas>" not in text:
+        text += "\n    <formulas>\n    </formulas>"
+    elif "</formulas>" not in text:
+        text = text[:text.rindex("<formulas>")] + "<formulas>\n    </formulas>"
+    return text + "\n</document>"
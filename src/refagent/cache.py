@@ -0,0 +1,191 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from src.config import settings
+
+
+def cache_key(model: str, temperature: float | None, prompt: str) -> str:
+    """Ключ кеша: sha256 от (model, temperature, prompt)."""
+    raw = f"{model}\x00{temperature}\x00{prompt}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """
+    Кеш ответов LLM на SQLite с вытеснением LRU и TTL.
+
+    Файл SQLite общий для всех процессов узла (API и воркеры), поэтому
+    счётчики hits/misses/coalesced тоже хранятся в нём. Одинаковые запросы,
+    которые выполняются одновременно в одном процессе, объединяются в один
+    вызов модели.
+    """
+
+    def __init__(self, path: Path | str, max_entries: int = 10000,
+                 ttl_seconds: int = 7 * 24 * 3600, clock: Callable[[], float] = time.time):
+        self.path = str(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._in_flight: dict[str, Future] = {}
+        self._async_in_flight: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Future]]" = \
+            weakref.WeakKeyDictionary()
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_accessed_at ON llm_cache (accessed_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _incr(self, conn: sqlite3.Connection, name: str):
+        conn.execute(
+            "INSERT INTO llm_cache_stats (name, value) VALUES (?, 1) "
+            "ON CONFLICT(name) DO UPDATE SET value = value + 1",
+            (name,),
+        )
+
+    def get(self, key: str) -> str | None:
+        now = self.clock()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row and row[1] + self.ttl_seconds > now:
+                conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                self._incr(conn, "hits")
+                return row[0]
+            if row:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+            self._incr(conn, "misses")
+            return None
+
+    def set(self, key: str, value: str):
+        now = self.clock()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now, now),
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at + ? <= ?", (self.ttl_seconds, now))
+            conn.execute(
+                "DELETE FROM llm_cache WHERE key IN ("
+                "SELECT key FROM llm_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        with self._connect() as conn:
+            counters = dict(conn.execute("SELECT name, value FROM llm_cache_stats").fetchall())
+            entries = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+        return {
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "coalesced": counters.get("coalesced", 0),
+            "entries": entries,
+        }
+
+    def _record_coalesced(self):
+        with self._connect() as conn:
+            self._incr(conn, "coalesced")
+
+    def get_or_call(self, key: str, call: Callable[[], str]) -> str:
+        """
+        Возвращает ответ из кеша или выполняет call().
+
+        Если такой же запрос уже выполняется в другом потоке, ждёт его
+        результат вместо повторного вызова модели.
+        """
+        with self._lock:
+            leader = self._in_flight.get(key)
+            if leader is None:
+                future = Future()
+                self._in_flight[key] = future
+        if leader is not None:
+            self._record_coalesced()
+            return leader.result()
+
+        try:
+            value = self.get(key)
+            if value is None:
+                value = call()
+                self.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    async def aget_or_call(self, key: str, call: Callable[[], Awaitable[str]]) -> str:
+        """Асинхронный вариант get_or_call: объединяет запросы внутри event loop."""
+        loop = asyncio.get_running_loop()
+        in_flight = self._async_in_flight.setdefault(loop, {})
+        leader = in_flight.get(key)
+        if leader is not None:
+            await asyncio.to_thread(self._record_coalesced)
+            return await asyncio.shield(leader)
+
+        future = loop.create_future()
+        in_flight[key] = future
+        try:
+            value = await asyncio.to_thread(self.get, key)
+            if value is None:
+                value = await call()
+                await asyncio.to_thread(self.set, key, value)
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже отдано вызывающему; ведомые получат его из future
+            future.exception()
+            raise
+        finally:
+            in_flight.pop(key, None)
+
+
+_caches: dict[int, LLMCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_llm_cache() -> LLMCache | None:
+    """Кеш текущего процесса или None, если кеш выключен (LLM_CACHE_ENABLED)."""
+    if not settings.refagent.llm_cache_enabled:
+        return None
+    pid = os.getpid()
+    cache = _caches.get(pid)
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get(pid)
+            if cache is None:
+                cache = LLMCache(
+                    settings.refagent.llm_cache_path,
+                    max_entries=settings.refagent.llm_cache_max_entries,
+                    ttl_seconds=settings.refagent.llm_cache_ttl_seconds,
+                )
+                _caches[pid] = cache
+    return cache
@@ -0,0 +1,96 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from src.config import settings
+
+
+# Сколько наблюдений задержки нужно по маршруту, прежде чем дублировать его вызовы
+MIN_HEDGE_SAMPLES = 20
+
+
+class Hedger:
+    """
+    Решает, когда дублировать (hedge) медленный вызов модели.
+
+    Задержки вызовов хранятся по ключу (маршрут, модель) в окне последних
+    HEDGE_WINDOW наблюдений процесса. Дубль отправляется, если вызов не
+    завершился за HEDGE_PERCENTILE недавних задержек, и только пока доля
+    дублей среди вызовов не превышает HEDGE_MAX_RATIO.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies: dict[tuple, deque] = {}
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    def begin(self, key: tuple) -> float | None:
+        """Учитывает вызов; возвращает задержку до дубля или None, если дублировать нельзя."""
+        with self._lock:
+            self.requests += 1
+            latencies = sorted(self._latencies.get(key, ()))
+        if not settings.refagent.hedge_enabled or len(latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        index = min(int(len(latencies) * settings.refagent.hedge_percentile), len(latencies) - 1)
+        return max(latencies[index], settings.refagent.hedge_min_delay_seconds)
+
+    def observe(self, key: tuple, latency: float):
+        with self._lock:
+            window = self._latencies.setdefault(key, deque(maxlen=settings.refagent.hedge_window))
+            window.append(latency)
+
+    def allow(self) -> bool:
+        """Резервирует дубль, если он укладывается в HEDGE_MAX_RATIO."""
+        with self._lock:
+            if self.hedges + 1 > settings.refagent.hedge_max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
+
+    def record_win(self):
+        with self._lock:
+            self.wins += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": settings.refagent.hedge_enabled,
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.wins,
+                "hedge_ratio": round(self.hedges / self.requests, 4) if self.requests else 0.0,
+            }
+
+
+_hedgers: dict[int, Hedger] = {}
+_executors: dict[int, ThreadPoolExecutor] = {}
+_lock = threading.Lock()
+
+
+def get_hedger() -> Hedger:
+    pid = os.getpid()
+    hedger = _hedgers.get(pid)
+    if hedger is None:
+        with _lock:
+            hedger = _hedgers.setdefault(pid, Hedger())
+    return hedger
+
+
+def get_hedge_executor() -> ThreadPoolExecutor:
+    """
+    Пул потоков синхронных вызовов с дублированием. Синхронный HTTP-запрос
+    нельзя прервать, поэтому проигравший вызов дорабатывает здесь в фоне.
+    """
+    pid = os.getpid()
+    executor = _executors.get(pid)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(pid)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=settings.refagent.http_max_connections,
+                                              thread_name_prefix="hedge")
+                _executors[pid] = executor
+    return executor
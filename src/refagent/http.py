@@ -0,0 +1,67 @@
+import asyncio
+import os
+import threading
+import weakref
+
+import httpx
+
+from src.config import settings
+
+
+_lock = threading.Lock()
+_sync_clients: dict[int, httpx.Client] = {}
+# Соединения AsyncClient привязаны к event loop, в котором созданы,
+# поэтому асинхронный клиент свой для каждого loop.
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.refagent.http_max_connections,
+        max_keepalive_connections=settings.refagent.http_max_keepalive,
+        keepalive_expiry=settings.refagent.http_keepalive_expiry,
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(settings.refagent.http_timeout, connect=10.0)
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Общий на процесс синхронный HTTP-клиент с keep-alive для всех агентов.
+
+    Ключ — pid: после fork (prefork-воркеры Celery) дочерний процесс
+    получает свой пул соединений, а не унаследованные сокеты родителя.
+    """
+    pid = os.getpid()
+    client = _sync_clients.get(pid)
+    if client is None or client.is_closed:
+        with _lock:
+            client = _sync_clients.get(pid)
+            if client is None or client.is_closed:
+                client = httpx.Client(limits=_limits(), timeout=_timeout())
+                _sync_clients[pid] = client
+    return client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Общий асинхронный HTTP-клиент с keep-alive для текущего event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(limits=_limits(), timeout=_timeout())
+        _async_clients[loop] = client
+    return client
+
+
+async def aclose_http_clients():
+    """Закрывает синхронный клиент процесса и асинхронный клиент текущего loop."""
+    with _lock:
+        sync_client = _sync_clients.pop(os.getpid(), None)
+    async_client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if sync_client is not None:
+        sync_client.close()
+    if async_client is not None:
+        await async_client.aclose()
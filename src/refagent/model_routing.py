@@ -0,0 +1,175 @@
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+
+from src.config import settings
+from src.refagent.budget import TokenBudget
+
+
+@dataclass(frozen=True)
+class ModelRoute:
+    """Строка таблицы MODEL_ROUTES: агент, верхняя граница объёма (символы) и модель."""
+    agent: str
+    max_chars: int | None
+    model: str
+
+    @property
+    def name(self) -> str:
+        return self.agent if self.max_chars is None else f"{self.agent}:{self.max_chars}"
+
+
+@dataclass(frozen=True)
+class RouteChoice:
+    """Выбранная для вызова модель и строка таблицы, по которой она выбрана."""
+    route: str
+    model: str
+    fallback: bool = False
+
+
+def parse_routes(spec: str) -> list[ModelRoute]:
+    """
+    Разбирает MODEL_ROUTES: "plan=gpt-4o-mini,chapter:6000=gpt-4o-mini,chapter=gpt-4o".
+
+    agent:N — вызовы этого агента с целевым объёмом до N символов включительно.
+    """
+    routes = []
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, _, model = item.partition("=")
+        agent, _, max_chars = key.strip().partition(":")
+        if not model.strip():
+            raise ValueError(f"Invalid MODEL_ROUTES entry: {item!r}")
+        routes.append(ModelRoute(agent, int(max_chars) if max_chars else None, model.strip()))
+    return routes
+
+
+def parse_prices(spec: str) -> dict[str, tuple[float, float]]:
+    """MODEL_PRICES: "gpt-4o=2.5/10" — USD за 1M входных/выходных токенов."""
+    prices = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        model, _, price = item.partition("=")
+        prompt_price, _, completion_price = price.partition("/")
+        prices[model.strip()] = (float(prompt_price), float(completion_price or prompt_price))
+    return prices
+
+
+def match_route(agent: str, budget: TokenBudget | None, default_model: str) -> ModelRoute:
+    """Самая узкая полоса агента, в которую помещается целевой объём; иначе — MODEL_NAME."""
+    chars = budget.target_chars if budget is not None else 0
+    bands = sorted(
+        (route for route in parse_routes(settings.refagent.model_routes) if route.agent == agent),
+        key=lambda route: route.max_chars if route.max_chars is not None else float("inf"),
+    )
+    for route in bands:
+        if route.max_chars is None or chars <= route.max_chars:
+            return route
+    return ModelRoute(agent or "default", None, default_model)
+
+
+class RouteStats:
+    """
+    Задержка и стоимость вызовов по (маршрут, модель).
+
+    Суммы хранятся в SQLite-файле узла, как калибровка токенов: по ним
+    выбирается запасная модель и подстраивается таблица MODEL_ROUTES.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS model_route_stats ("
+                "route TEXT NOT NULL, model TEXT NOT NULL, calls INTEGER NOT NULL, "
+                "fallbacks INTEGER NOT NULL, latency_seconds REAL NOT NULL, "
+                "input_tokens INTEGER NOT NULL, output_tokens INTEGER NOT NULL, cost_usd REAL NOT NULL, "
+                "PRIMARY KEY (route, model))"
+            )
+            yield conn
+        finally:
+            conn.close()
+
+    def record(self, choice: RouteChoice, latency: float, input_tokens: int = 0, output_tokens: int = 0):
+        prompt_price, completion_price = parse_prices(settings.refagent.model_prices).get(choice.model, (0.0, 0.0))
+        cost = (input_tokens * prompt_price + output_tokens * completion_price) / 1_000_000
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO model_route_stats VALUES (?, ?, 1, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(route, model) DO UPDATE SET "
+                "calls = calls + 1, fallbacks = fallbacks + excluded.fallbacks, "
+                "latency_seconds = latency_seconds + excluded.latency_seconds, "
+                "input_tokens = input_tokens + excluded.input_tokens, "
+                "output_tokens = output_tokens + excluded.output_tokens, "
+                "cost_usd = cost_usd + excluded.cost_usd",
+                (choice.route, choice.model, int(choice.fallback), latency, input_tokens, output_tokens, cost),
+            )
+
+    def mean_latency(self, route: str, model: str) -> float:
+        if not self.path.exists():
+            return 0.0
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT calls, latency_seconds FROM model_route_stats WHERE route = ? AND model = ?",
+                (route, model),
+            ).fetchone()
+        return row[1] / row[0] if row and row[0] else 0.0
+
+    def stats(self) -> list[dict]:
+        if not self.path.exists():
+            return []
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT route, model, calls, fallbacks, latency_seconds, input_tokens, output_tokens, cost_usd "
+                "FROM model_route_stats ORDER BY route, model"
+            ).fetchall()
+        return [
+            {
+                "route": route, "model": model, "calls": calls, "fallbacks": fallbacks,
+                "mean_latency_seconds": round(latency / calls, 3) if calls else 0.0,
+                "input_tokens": input_tokens, "output_tokens": output_tokens,
+                "cost_usd": round(cost, 6),
+            }
+            for route, model, calls, fallbacks, latency, input_tokens, output_tokens, cost in rows
+        ]
+
+
+_route_stats: dict[int, RouteStats] = {}
+
+
+def get_route_stats() -> RouteStats:
+    pid = os.getpid()
+    stats = _route_stats.get(pid)
+    if stats is None:
+        stats = RouteStats(settings.refagent.model_stats_path)
+        _route_stats[pid] = stats
+    return stats
+
+
+def select_model(agent: str, budget: TokenBudget | None, default_model: str,
+                 queue_wait: float = 0.0) -> RouteChoice:
+    """
+    Модель для вызова агента по таблице MODEL_ROUTES.
+
+    Если ожидаемое время ответа — ожидание бюджета (queue_wait) плюс средняя
+    задержка маршрута — больше MODEL_LATENCY_SLO_SECONDS, выбирается
+    более быстрая MODEL_FALLBACK.
+    """
+    route = match_route(agent, budget, default_model)
+    fallback = settings.refagent.model_fallback
+    slo = settings.refagent.model_latency_slo_seconds
+    if fallback and fallback != route.model and slo > 0:
+        expected = queue_wait + get_route_stats().mean_latency(route.name, route.model)
+        if expected > slo:
+            return RouteChoice(route.name, fallback, fallback=True)
+    return RouteChoice(route.name, route.model)
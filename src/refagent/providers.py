@@ -0,0 +1,164 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable
+
+import httpx
+import openai
+
+from src.config import settings
+
+
+# Ошибки, после которых вызов повторяется на другом endpoint пула.
+# 429 сюда не входит: его обрабатывает общий лимитер (src.refagent.ratelimit).
+FAILOVER_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+    httpx.TransportError,
+)
+
+# Сколько последних вызовов endpoint нужно, прежде чем судить о его здоровье
+MIN_HEALTH_SAMPLES = 5
+
+
+@dataclass(frozen=True)
+class Endpoint:
+    """OpenAI-совместимый шлюз: base_url None — официальный API OpenAI."""
+    name: str
+    base_url: str | None
+    api_key: str
+    weight: float = 1.0
+
+
+def parse_endpoints(spec: str) -> list[Endpoint]:
+    """
+    Разбирает OPENAI_ENDPOINTS: "name|base_url|api_key|weight;...".
+
+    Пустой ключ — OPENAI_API_KEY, пустой вес — 1. Пустая строка — один
+    endpoint по умолчанию (api.openai.com).
+    """
+    endpoints = []
+    for item in spec.split(";"):
+        if not item.strip():
+            continue
+        name, base_url, api_key, weight = (item.split("|") + ["", "", ""])[:4]
+        if not name.strip() or not base_url.strip():
+            raise ValueError(f"Invalid OPENAI_ENDPOINTS entry: {item!r}")
+        endpoints.append(Endpoint(
+            name=name.strip(),
+            base_url=base_url.strip(),
+            api_key=api_key.strip() or settings.refagent.openai_api_key,
+            weight=float(weight) if weight.strip() else 1.0,
+        ))
+    return endpoints or [Endpoint("openai", None, settings.refagent.openai_api_key)]
+
+
+@dataclass
+class EndpointHealth:
+    """Скользящее окно последних вызовов endpoint и время, до которого он исключён."""
+    window: deque = field(default_factory=deque)
+    ejected_until: float = 0.0
+    ejections: int = 0
+    calls: int = 0
+    errors: int = 0
+
+    def error_rate(self) -> float:
+        return sum(1 for ok, _ in self.window if not ok) / len(self.window) if self.window else 0.0
+
+    def p95_latency(self) -> float:
+        latencies = sorted(latency for ok, latency in self.window if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)]
+
+
+class ProviderPool:
+    """
+    Пул OpenAI-совместимых endpoint с учётом здоровья.
+
+    choose() выбирает endpoint случайно пропорционально весу среди
+    неисключённых. Endpoint с долей ошибок выше PROVIDER_MAX_ERROR_RATE или
+    p95 задержки выше PROVIDER_MAX_P95_SECONDS исключается на
+    PROVIDER_EJECT_SECONDS, после чего возвращается с чистой статистикой.
+    Если исключены все, берётся тот, чьё исключение истекает раньше.
+    """
+
+    def __init__(self, endpoints: list[Endpoint], clock: Callable[[], float] = time.monotonic,
+                 rng: random.Random | None = None):
+        self.endpoints = endpoints
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._health = {endpoint.name: EndpointHealth() for endpoint in endpoints}
+
+    def _reinstate(self, now: float):
+        for health in self._health.values():
+            if health.ejected_until and health.ejected_until <= now:
+                health.ejected_until = 0.0
+                health.window.clear()
+
+    def choose(self, exclude: tuple[str, ...] | list[str] = ()) -> Endpoint:
+        with self._lock:
+            now = self.clock()
+            self._reinstate(now)
+            candidates = [endpoint for endpoint in self.endpoints if endpoint.name not in exclude] \
+                or self.endpoints
+            healthy = [endpoint for endpoint in candidates if not self._health[endpoint.name].ejected_until]
+            if not healthy:
+                return min(candidates, key=lambda endpoint: self._health[endpoint.name].ejected_until)
+            return self.rng.choices(healthy, weights=[endpoint.weight for endpoint in healthy])[0]
+
+    def record(self, endpoint: Endpoint, ok: bool, latency: float):
+        with self._lock:
+            health = self._health[endpoint.name]
+            health.calls += 1
+            health.errors += 0 if ok else 1
+            health.window.append((ok, latency))
+            while len(health.window) > settings.refagent.provider_window:
+                health.window.popleft()
+            if health.ejected_until or len(health.window) < MIN_HEALTH_SAMPLES:
+                return
+            if health.error_rate() > settings.refagent.provider_max_error_rate \
+                    or health.p95_latency() > settings.refagent.provider_max_p95_seconds:
+                health.ejected_until = self.clock() + settings.refagent.provider_eject_seconds
+                health.ejections += 1
+
+    def stats(self) -> list[dict]:
+        with self._lock:
+            now = self.clock()
+            return [
+                {
+                    "endpoint": endpoint.name,
+                    "base_url": endpoint.base_url,
+                    "weight": endpoint.weight,
+                    "ejected": health.ejected_until > now,
+                    "ejections": health.ejections,
+                    "calls": health.calls,
+                    "errors": health.errors,
+                    "error_rate": round(health.error_rate(), 4),
+                    "p95_latency_seconds": round(health.p95_latency(), 3),
+                }
+                for endpoint in self.endpoints
+                for health in (self._health[endpoint.name],)
+            ]
+
+
+_pools: dict[int, ProviderPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_provider_pool() -> ProviderPool:
+    """Пул endpoint текущего процесса (OPENAI_ENDPOINTS)."""
+    pid = os.getpid()
+    pool = _pools.get(pid)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(pid)
+            if pool is None:
+                pool = ProviderPool(parse_endpoints(settings.refagent.openai_endpoints))
+                _pools[pid] = pool
+    return pool
@@ -0,0 +1,218 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Callable
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, case, create_engine, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Engine
+
+from src.config import settings
+
+
+REQUESTS_BUCKET = "openai:requests"
+TOKENS_BUCKET = "openai:tokens"
+
+_metadata = MetaData()
+
+rate_limit_buckets = Table(
+    "rate_limit_buckets",
+    _metadata,
+    Column("name", String(64), primary_key=True),
+    Column("tokens", Float, nullable=False),
+    Column("updated_at", Float, nullable=False),
+    # Счётчики для метрик: сколько выдано, сколько раз и сколько секунд ждали
+    Column("acquired", Float, nullable=False, default=0),
+    Column("requests", Integer, nullable=False, default=0),
+    Column("throttled", Integer, nullable=False, default=0),
+    Column("waited_seconds", Float, nullable=False, default=0),
+)
+
+
+def estimate_tokens(prompt: str, completion_tokens: int) -> int:
+    """Грубая оценка токенов запроса: ~3 символа на токен плюс резерв на ответ."""
+    return len(prompt) // 3 + completion_tokens
+
+
+class SqlRateLimitBackend:
+    """
+    Хранилище token bucket в таблице rate_limit_buckets.
+
+    Списание — один атомарный UPDATE с условием на остаток, поэтому бакет
+    можно делить между процессами и узлами: с Postgres (sync_engine) —
+    на весь кластер, с файлом SQLite — на один узел и в тестах.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        _metadata.create_all(engine)
+
+    def _ensure(self, conn, name: str, capacity: float, now: float):
+        dialect = postgresql if self.engine.dialect.name == "postgresql" else sqlite
+        conn.execute(
+            dialect.insert(rate_limit_buckets).on_conflict_do_nothing(index_elements=["name"]),
+            {"name": name, "tokens": capacity, "updated_at": now, "acquired": 0,
+             "requests": 0, "throttled": 0, "waited_seconds": 0},
+        )
+
+    def try_acquire(self, name: str, amount: float, capacity: float,
+                    refill_per_second: float, now: float) -> float:
+        """
+        Списывает amount из бакета. Возвращает 0, если списано, иначе —
+        сколько секунд ждать до пополнения.
+        """
+        bucket = rate_limit_buckets.c
+        elapsed = case((bucket.updated_at < now, now - bucket.updated_at), else_=0)
+        refilled = case(
+            (bucket.tokens + elapsed * refill_per_second > capacity, capacity),
+            else_=bucket.tokens + elapsed * refill_per_second,
+        )
+        with self.engine.begin() as conn:
+            self._ensure(conn, name, capacity, now)
+            acquired = conn.execute(
+                update(rate_limit_buckets)
+                .where(bucket.name == name, refilled >= amount)
+                .values(tokens=refilled - amount, updated_at=now,
+                        acquired=bucket.acquired + amount, requests=bucket.requests + 1)
+            ).rowcount
+            if acquired:
+                return 0.0
+            tokens = conn.execute(select(refilled).where(bucket.name == name)).scalar_one()
+        return max((amount - tokens) / refill_per_second, 0.01)
+
+    def record_wait(self, name: str, seconds: float):
+        bucket = rate_limit_buckets.c
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(rate_limit_buckets).where(bucket.name == name)
+                .values(throttled=bucket.throttled + 1, waited_seconds=bucket.waited_seconds + seconds)
+            )
+
+    def drain(self, name: str, now: float):
+        """Обнуляет бакет: после 429 паузу делают все воркеры, а не только получивший ошибку."""
+        with self.engine.begin() as conn:
+            conn.execute(
+                update(rate_limit_buckets).where(rate_limit_buckets.c.name == name)
+                .values(tokens=0, updated_at=now)
+            )
+
+    def stats(self) -> list[dict]:
+        with self.engine.connect() as conn:
+            rows = conn.execute(select(rate_limit_buckets).order_by(rate_limit_buckets.c.name)).mappings()
+            return [dict(row) for row in rows]
+
+
+class RateLimiter:
+    """
+    Общий бюджет OpenAI: запросы в минуту и токены в минуту.
+
+    acquire() ждёт, пока в обоих бакетах хватит бюджета, вместо того чтобы
+    отправить запрос и получить 429.
+    """
+
+    def __init__(self, backend: SqlRateLimitBackend, requests_per_minute: int, tokens_per_minute: int,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep):
+        self.backend = backend
+        self.buckets = {
+            REQUESTS_BUCKET: float(requests_per_minute),
+            TOKENS_BUCKET: float(tokens_per_minute),
+        }
+        self.clock = clock
+        self.sleep = sleep
+
+    def _amounts(self, tokens: int) -> list[tuple[str, float, float]]:
+        return [
+            (REQUESTS_BUCKET, 1.0, self.buckets[REQUESTS_BUCKET]),
+            # Запрос больше ёмкости бакета иначе не прошёл бы никогда
+            (TOKENS_BUCKET, float(min(tokens, self.buckets[TOKENS_BUCKET])), self.buckets[TOKENS_BUCKET]),
+        ]
+
+    def _try(self, name: str, amount: float, capacity: float) -> float:
+        return self.backend.try_acquire(name, amount, capacity, capacity / 60.0, self.clock())
+
+    def acquire(self, tokens: int):
+        for name, amount, capacity in self._amounts(tokens):
+            waited = 0.0
+            while (delay := self._try(name, amount, capacity)) > 0:
+                self.sleep(delay)
+                waited += delay
+            if waited:
+                self.backend.record_wait(name, waited)
+
+    async def aacquire(self, tokens: int):
+        for name, amount, capacity in self._amounts(tokens):
+            waited = 0.0
+            while (delay := await asyncio.to_thread(self._try, name, amount, capacity)) > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            if waited:
+                await asyncio.to_thread(self.backend.record_wait, name, waited)
+
+    def estimate_wait(self, tokens: int) -> float:
+        """Сколько секунд сейчас пришлось бы ждать бюджета на запрос (без списания)."""
+        rows = {row["name"]: row for row in self.backend.stats()}
+        now, wait = self.clock(), 0.0
+        for name, amount, capacity in self._amounts(tokens):
+            row = rows.get(name)
+            if row is None:
+                continue
+            available = min(capacity, row["tokens"] + max(now - row["updated_at"], 0) * capacity / 60.0)
+            wait = max(wait, (amount - available) * 60.0 / capacity)
+        return wait
+
+    def throttle(self):
+        """Провайдер ответил 429: бюджет запросов исчерпан для всех."""
+        self.backend.drain(REQUESTS_BUCKET, self.clock())
+
+    def stats(self) -> list[dict]:
+        result = []
+        now = self.clock()
+        for row in self.backend.stats():
+            capacity = self.buckets.get(row["name"])
+            if capacity is None:
+                continue
+            elapsed = max(now - row["updated_at"], 0)
+            available = min(capacity, row["tokens"] + elapsed * capacity / 60.0)
+            result.append({
+                "bucket": row["name"],
+                "capacity_per_minute": capacity,
+                "available": round(available, 2),
+                "acquired": row["acquired"],
+                "requests": row["requests"],
+                "throttled": row["throttled"],
+                "waited_seconds": round(row["waited_seconds"], 3),
+            })
+        return result
+
+
+_limiters: dict[int, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def _backend_engine() -> Engine:
+    if settings.refagent.rate_limit_backend == "postgres":
+        from src.database import sync_engine
+        return sync_engine
+    path = settings.refagent.rate_limit_sqlite_path
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return create_engine(f"sqlite+pysqlite:///{path}", connect_args={"timeout": 30})
+
+
+def get_rate_limiter() -> RateLimiter | None:
+    """Лимитер текущего процесса или None, если RATE_LIMIT_BACKEND=none."""
+    if settings.refagent.rate_limit_backend == "none":
+        return None
+    pid = os.getpid()
+    limiter = _limiters.get(pid)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(pid)
+            if limiter is None:
+                limiter = RateLimiter(
+                    SqlRateLimitBackend(_backend_engine()),
+                    requests_per_minute=settings.refagent.openai_rpm,
+                    tokens_per_minute=settings.refagent.openai_tpm,
+                )
+                _limiters[pid] = limiter
+    return limiter
@@ -107,3 +107,59 @@ def distribute_pages_with_priority(
         "total_pages": total_pages,
         "remainder_pages": int(remainder),
     }
+
+
+def build_plan_layout(plan: str, page_count: int, chapters_count: int | None = None):
+    """
+    Превращает ответ PlanAgent в структуру эссе: названия глав и объём разделов.
+
+    Используется и в API (синхронная генерация плана), и в воркере
+    (генерация плана как фоновая задача).
+
+    Аргументы:
+        plan (str): XML-ответ PlanAgent
+        page_count (int): Общее количество страниц
+        chapters_count (int | None): Запрошенное количество глав (если план пустой)
+
+    Возвращает:
+        dict с ключами:
+            - 'plan_list': названия глав
+            - 'introduction_chars', 'conclusion_chars', 'references_chars'
+            - 'chapters_chars': список символов на каждую главу
+
+    Исключения:
+        ValueError: если страницы нельзя распределить по главам
+    """
+    plan_list = parse_plan(plan)
+    if not plan_list:
+        requested_chapters = chapters_count or 1
+        plan_list = [f"Глава {idx}" for idx in range(1, requested_chapters + 1)]
+    number_of_chapters = len(plan_list) or 1
+
+    # Определяем страницы для введения, заключения, глав
+    if page_count <= 20:
+        pages = 1
+    elif page_count <= 40:
+        pages = 2
+    else:
+        pages = 3
+
+    pages_priority = distribute_pages_with_priority(
+        total_pages=page_count,
+        intro_pages=pages,
+        conclusion_pages=pages,
+        references_pages=1,
+        number_of_chapters=number_of_chapters
+    )
+
+    chapter_pages = pages_priority.get("chapters", [])
+    if len(chapter_pages) != number_of_chapters:
+        raise ValueError("Количество распределённых страниц не совпадает с количеством глав.")
+
+    return {
+        "plan_list": plan_list,
+        "introduction_chars": chars_to_page(pages_priority.get("introduction", pages)).get("chars", 1000),
+        "conclusion_chars": chars_to_page(pages_priority.get("conclusion", pages)).get("chars", 1000),
+        "references_chars": chars_to_page(pages_priority.get("references", 1)).get("chars", 500),
+        "chapters_chars": [chars_to_page(chapter_page)["chars"] for chapter_page in chapter_pages],
+    }
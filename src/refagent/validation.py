@@ -0,0 +1,243 @@
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+from lxml import etree
+
+from src.config import settings
+from src.refagent.budget import TokenBudget
+
+
+# Сколько последних символов уже написанного текста показывать модели при продолжении
+CONTINUATION_TAIL_CHARS = 1500
+
+_DOCUMENT = re.compile(r"<document\b.*?(</document>|$)", re.DOTALL)
+_FENCE = re.compile(r"^```[a-zA-Z]*\s*|\s*```$")
+
+
+class InvalidDocument(ValueError):
+    """Ответ агента так и не удалось привести к формату <document>."""
+
+
+@dataclass
+class ValidationResult:
+    root: etree._Element | None
+    problems: list[str] = field(default_factory=list)
+    missing_chars: int = 0
+
+    @property
+    def ok(self) -> bool:
+        return not self.problems
+
+    @property
+    def usable(self) -> bool:
+        """Конверт корректен; не хватает разве что объёма."""
+        return self.root is not None and all(problem == "too_short" for problem in self.problems)
+
+
+def _parser() -> etree.XMLParser:
+    return etree.XMLParser(recover=True, remove_blank_text=False, resolve_entities=False)
+
+
+def _wrap(text: str) -> str:
+    """Оборачивает ответ без конверта: текст без тегов разбивается на абзацы."""
+    if "<" not in text:
+        text = "".join(f"<p>{part.strip()}</p>" for part in re.split(r"\n\s*\n", text) if part.strip())
+    return f"<document><content>{text}</content><formulas></formulas></document>"
+
+
+def parse_document(text: str) -> etree._Element | None:
+    """
+    Быстрый разбор ответа агента через lxml.
+
+    Лишний текст вокруг <document> и markdown-ограждения отбрасываются,
+    ответ без конверта оборачивается заново. None — если текста нет вовсе.
+    """
+    text = _FENCE.sub("", (text or "").strip())
+    if not text:
+        return None
+    match = _DOCUMENT.search(text)
+    if match:
+        text = match.group(0)
+    elif "<content" not in text:
+        text = _wrap(text)
+    else:
+        text = f"<document>{text}</document>"
+
+    root = etree.fromstring(text.encode("utf-8"), _parser())
+    if root is None:
+        return None
+    if root.tag != "document":
+        wrapper = etree.Element("document")
+        wrapper.append(root)
+        root = wrapper
+    if root.find("content") is None:
+        content = etree.SubElement(root, "content")
+        for child in [child for child in root if child.tag not in ("content", "formulas")]:
+            content.append(child)
+    if root.find("formulas") is None:
+        etree.SubElement(root, "formulas")
+    return root
+
+
+def content_chars(root: etree._Element) -> int:
+    content = root.find("content")
+    return len("".join(content.itertext()).strip()) if content is not None else 0
+
+
+def _fix_formulas(root: etree._Element):
+    """Убирает ссылки на несуществующие формулы и формулы без ссылок."""
+    content, formulas = root.find("content"), root.find("formulas")
+    defined = {latex.get("id") for latex in formulas.iter("latex")}
+    for ref in list(content.iter("formula")):
+        if ref.get("id") not in defined:
+            parent = ref.getparent()
+            if ref.tail:
+                previous = ref.getprevious()
+                if previous is not None:
+                    previous.tail = (previous.tail or "") + ref.tail
+                else:
+                    parent.text = (parent.text or "") + ref.tail
+            parent.remove(ref)
+    used = {ref.get("id") for ref in content.iter("formula")}
+    for latex in list(formulas.iter("latex")):
+        if latex.get("id") not in used:
+            formulas.remove(latex)
+
+
+def _trim(root: etree._Element, max_chars: int):
+    """Отрезает лишние блоки в конце, если текст вышел за потолок бюджета."""
+    content = root.find("content")
+    while len(content) > 1 and content_chars(root) > max_chars:
+        content.remove(content[-1])
+
+
+def validate_document(text: str, budget: TokenBudget | None = None,
+                      check_length: bool = True) -> ValidationResult:
+    """
+    Проверяет конверт <document><content>…<formulas>, согласованность id
+    формул и объём. Дешёвые исправления (перезаворачивание, лишние формулы,
+    обрезка сверх потолка) выполняются сразу, без вызова модели.
+    """
+    root = parse_document(text)
+    if root is None or not content_chars(root):
+        return ValidationResult(None, ["empty_content"])
+
+    _fix_formulas(root)
+    result = ValidationResult(root)
+    if budget is not None and check_length:
+        _trim(root, budget.max_chars)
+        min_chars = int(budget.target_chars * (1 - settings.refagent.validation_length_tolerance))
+        if content_chars(root) < min_chars:
+            result.problems.append("too_short")
+            result.missing_chars = budget.target_chars - content_chars(root)
+    return result
+
+
+def render_document(root: etree._Element) -> str:
+    return etree.tostring(root, encoding="unicode")
+
+
+def merge_documents(roots: list[etree._Element]) -> etree._Element:
+    """
+    Склеивает документы в один: содержимое <content> подряд, формулы
+    перенумеровываются (f1, f2, ...), чтобы id не пересекались.
+    """
+    merged = etree.fromstring(b"<document><content/><formulas/></document>")
+    content, formulas = merged.find("content"), merged.find("formulas")
+    counter = 0
+    for root in roots:
+        ids = {}
+        for latex in root.find("formulas").iter("latex"):
+            counter += 1
+            ids[latex.get("id")] = f"f{counter}"
+        for ref in root.find("content").iter("formula"):
+            if ref.get("id") in ids:
+                ref.set("id", ids[ref.get("id")])
+        for latex in list(root.find("formulas").iter("latex")):
+            latex.set("id", ids[latex.get("id")])
+            formulas.append(latex)
+        source = root.find("content")
+        if source.text and source.text.strip():
+            paragraph = etree.SubElement(content, "p")
+            paragraph.text = source.text.strip()
+        for child in list(source):
+            content.append(child)
+    return merged
+
+
+def continuation_prompt(root: etree._Element, missing_chars: int, language: str) -> str:
+    tail = "".join(root.find("content").itertext()).strip()[-CONTINUATION_TAIL_CHARS:]
+    return f"""
+Ты продолжаешь раздел академического реферата, который оборвался раньше нужного объёма.
+Язык: {language}
+Конец уже написанного текста:
+\"\"\"{tail}\"\"\"
+
+Напиши продолжение объёмом около {missing_chars} символов. Не повторяй написанное,
+не начинай раздел заново, продолжай мысль с того места, где текст остановился.
+В тексте используй только теги: h2, h3, p, ul, ol, table.
+Формулы — как <formula id="fX"/>, их LaTeX — в блоке <formulas> как <latex id="fX">...</latex>.
+
+Выведи результат строго в формате:
+
+<document>
+    <content>
+        ...продолжение...
+    </content>
+    <formulas>
+    </formulas>
+</document>
+"""
+
+
+def ensure_valid_document(text: str, budget: TokenBudget, *, check_length: bool,
+                          continue_text: Callable[[str, int], str],
+                          regenerate: Callable[[], str]) -> str:
+    """
+    Проверяет ответ и чинит его не дороже, чем нужно (VALIDATION_MAX_RETRIES попыток):
+    нехватка объёма — продолжение текста (continue_text(prompt, missing_chars)),
+    полная перегенерация (regenerate) — только если конверт не восстановить.
+    """
+    result = validate_document(text, budget, check_length)
+    for _ in range(settings.refagent.validation_max_retries):
+        if result.ok:
+            break
+        if result.usable:
+            extra = parse_document(continue_text(
+                continuation_prompt(result.root, result.missing_chars, budget.language),
+                result.missing_chars,
+            ))
+            if extra is not None:
+                text = render_document(merge_documents([result.root, extra]))
+        else:
+            text = regenerate()
+        result = validate_document(text, budget, check_length)
+    return _finish(result)
+
+
+async def aensure_valid_document(text: str, budget: TokenBudget, *, check_length: bool,
+                                 continue_text: Callable[[str, int], Awaitable[str]],
+                                 regenerate: Callable[[], Awaitable[str]]) -> str:
+    result = validate_document(text, budget, check_length)
+    for _ in range(settings.refagent.validation_max_retries):
+        if result.ok:
+            break
+        if result.usable:
+            extra = parse_document(await continue_text(
+                continuation_prompt(result.root, result.missing_chars, budget.language),
+                result.missing_chars,
+            ))
+            if extra is not None:
+                text = render_document(merge_documents([result.root, extra]))
+        else:
+            text = await regenerate()
+        result = validate_document(text, budget, check_length)
+    return _finish(result)
+
+
+def _finish(result: ValidationResult) -> str:
+    # Короткий, но корректный раздел лучше упавшего эссе
+    if not result.usable:
+        raise InvalidDocument(f"Invalid agent output: {', '.join(result.problems)}")
+    return render_document(result.root)
@@ -1,5 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy import select
+import asyncio
+import json
+import weakref
+from datetime import datetime, timezone
+
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, HTTPException, Query, Response, status
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, select, update
 from sqlalchemy.orm import selectinload
 from celery.result import AsyncResult
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -7,13 +13,18 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from src.auth.services import get_current_user
 from src.models.profile import Profile
 from src.models.users import User
-from src.models.essay import EnumLanguage, Essay, EssayMetadata, EnumStatus, Chapter
+from src.models.essay import EnumLanguage, Essay, EssayMetadata, EnumStatus, Chapter, EssaySection
 from src.database import get_async_session
 from src.schemas.essay import RefRequest, UpdateChapterRequest
 from src.refagent.agents.plan_agent import PlanAgent
-from src.refagent.utils import chars_to_page, distribute_pages_with_priority, parse_plan
+from src.refagent.utils import build_plan_layout
 from src.celery_app import celery_app
-from src.tasks.essay import generate_essay
+from src.tasks.essay import dispatch_section_drafts, release_queued_essays
+from src.tasks.plan import generate_plan_task
+from src.tasks.outbox import enqueue_task, relay_outbox
+from src.tasks.routing import in_flight_limit, plan_route
+from src.notifications import anotify_essay, get_essay_listener, wait_for_essay_change
+from src.idempotency import idempotent
 from src.config import settings
 
 
@@ -22,13 +33,83 @@ from src.config import settings
 
 router = APIRouter(prefix="/essays", tags=["Essay"])
 
+_plan_semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+    weakref.WeakKeyDictionary()
+
+
+def _plan_semaphore() -> asyncio.Semaphore:
+    """Ограничение одновременных вызовов PlanAgent на процесс (PLAN_MAX_CONCURRENCY)."""
+    loop = asyncio.get_running_loop()
+    semaphore = _plan_semaphores.get(loop)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(settings.refagent.plan_max_concurrency)
+        _plan_semaphores[loop] = semaphore
+    return semaphore
+
+
+def _essay_metadata(essay_id: int, ref_request: RefRequest, profile: Profile) -> EssayMetadata:
+    return EssayMetadata(
+        essay_id=essay_id,
+        university=profile.university or "Не указано",
+        faculty=profile.faculty or "Не указано",
+        subject=ref_request.subject or "Не указано",
+        course=profile.course or 1,
+        performed_by=f"{profile.surname} {profile.name}",
+        checked_by=ref_request.checked_by or "Не указано",
+        group=profile.group or "Не указано",
+        city=profile.city or "Не указано"
+    )
+
+
+async def _queue_plan(ref_request: RefRequest, profile: Profile, current_user: User,
+                      session: AsyncSession):
+    """
+    Создаёт эссе в статусе PLAN_PENDING и ставит генерацию плана в outbox
+    той же транзакцией.
+
+    Объёмы разделов и главы заполнит воркер (generate_plan_task);
+    клиент опрашивает /essays/{essay_id}/status.
+    """
+    essay = Essay(
+        topic=ref_request.topic or "Без темы",
+        page_count=ref_request.page_count or 20,
+        language=ref_request.language or EnumLanguage.RU,
+        chapter_count=ref_request.chapters_count or 1,
+        introduction_chars_count=0,
+        conclusion_chars_count=0,
+        references_chars_count=0,
+        status=EnumStatus.PLAN_PENDING,
+        user_id=current_user.id
+    )
+    session.add(essay)
+    await session.flush()
+    session.add(_essay_metadata(essay.id, ref_request, profile))
+    essay.task_id = enqueue_task(session, generate_plan_task, (essay.id, ref_request.chapters_count),
+                                 plan_route().options())
+    await session.commit()
+
+    return {"essay_id": essay.id, "status": essay.status, "task_id": essay.task_id}
+
+
 # ========================================================= 
 @router.post("/plan/generate")
 async def generate_plan(
     ref_request: RefRequest,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user),
     session: AsyncSession = Depends(get_async_session),
 ):
+    # Задачи из outbox публикуются после ответа: брокер не на пути запроса
+    background_tasks.add_task(relay_outbox)
+    return await idempotent(
+        session, response, current_user.id, idempotency_key, "plan/generate", ref_request,
+        lambda: _generate_plan(ref_request, current_user, session),
+    )
+
+
+async def _generate_plan(ref_request: RefRequest, current_user: User, session: AsyncSession) -> dict:
     # Получаем профиль пользователя
     result = await session.execute(
         select(Profile).where(Profile.user_id == current_user.id)
@@ -58,66 +139,38 @@ async def generate_plan(
             detail=f"Профиль пользователя не заполнен. Отсутствуют поля: {', '.join(missing_fields)}"
         )
 
-    # 1. Генерируем план
-    plan_agent = PlanAgent()
-    plan = plan_agent.generate_plan(
-        topic=ref_request.topic,
-        chapters_count=ref_request.chapters_count,
-        language=ref_request.language
-    )
-    plan_list = parse_plan(plan)
-    if not plan_list:
-        requested_chapters = ref_request.chapters_count or 1
-        plan_list = [f"Глава {idx}" for idx in range(1, requested_chapters + 1)]
-    chapters_count = len(plan_list) or 1
-
-    # Определяем страницы для введения, заключения, глав
-    if ref_request.page_count <= 20:
-        pages = 1
-    elif ref_request.page_count <= 40:
-        pages = 2
-    else:
-        pages = 3
-
-    try:
-        pages_priority = distribute_pages_with_priority(
-            total_pages=ref_request.page_count,
-            intro_pages=pages,
-            conclusion_pages=pages,
-            references_pages=1,
-            number_of_chapters=chapters_count
-        )
+    # Очередь: сразу возвращаем essay_id, план генерирует воркер
+    if ref_request.queued:
+        return await _queue_plan(ref_request, profile, current_user, session)
 
-        introduction_chars = chars_to_page(
-            pages_priority.get("introduction", pages)
-        )
-        conclusion_chars = chars_to_page(
-            pages_priority.get("conclusion", pages)
-        )
-        references_chars = chars_to_page(
-            pages_priority.get("references", 1)
+    # 1. Генерируем план (асинхронно, не блокируя event loop)
+    plan_agent = PlanAgent()
+    async with _plan_semaphore():
+        plan = await plan_agent.agenerate_plan(
+            topic=ref_request.topic,
+            chapters_count=ref_request.chapters_count,
+            language=ref_request.language
         )
 
-        chapter_pages = pages_priority.get("chapters", [])
-        if len(chapter_pages) != chapters_count:
-            raise ValueError("Количество распределённых страниц не совпадает с количеством глав.")
-        chapters_chars = [chars_to_page(chapter_page) for chapter_page in chapter_pages]
-
+    try:
+        layout = build_plan_layout(plan, ref_request.page_count, ref_request.chapters_count)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Ошибка при генерации плана: {str(e)}"
         )
+    plan_list = layout["plan_list"]
 
     # 2. Создаём Essay
     essay = Essay(
         topic=ref_request.topic or "Без темы",
         page_count=ref_request.page_count or 20,
         language=ref_request.language or EnumLanguage.RU,
-        chapter_count=chapters_count,
-        introduction_chars_count=introduction_chars.get("chars", 1000),
-        conclusion_chars_count=conclusion_chars.get("chars", 1000),
-        references_chars_count=references_chars.get("chars", 500),
+        chapter_count=len(plan_list),
+        introduction_chars_count=layout["introduction_chars"],
+        conclusion_chars_count=layout["conclusion_chars"],
+        references_chars_count=layout["references_chars"],
+        plan=plan,
         status=EnumStatus.PLAN_GENERATED,
         user_id=current_user.id
     )
@@ -125,77 +178,135 @@ async def generate_plan(
     await session.flush()  # получаем essay.id
 
     # 3. Создаём metadata (1 к 1)
-    essay_metadata = EssayMetadata(
-        essay_id=essay.id,
-        university=profile.university or "Не указано",
-        faculty=profile.faculty or "Не указано",
-        subject=ref_request.subject or "Не указано",
-        course=profile.course or 1,
-        performed_by=f"{profile.surname} {profile.name}",
-        checked_by=ref_request.checked_by or "Не указано",
-        group=profile.group or "Не указано",
-        city=profile.city or "Не указано"
-    )
-    session.add(essay_metadata)
+    session.add(_essay_metadata(essay.id, ref_request, profile))
 
     # 4. Создаём главы (1 ко многим)
-    default_chapter_chars = settings.refagent.chars or 1500
-    if len(plan_list) != len(chapters_chars):
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Количество глав в плане не совпадает с количеством распределённых страниц."
-        )
-
-    for idx, (plan_title, chapter_char_info) in enumerate(zip(plan_list, chapters_chars), start=1):
+    for idx, (plan_title, chapter_chars) in enumerate(zip(plan_list, layout["chapters_chars"]), start=1):
         chapter = Chapter(
             title=plan_title or f"Глава {idx}",
             position=idx,
-            chars=chapter_char_info.get("chars", default_chapter_chars),
+            chars=chapter_chars,
             essay_id=essay.id
         )
         session.add(chapter)
 
-    # 5. Коммитим всё
+    # 5. Введение и литература не зависят от глав — их можно начать сразу
+    dispatch_section_drafts(session, essay.id, essay.page_count, essay.chapter_count)
+
+    # 6. Коммитим всё
     await session.commit()
     await session.refresh(essay)
 
     return {"essay_id": essay.id, "plan": plan}
 
 
+# Статусы, из которых эссе можно (повторно) отправить на генерацию
+DISPATCHABLE_STATUSES = (
+    EnumStatus.PENDING, EnumStatus.PLAN_GENERATED, EnumStatus.COMPLETED, EnumStatus.FAILURE,
+    EnumStatus.ERROR, EnumStatus.CANCELED, EnumStatus.EXPIRED, EnumStatus.FAILED,
+)
+
+
 @router.post("/{essay_id}/generate")
 async def generate_essay_endpoint(
     essay_id: int,
+    response: Response,
+    background_tasks: BackgroundTasks,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key"),
     current_user: User = Depends(get_current_user),
     session: AsyncSession = Depends(get_async_session)
 ):
-    result = await session.execute(
-        select(Essay).where(Essay.id == essay_id, Essay.user_id == current_user.id)
+    # Планировщик выпускает эссе из очереди, если у пользователя есть свободный слот
+    background_tasks.add_task(release_queued_essays)
+    return await idempotent(
+        session, response, current_user.id, idempotency_key, "generate", {"essay_id": essay_id},
+        lambda: _dispatch_essay(essay_id, current_user, session),
     )
-    essay = result.scalars().first()
-    if not essay:
-        raise HTTPException(status_code=404, detail="Essay not found")
 
-    # Проверка на уже запущенные задачи
-    if essay.status in [EnumStatus.GENERATING, EnumStatus.GENERATED, EnumStatus.IN_PROGRESS, EnumStatus.STARTED]:
+
+async def _dispatch_essay(essay_id: int, current_user: User, session: AsyncSession) -> dict:
+    """
+    Ставит эссе в очередь генерации, если его ещё никто не поставил.
+
+    Переход в QUEUED — один условный UPDATE ... WHERE status IN
+    (DISPATCHABLE_STATUSES): из одновременных запросов (двойной клик, две
+    вкладки) строку меняет только один, остальные получают текущее
+    состояние. Задачу generate_essay ставит планировщик
+    release_queued_essays, когда у пользователя освободится слот.
+    """
+    claimed = (await session.execute(
+        update(Essay)
+        .where(Essay.id == essay_id, Essay.user_id == current_user.id,
+               Essay.status.in_(DISPATCHABLE_STATUSES))
+        # Запуск пользователем — первая попытка; дальше считает reaper.
+        # updated_at — время постановки в очередь: по нему планировщик берёт старые первыми
+        .values(status=EnumStatus.QUEUED, attempts=1, updated_at=datetime.now(timezone.utc))
+    )).rowcount
+    if not claimed:
+        await session.rollback()
+        result = await session.execute(
+            select(Essay).where(Essay.id == essay_id, Essay.user_id == current_user.id)
+        )
+        essay = result.scalars().first()
+        if not essay:
+            raise HTTPException(status_code=404, detail="Essay not found")
+        # Уже запущено (или запускается) другим запросом
         return {"essay_id": essay.id, "status": essay.status, "task_id": essay.task_id}
 
-    try:
-        # Запускаем Celery задачу
-        task = generate_essay.delay(essay_id)
-        essay.task_id = task.id
-        essay.status = EnumStatus.GENERATING
+    await anotify_essay(session, essay_id)
+    await session.commit()
+    return {"essay_id": essay_id, "status": EnumStatus.QUEUED, "task_id": None}
 
-        await session.commit()
-        await session.refresh(essay)
-    except Exception as e:
-        await session.rollback()
-        raise HTTPException(status_code=500, detail=f"Ошибка при запуске задачи: {str(e)}")
 
-    return {"essay_id": essay.id, "status": essay.status, "task_id": essay.task_id}
+async def _status_snapshot(session: AsyncSession, essay_id: int) -> tuple:
+    """Статус эссе и разделов; транзакция закрывается, чтобы ожидание не держало соединение."""
+    essay_status = (await session.execute(select(Essay.status).where(Essay.id == essay_id))).scalar_one_or_none()
+    sections = (await session.execute(
+        select(EssaySection.section, EssaySection.status).where(EssaySection.essay_id == essay_id)
+    )).all()
+    await session.rollback()
+    return essay_status, frozenset(map(tuple, sections))
+
+
+async def _section_progress(session: AsyncSession, essay_id: int) -> dict:
+    """Прогресс по разделам одним запросом по индексу (essay_id, section)."""
+    rows = (await session.execute(
+        select(EssaySection).where(EssaySection.essay_id == essay_id).order_by(EssaySection.id)
+    )).scalars().all()
+    return {
+        "total": len(rows),
+        "done": sum(1 for row in rows if row.status == EnumStatus.GENERATED),
+        "sections": [
+            {
+                "section": row.section,
+                "status": row.status,
+                "attempts": row.attempts,
+                "started_at": row.started_at,
+                "finished_at": row.finished_at,
+                "chars": row.chars,
+                "model": row.model,
+            }
+            for row in rows
+        ],
+    }
+
+
+async def _user_queue(session: AsyncSession, user_id: int, limit: int) -> dict:
+    """Сколько эссе пользователя ждёт в очереди и генерируется, и его лимит."""
+    queued, in_flight = (await session.execute(
+        select(
+            func.count(Essay.id).filter(Essay.status == EnumStatus.QUEUED),
+            func.count(Essay.id).filter(Essay.status == EnumStatus.GENERATING),
+        ).where(Essay.user_id == user_id)
+    )).one()
+    return {"queued": queued, "in_flight": in_flight, "limit": limit}
+
 
 @router.get("/{essay_id}/status")
 async def get_essay_status(
     essay_id: int,
+    wait: float = Query(0, ge=0, description="Long-poll: ждать изменения до N секунд"),
+    since: str | None = Query(None, description="Статус, который клиент уже видел"),
     current_user: User = Depends(get_current_user),
     session: AsyncSession = Depends(get_async_session)
 ):
@@ -205,22 +316,122 @@ async def get_essay_status(
     essay = result.scalars().first()
     if not essay:
         raise HTTPException(status_code=404, detail="Essay not found")
+    # До long-poll: ожидание откатывает транзакцию, и объекты сессии истекают
+    user_id, limit = current_user.id, in_flight_limit(current_user.is_superuser)
+
+    # Long-poll: отвечаем сразу, если статус уже не тот, что видел клиент,
+    # иначе ждём NOTIFY от воркера (или таймаута) и отдаём свежее состояние
+    if wait > 0 and (since is None or since == essay.status):
+        initial = await _status_snapshot(session, essay_id)
+        await wait_for_essay_change(
+            essay_id, min(wait, settings.celery.status_max_wait_seconds), initial,
+            lambda: _status_snapshot(session, essay_id),
+        )
+        await session.refresh(essay)
 
-    # Проверка состояния Celery задачи
-    if essay.task_id:
+    # Проверка состояния Celery задачи (у эссе в очереди task_id — от прошлого запуска)
+    if essay.task_id and essay.status == EnumStatus.GENERATING:
         celery_result = AsyncResult(essay.task_id, app=celery_app)
         if celery_result.state == "FAILURE":
             essay.status = EnumStatus.FAILURE
             session.add(essay)
+            await anotify_essay(session, essay.id)
             await session.commit()
             await session.refresh(essay)
 
     return {
         "essay_id": essay.id,
         "status": essay.status,
-        "task_id": essay.task_id
+        "task_id": essay.task_id,
+        "plan": essay.plan,
+        "progress": await _section_progress(session, essay.id),
+        "queue": await _user_queue(session, user_id, limit),
     }
 
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+async def essay_events(session: AsyncSession, essay_id: int, poll_seconds: float):
+    """
+    События SSE по эссе: status — смена статуса, section — смена статуса
+    раздела, delta — новый текст главы (частичный, пока воркер пишет поток).
+    Завершается событием done, когда эссе готово или упало.
+
+    Между опросами транзакция закрывается, чтобы открытый поток не держал
+    соединение с БД. Если доступен LISTEN/NOTIFY, состояние перечитывается
+    по уведомлению воркера, иначе — раз в poll_seconds.
+    """
+    essay_status, sections, contents = None, {}, {}
+    listener = get_essay_listener()
+    listening = listener is not None and await listener.connect()
+    while True:
+        # Подписка до чтения: уведомление между чтением и ожиданием не теряется
+        waiter = listener.subscribe(essay_id) if listening else None
+        current = (await session.execute(select(Essay.status).where(Essay.id == essay_id))).scalar_one_or_none()
+        section_rows = (await session.execute(
+            select(EssaySection.section, EssaySection.status).where(EssaySection.essay_id == essay_id)
+        )).all()
+        chapter_rows = (await session.execute(
+            select(Chapter.id, Chapter.content).where(Chapter.essay_id == essay_id).order_by(Chapter.position)
+        )).all()
+        await session.rollback()
+
+        if current != essay_status:
+            essay_status = current
+            yield _sse("status", {"essay_id": essay_id, "status": current})
+        for section, section_status in section_rows:
+            if sections.get(section) != section_status:
+                sections[section] = section_status
+                yield _sse("section", {"section": section, "status": section_status})
+        for chapter_id, content in chapter_rows:
+            section, previous, content = f"chapter:{chapter_id}", contents.get(chapter_id, ""), content or ""
+            if content == previous:
+                continue
+            contents[chapter_id] = content
+            if content.startswith(previous):
+                yield _sse("delta", {"section": section, "text": content[len(previous):]})
+            else:
+                # Частичный текст заменён окончательным документом
+                yield _sse("delta", {"section": section, "text": content, "reset": True})
+
+        if current is None or current in (EnumStatus.GENERATED, EnumStatus.FAILURE):
+            if waiter is not None:
+                listener.unsubscribe(essay_id, waiter)
+            yield _sse("done", {"essay_id": essay_id, "status": current})
+            return
+        if waiter is None:
+            await asyncio.sleep(poll_seconds)
+            continue
+        # С LISTEN/NOTIFY перечитываем только по уведомлению; таймаут — страховка
+        try:
+            await asyncio.wait_for(waiter, settings.celery.status_max_wait_seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            listener.unsubscribe(essay_id, waiter)
+
+
+@router.get("/{essay_id}/stream")
+async def stream_essay(
+    essay_id: int,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    """Server-Sent Events с прогрессом генерации вместо опроса /status."""
+    result = await session.execute(
+        select(Essay.id).where(Essay.id == essay_id, Essay.user_id == current_user.id)
+    )
+    if result.scalar_one_or_none() is None:
+        raise HTTPException(status_code=404, detail="Essay not found")
+
+    return StreamingResponse(
+        essay_events(session, essay_id, settings.celery.stream_poll_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get("/{essay_id}/chapters")
 async def get_chapters(
     essay_id: int,
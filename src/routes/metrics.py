@@ -0,0 +1,81 @@
+import asyncio
+
+from fastapi import APIRouter, Depends
+
+from src.auth.services import get_current_superuser
+from src.config import settings
+from src.models.users import User
+from src.refagent.cache import get_llm_cache
+from src.refagent.hedging import get_hedger
+from src.refagent.model_routing import get_route_stats, parse_routes
+from src.refagent.providers import get_provider_pool
+from src.refagent.ratelimit import get_rate_limiter
+
+router = APIRouter(prefix="/metrics", tags=["Metrics"])
+
+
+# =========================================================
+# GET /metrics/llm-cache — счётчики кеша ответов LLM
+# =========================================================
+@router.get("/llm-cache")
+async def llm_cache_metrics(
+    current_user: User = Depends(get_current_superuser),
+):
+    cache = get_llm_cache()
+    if cache is None:
+        return {"enabled": False}
+
+    stats = cache.stats()
+    lookups = stats["hits"] + stats["misses"]
+    return {
+        "enabled": True,
+        **stats,
+        "hit_ratio": round(stats["hits"] / lookups, 4) if lookups else 0.0,
+    }
+
+
+# =========================================================
+# GET /metrics/rate-limit — расход общего бюджета OpenAI
+# =========================================================
+@router.get("/rate-limit")
+async def rate_limit_metrics(
+    current_user: User = Depends(get_current_superuser),
+):
+    limiter = get_rate_limiter()
+    if limiter is None:
+        return {"enabled": False}
+
+    return {
+        "enabled": True,
+        "backend": settings.refagent.rate_limit_backend,
+        "buckets": await asyncio.to_thread(limiter.stats),
+    }
+
+
+# =========================================================
+# GET /metrics/model-routes — задержка и стоимость по маршрутам моделей
+# =========================================================
+@router.get("/model-routes")
+async def model_route_metrics(
+    current_user: User = Depends(get_current_superuser),
+):
+    return {
+        "default_model": settings.refagent.model_name,
+        "fallback_model": settings.refagent.model_fallback,
+        "latency_slo_seconds": settings.refagent.model_latency_slo_seconds,
+        "routes": [
+            {"route": route.name, "model": route.model}
+            for route in parse_routes(settings.refagent.model_routes)
+        ],
+        "stats": await asyncio.to_thread(get_route_stats().stats),
+    }
+
+
+# =========================================================
+# GET /metrics/providers — здоровье endpoint пула OpenAI и дублирование вызовов
+# =========================================================
+@router.get("/providers")
+async def provider_metrics(
+    current_user: User = Depends(get_current_superuser),
+):
+    return {"endpoints": get_provider_pool().stats(), "hedging": get_hedger().stats()}
@@ -17,6 +17,8 @@ class RefRequest(BaseModel):
     page_count: int = 20
     chapters_count: int = 6
     language: str = EnumLanguage.RU
+    # True: план генерирует воркер, ответ сразу с essay_id в статусе PLAN_PENDING
+    queued: bool = False
     
     
 class UpdateChapterRequest(BaseModel):
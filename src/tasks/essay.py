@@ -1,76 +1,802 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Callable
+
+import httpx
+import openai
+from celery import chord, group
+from celery.exceptions import ImproperlyConfigured
+from sqlalchemy import func, text, update
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import selectinload
 
 from src.config import settings
-from src.models.essay import EnumStatus, Essay
+from src.models.essay import Chapter, EnumStatus, Essay, EssaySection, SectionDraft
+from src.models.idempotency import IdempotencyKey
+from src.models.users import User
 from src.celery_app import celery_app
 from src.database import SyncSessionLocal
+from src.notifications import notify_essay
+from src.refagent.agents.base import track_models
+from src.refagent.budget import visible_chars
+from src.tasks.outbox import enqueue_task, relay_outbox
+from src.tasks.routing import draft_route, essay_route, fair_release, in_flight_limit
 from src.refagent.agents.introduction_agent import IntroductionAgent
 from src.refagent.agents.conclusion_agent import ConclusionAgent
 from src.refagent.agents.references_agent import ReferencesAgent
 from src.refagent.agents.chapter_agent import ChapterAgent
+from src.refagent.agents.front_matter_agent import FrontMatterAgent
 
 
-@celery_app.task(bind=True)
-def generate_essay(self, essay_id: int):
-    introduction_agent = IntroductionAgent()
-    conclusion_agent = ConclusionAgent()
-    references_agent = ReferencesAgent()
-    chapter_agent = ChapterAgent()
+# Ошибки, после которых имеет смысл повторить генерацию раздела.
+# Детерминированные ошибки (нет главы, ошибка конфигурации) не повторяются.
+TRANSIENT_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    httpx.TimeoutException,
+    httpx.TransportError,
+    OperationalError,
+)
+
+
+@dataclass
+class SectionAgents:
+    introduction: IntroductionAgent = field(default_factory=IntroductionAgent)
+    conclusion: ConclusionAgent = field(default_factory=ConclusionAgent)
+    references: ReferencesAgent = field(default_factory=ReferencesAgent)
+    chapter: ChapterAgent = field(default_factory=ChapterAgent)
+    front_matter: FrontMatterAgent = field(default_factory=FrontMatterAgent)
+
+
+@dataclass
+class SectionJob:
+    """
+    Один вызов LLM и куда записать результат: модель, её id и поле.
+
+    Задание не держит ORM-объектов, поэтому вызов LLM выполняется без
+    открытой сессии и соединения с БД. Составное задание (front_matter:…)
+    возвращает {раздел: текст} и записывает поля эссе всех members.
+    """
+    name: str
+    model: type
+    target_id: int
+    attr: str | None
+    call: Callable[[], str | dict[str, str]]
+    members: tuple[str, ...] = ()
+    models: list[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        if not self.members:
+            self.members = (self.name,)
+
+    def run(self) -> str | dict[str, str]:
+        """Выполняет call(), запоминая модели, которые выбрал маршрутизатор."""
+        with track_models() as models:
+            content = self.call()
+        self.models = models
+        return content
+
+    @property
+    def model_name(self) -> str | None:
+        return ",".join(dict.fromkeys(self.models))[:255] or None
+
+
+def list_sections(essay: Essay) -> list[str]:
+    """
+    Возвращает имена разделов эссе, которые нужно сгенерировать:
+    introduction, conclusion, references и chapter:<id> для каждой главы.
+    """
+    sections = [
+        name for name in ("introduction", "conclusion", "references")
+        if (getattr(essay, f"{name}_chars_count") or 0) > 0
+    ]
+    sections += [
+        f"chapter:{chapter.id}"
+        for chapter in sorted(essay.chapters, key=lambda ch: ch.position)
+        if chapter.chars and chapter.chars > 0
+    ]
+    return sections
+
+
+# Небольшие разделы эссе, которые для коротких эссе пишутся одним вызовом LLM
+FRONT_MATTER_SECTIONS = ("introduction", "conclusion", "references")
+
+
+def section_members(section: str) -> tuple[str, ...]:
+    """Разделы, которые покрывает задание: front_matter:introduction,references → оба."""
+    if section.startswith("front_matter:"):
+        return tuple(section.split(":", 1)[1].split(","))
+    return (section,)
+
+
+def group_front_matter(sections: list[str], page_count: int) -> list[str]:
+    """
+    Для коротких эссе (FRONT_MATTER_MAX_PAGES) заменяет оставшиеся введение,
+    заключение и литературу одним заданием front_matter:<разделы>.
+    """
+    if page_count > settings.refagent.front_matter_max_pages:
+        return sections
+    small = [section for section in sections if section in FRONT_MATTER_SECTIONS]
+    if len(small) < 2:
+        return sections
+    return ["front_matter:" + ",".join(small)] + [s for s in sections if s not in small]
+
+
+def done_sections(db, essay_id: int) -> set[str]:
+    """Разделы, результат которых уже сохранён (чекпоинт в essay_sections)."""
+    rows = db.query(EssaySection.section).filter(
+        EssaySection.essay_id == essay_id,
+        EssaySection.status == EnumStatus.GENERATED,
+    ).all()
+    return {row.section for row in rows}
+
+
+def pending_sections(db, essay: Essay) -> list[str]:
+    """Разделы эссе, которые ещё предстоит сгенерировать."""
+    done = done_sections(db, essay.id)
+    return [section for section in list_sections(essay) if section not in done]
+
+
+def _section_progress(db, essay_id: int, section: str) -> EssaySection:
+    progress = db.query(EssaySection).filter(
+        EssaySection.essay_id == essay_id,
+        EssaySection.section == section,
+    ).first()
+    if progress is None:
+        progress = EssaySection(essay_id=essay_id, section=section,
+                                status=EnumStatus.PENDING, attempts=0)
+        db.add(progress)
+    return progress
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def essay_changed(db, essay_id: int):
+    """
+    Heartbeat и уведомление в текущей транзакции: обновляет essays.updated_at
+    (по нему reaper отличает живую генерацию от зависшей) и ставит NOTIFY.
+    """
+    db.execute(update(Essay).where(Essay.id == essay_id).values(updated_at=_now()))
+    notify_essay(db, essay_id)
+
+
+class EssayHeartbeat:
+    """
+    Пока задача ждёт LLM, раз в ESSAY_HEARTBEAT_SECONDS обновляет
+    essays.updated_at из фонового потока (своя короткая транзакция):
+    длинная глава не должна выглядеть для reaper зависшей.
+    """
+
+    def __init__(self, essay_id: int, interval: float | None = None):
+        self.essay_id = essay_id
+        self.interval = settings.celery.essay_heartbeat_seconds if interval is None else interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{essay_id}", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with SyncSessionLocal() as db:
+                    db.execute(update(Essay).where(Essay.id == self.essay_id).values(updated_at=_now()))
+                    db.commit()
+            except Exception as e:
+                print(f"[ERROR] Heartbeat of essay {self.essay_id} failed: {e}")
+
+
+def queue_section(db, essay_id: int, section: str):
+    """Отмечает раздел поставленным в очередь (PENDING) без отметок времени."""
+    progress = _section_progress(db, essay_id, section)
+    progress.status = EnumStatus.PENDING
+    progress.started_at = progress.finished_at = None
+
+
+def start_section(db, essay_id: int, section: str):
+    """Отмечает попытку генерации раздела."""
+    progress = _section_progress(db, essay_id, section)
+    progress.status = EnumStatus.GENERATING
+    progress.attempts = (progress.attempts or 0) + 1
+    progress.started_at, progress.finished_at = _now(), None
+
+
+def complete_section(db, essay_id: int, section: str, chars: int | None = None, model: str | None = None):
+    """
+    Отмечает раздел готовым. Вызывается до commit вместе с записью
+    текста раздела, поэтому чекпоинт и результат сохраняются атомарно.
+    """
+    progress = _section_progress(db, essay_id, section)
+    progress.status = EnumStatus.GENERATED
+    progress.finished_at = _now()
+    progress.chars, progress.model = chars, model
+
+
+def _fail_running_sections(db, essay_id: int, sections: list[str] | tuple[str, ...] | None = None):
+    query = update(EssaySection).where(
+        EssaySection.essay_id == essay_id, EssaySection.status == EnumStatus.GENERATING,
+    )
+    if sections is not None:
+        query = query.where(EssaySection.section.in_(sections))
+    db.execute(query.values(status=EnumStatus.FAILURE, finished_at=_now()))
+
+
+def fail_sections(essay_id: int, sections: list[str] | tuple[str, ...] | None = None):
+    """
+    Отмечает FAILURE разделы, которые писались (GENERATING), когда задача
+    упала: все разделы эссе или только sections. Своя транзакция.
+    """
+    with SyncSessionLocal() as db:
+        _fail_running_sections(db, essay_id, sections)
+        essay_changed(db, essay_id)
+        db.commit()
+
+
+def begin_section_job(essay_id: int, job: "SectionJob"):
+    """Отмечает разделы задания начатыми в своей короткой транзакции."""
+    with SyncSessionLocal() as db:
+        for name in job.members:
+            start_section(db, essay_id, name)
+        essay_changed(db, essay_id)
+        db.commit()
+
+
+# Разделы, которые зависят только от темы и языка и известны уже после плана
+SPECULATIVE_SECTIONS = ("introduction", "references")
+
+
+def adopt_drafts(db, essay: Essay) -> list[str]:
+    """
+    Переносит в эссе черновики разделов, сгенерированные после плана.
+
+    Черновик принимается, если тема, язык и объём раздела не изменились,
+    иначе отбрасывается. Вызывается до commit: раздел, текст и чекпоинт
+    сохраняются вместе.
+    """
+    adopted = []
+    drafts = db.query(SectionDraft).filter(SectionDraft.essay_id == essay.id).all()
+    for draft in drafts:
+        current = (essay.topic, essay.language, getattr(essay, f"{draft.section}_chars_count"))
+        if (draft.topic, draft.language, draft.chars) == current:
+            setattr(essay, draft.section, draft.content)
+            complete_section(db, essay.id, draft.section, visible_chars(draft.content))
+            adopted.append(draft.section)
+        db.delete(draft)
+    # Сессия без autoflush: чекпоинты должны быть видны pending_sections
+    db.flush()
+    return adopted
+
+
+def dispatch_section_drafts(db, essay_id: int, page_count: int, chapter_count: int):
+    """
+    Ставит спекулятивную генерацию введения и литературы в outbox (если
+    включено). Вызывается до commit транзакции, сохраняющей план.
+    """
+    if not settings.celery.speculative_sections:
+        return
+    route = draft_route(page_count, chapter_count)
+    for section in SPECULATIVE_SECTIONS:
+        enqueue_task(db, generate_section_draft, (essay_id, section), route.options())
+
+
+class SectionStream:
+    """
+    Принимает куски текста главы от агента и пишет накопленный текст
+    в Chapter.content не чаще раза в STREAM_FLUSH_SECONDS (своя короткая
+    транзакция). Окончательный текст потом записывает save_section.
+    """
+
+    def __init__(self, essay_id: int, chapter_id: int, interval: float | None = None,
+                 clock: Callable[[], float] = time.monotonic):
+        self.essay_id = essay_id
+        self.chapter_id = chapter_id
+        self.interval = settings.celery.stream_flush_seconds if interval is None else interval
+        self.clock = clock
+        self.text = ""
+        self.flushed_at = clock()
+
+    def __call__(self, chunk: str):
+        self.text += chunk
+        if self.clock() - self.flushed_at >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.flushed_at = self.clock()
+        with SyncSessionLocal() as db:
+            db.execute(update(Chapter).where(Chapter.id == self.chapter_id).values(content=self.text))
+            essay_changed(db, self.essay_id)
+            db.commit()
+
+
+def build_section_job(essay: Essay, section: str, agents: SectionAgents) -> SectionJob:
+    """
+    Готовит вызов LLM для одного раздела.
+
+    Все значения из ORM-объектов читаются здесь, пока сессия открыта, чтобы
+    сам вызов можно было выполнять в другом потоке и после закрытия сессии.
+    """
+    essay_id = essay.id
+    topic = essay.topic
+    language = essay.language
+
+    if section == "introduction":
+        chars = essay.introduction_chars_count
+        return SectionJob(section, Essay, essay_id, "introduction",
+                          lambda: agents.introduction.write(topic, language, chars))
+    if section == "conclusion":
+        chars = essay.conclusion_chars_count
+        return SectionJob(section, Essay, essay_id, "conclusion",
+                          lambda: agents.conclusion.write(topic, language, chars))
+    if section == "references":
+        chars = essay.references_chars_count
+        return SectionJob(section, Essay, essay_id, "references",
+                          lambda: agents.references.write(topic, language, chars))
+    if section.startswith("front_matter:"):
+        return build_front_matter_job(essay, section, agents)
+
+    chapter_id = int(section.split(":", 1)[1])
+    chapter = next((ch for ch in essay.chapters if ch.id == chapter_id), None)
+    if chapter is None:
+        raise ValueError(f"Chapter {chapter_id} not found in essay {essay_id}")
 
     chars_per_page = settings.refagent.chars or 1500
     full_chars_per_page = settings.refagent.full_chars or 2000
     words_per_page = settings.refagent.words or 300
+    approximate_pages = max(chapter.chars / chars_per_page, 1)
+    kwargs = dict(
+        topic=topic,
+        chapter_title=chapter.title,
+        position=chapter.position,
+        language=language,
+        chars=chapter.chars,
+        full_chars=int(full_chars_per_page * approximate_pages),
+        words=int(words_per_page * approximate_pages),
+    )
+    if settings.celery.stream_sections:
+        return SectionJob(section, Chapter, chapter_id, "content",
+                          lambda: agents.chapter.write_chapter(**kwargs, on_chunk=SectionStream(essay_id, chapter_id)))
+    return SectionJob(section, Chapter, chapter_id, "content",
+                      lambda: agents.chapter.write_chapter(**kwargs))
+
+
+def build_front_matter_job(essay: Essay, section: str, agents: SectionAgents) -> SectionJob:
+    """
+    Один вызов FrontMatterAgent на несколько небольших разделов.
+
+    Разделы, которые модель не вернула или вернула неразборчиво,
+    догенерируются отдельными агентами в рамках того же задания.
+    """
+    members = section_members(section)
+    topic, language = essay.topic, essay.language
+    sizes = {name: getattr(essay, f"{name}_chars_count") for name in members}
+    fallbacks = {name: build_section_job(essay, name, agents) for name in members}
+
+    def call() -> dict[str, str]:
+        parts = agents.front_matter.write(topic, language, sizes)
+        for name in members:
+            if name not in parts:
+                parts[name] = fallbacks[name].call()
+        return {name: parts[name] for name in members}
+
+    return SectionJob(section, Essay, essay.id, None, call, members)
+
+
+def build_section_jobs(essay: Essay, sections: list[str], agents: SectionAgents) -> list[SectionJob]:
+    return [build_section_job(essay, section, agents) for section in sections]
+
+
+def save_section(essay_id: int, job: SectionJob, content: str | dict[str, str]):
+    """Записывает текст раздела (или разделов) и чекпоинты в одной короткой транзакции."""
+    with SyncSessionLocal() as db:
+        target = db.get(job.model, job.target_id)
+        if target is None:
+            raise LookupError(f"{job.model.__name__} {job.target_id} not found")
+        parts = content if isinstance(content, dict) else {job.name: content}
+        for name, text in parts.items():
+            setattr(target, job.attr or name, text)
+            complete_section(db, essay_id, name, visible_chars(text), job.model_name)
+        essay_changed(db, essay_id)
+        db.commit()
+
+
+def run_section_jobs(jobs: list[SectionJob], save: Callable[[SectionJob, str], None],
+                     max_in_flight: int = 1, start: Callable[[SectionJob], None] | None = None):
+    """
+    Выполняет задания и сохраняет каждый раздел через save(job, content)
+    сразу по готовности. start(job), если задан, вызывается перед вызовом LLM.
+
+    При max_in_flight > 1 вызовы LLM идут параллельно в пуле потоков:
+    задание отправляется в пул, когда освобождается место, а start и save
+    (запись в БД) остаются в текущем потоке.
+    """
+    if max_in_flight <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            if start is not None:
+                start(job)
+            save(job, job.run())
+        return
+
+    workers = min(max_in_flight, len(jobs))
+    queued = list(jobs)
+    futures = {}
+    pool = ThreadPoolExecutor(max_workers=workers)
+
+    def submit():
+        job = queued.pop(0)
+        if start is not None:
+            start(job)
+        futures[pool.submit(job.run)] = job
+
+    try:
+        while queued and len(futures) < workers:
+            submit()
+        while futures:
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                save(futures.pop(future), future.result())
+                if queued:
+                    submit()
+    finally:
+        # При ошибке ещё не начатые вызовы LLM не отправляются, чтобы не платить
+        # за разделы, результат которых всё равно будет отброшен.
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _load_essay(db, essay_id: int) -> Essay | None:
+    return db.query(Essay).options(selectinload(Essay.chapters))\
+             .filter(Essay.id == essay_id).first()
+
+
+def _set_status(essay_id: int, status: EnumStatus):
+    with SyncSessionLocal() as db:
+        essay = db.get(Essay, essay_id)
+        if essay:
+            essay.status = status
+            essay_changed(db, essay_id)
+            db.commit()
+    # Эссе завершилось или упало: его слот достаётся следующему в очереди
+    release_queued_essays()
+
+
+def _superseded(essay_id: int, task_id: str | None) -> bool:
+    """
+    Задача устарела: эссе уже указывает на другую задачу (перезапуск reaper
+    или повторный запуск после сбоя), а эта доставлена с опозданием.
+    """
+    if not task_id:
+        return False
+    with SyncSessionLocal() as db:
+        current = db.query(Essay.task_id).filter(Essay.id == essay_id).scalar()
+    return current is not None and current != task_id
+
+
+def _chords_supported() -> bool:
+    try:
+        celery_app.backend.ensure_chords_allowed()
+    except ImproperlyConfigured:
+        return False
+    return True
+
+
+@celery_app.task(bind=True)
+def generate_essay(self, essay_id: int):
+    """
+    Оркестратор: помечает эссе как GENERATING и раздаёт разделы подзадачам
+    generate_section, объединённым chord с колбэком finalize_essay.
+
+    Если разбиение выключено (ESSAY_FAN_OUT) или backend не поддерживает
+    chord, эссе генерируется целиком в этой задаче. Уже готовые разделы
+    (после сбоя или повторного запуска) не генерируются заново.
+    """
+    if _superseded(essay_id, self.request.id):
+        return {"essay_id": essay_id, "status": "SKIPPED", "message": "Superseded by another task"}
+    if not settings.celery.essay_fan_out or not _chords_supported():
+        return generate_essay_inline(essay_id)
 
     with SyncSessionLocal() as db:
         try:
-            essay = db.query(Essay).options(selectinload(Essay.chapters))\
-                      .filter(Essay.id == essay_id).first()
+            essay = _load_essay(db, essay_id)
             if not essay:
                 return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": "Essay not found"}
 
+            adopt_drafts(db, essay)
+            sections = group_front_matter(pending_sections(db, essay), essay.page_count)
+            page_count, chapter_count = essay.page_count, len(essay.chapters)
             essay.status = EnumStatus.GENERATING
+            for section in sections:
+                for name in section_members(section):
+                    queue_section(db, essay_id, name)
+            essay_changed(db, essay_id)
             db.commit()
-            db.refresh(essay)
-
-            # Генерация частей эссе
-            if essay.introduction_chars_count and essay.introduction_chars_count > 0:
-                essay.introduction = introduction_agent.write(
-                    essay.topic, essay.language, essay.introduction_chars_count
-                )
-            if essay.conclusion_chars_count and essay.conclusion_chars_count > 0:
-                essay.conclusion = conclusion_agent.write(
-                    essay.topic, essay.language, essay.conclusion_chars_count
-                )
-            if essay.references_chars_count and essay.references_chars_count > 0:
-                essay.references = references_agent.write(
-                    essay.topic, essay.language, essay.references_chars_count
-                )
-
-            # Генерация глав
-            for chapter in essay.chapters:
-                if chapter.chars and chapter.chars > 0:
-                    approximate_pages = max(chapter.chars / chars_per_page, 1)
-                    chapter_full_chars = int(full_chars_per_page * approximate_pages)
-                    chapter_words = int(words_per_page * approximate_pages)
-                    chapter.content = chapter_agent.write_chapter(
-                        topic=essay.topic,
-                        chapter_title=chapter.title,
-                        position=chapter.position,
-                        language=essay.language,
-                        chars=chapter.chars,
-                        full_chars=chapter_full_chars,
-                        words=chapter_words
-                    )
-
-            # Обновление статуса
-            essay.status = EnumStatus.GENERATED
-            db.commit()
-            db.refresh(essay)
-
-            return {"essay_id": essay.id, "status": essay.status}
-
         except Exception as e:
             db.rollback()
-            # Логирование через logger или self.logger
-            print(f"[ERROR] Failed to generate essay {essay_id}: {e}")
+            print(f"[ERROR] Failed to dispatch essay {essay_id}: {e}")
             return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": str(e)}
+
+    if not sections:
+        return finalize_essay.run(essay_id)
+
+    try:
+        callback = finalize_essay.si(essay_id).on_error(mark_essay_failed.si(essay_id))
+        chord(group(
+            generate_section.s(essay_id, section).set(
+                **essay_route(page_count, chapter_count, section).options()
+            )
+            for section in sections
+        ))(callback)
+    except Exception as e:
+        # Без этого эссе навсегда осталось бы в GENERATING
+        print(f"[ERROR] Failed to dispatch essay {essay_id}: {e}")
+        _set_status(essay_id, EnumStatus.FAILURE)
+        return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": str(e)}
+
+    return {"essay_id": essay_id, "status": EnumStatus.GENERATING, "sections": sections}
+
+
+@celery_app.task(
+    bind=True,
+    autoretry_for=TRANSIENT_ERRORS,
+    retry_backoff=True,
+    max_retries=settings.celery.section_max_retries,
+    # Раздел идемпотентен (чекпоинт), поэтому задачу умершего воркера
+    # можно безопасно доставить повторно.
+    acks_late=True,
+    reject_on_worker_lost=True,
+)
+def generate_section(self, essay_id: int, section: str):
+    """
+    Генерирует один раздел эссе и сразу сохраняет его вместе с чекпоинтом.
+
+    Уже готовый раздел пропускается. Соединение с БД не удерживается на
+    время вызова LLM. Любая ошибка (после исчерпания повторов)
+    пробрасывается: chord падает, и эссе помечает FAILURE его errback
+    mark_essay_failed.
+    """
+    try:
+        with SyncSessionLocal() as db:
+            essay = _load_essay(db, essay_id)
+            if not essay:
+                raise LookupError(f"Essay {essay_id} not found")
+            # Составное задание после частичного сбоя догенерирует только недостающее
+            members = [name for name in section_members(section) if name not in done_sections(db, essay_id)]
+            if not members:
+                return {"essay_id": essay_id, "section": section, "status": EnumStatus.GENERATED}
+            section = members[0] if len(members) == 1 else "front_matter:" + ",".join(members)
+
+            job = build_section_job(essay, section, SectionAgents())
+            for name in job.members:
+                start_section(db, essay_id, name)
+            essay_changed(db, essay_id)
+            db.commit()
+
+        with EssayHeartbeat(essay_id):
+            content = job.run()
+        save_section(essay_id, job, content)
+    except Exception as e:
+        print(f"[ERROR] Failed to generate section {section} of essay {essay_id}: {e}")
+        fail_sections(essay_id, section_members(section))
+        raise
+
+    return {"essay_id": essay_id, "section": section, "status": EnumStatus.GENERATED}
+
+
+@celery_app.task(
+    bind=True,
+    autoretry_for=TRANSIENT_ERRORS,
+    retry_backoff=True,
+    max_retries=settings.celery.section_max_retries,
+)
+def generate_section_draft(self, essay_id: int, section: str):
+    """
+    Спекулятивно генерирует раздел после плана и сохраняет его как черновик.
+
+    Если генерация эссе уже началась, черновик не нужен: задача ничего
+    не делает, а результат, пришедший после готового раздела, отбрасывается.
+    """
+    with SyncSessionLocal() as db:
+        essay = _load_essay(db, essay_id)
+        if not essay or essay.status != EnumStatus.PLAN_GENERATED:
+            return {"essay_id": essay_id, "section": section, "status": "SKIPPED"}
+        job = build_section_job(essay, section, SectionAgents())
+        snapshot = dict(
+            topic=essay.topic,
+            language=essay.language,
+            chars=getattr(essay, f"{section}_chars_count"),
+        )
+
+    content = job.call()
+
+    with SyncSessionLocal() as db:
+        if section in done_sections(db, essay_id):
+            return {"essay_id": essay_id, "section": section, "status": "DISCARDED"}
+        draft = db.query(SectionDraft).filter(
+            SectionDraft.essay_id == essay_id, SectionDraft.section == section
+        ).first() or SectionDraft(essay_id=essay_id, section=section)
+        for key, value in snapshot.items():
+            setattr(draft, key, value)
+        draft.content = content
+        db.add(draft)
+        db.commit()
+
+    return {"essay_id": essay_id, "section": section, "status": EnumStatus.GENERATED}
+
+
+@celery_app.task
+def discard_stale_section_drafts():
+    """Удаляет черновики эссе, которые так и не отправили на генерацию (beat)."""
+    threshold = datetime.now(timezone.utc) - timedelta(hours=settings.celery.section_draft_ttl_hours)
+    with SyncSessionLocal() as db:
+        deleted = db.query(SectionDraft).filter(SectionDraft.created_at < threshold)\
+                    .delete(synchronize_session=False)
+        db.commit()
+    return {"deleted": deleted}
+
+
+@celery_app.task
+def discard_expired_idempotency_keys():
+    """Удаляет ответы на запросы с Idempotency-Key старше IDEMPOTENCY_TTL_HOURS (beat)."""
+    threshold = _now() - timedelta(hours=settings.celery.idempotency_ttl_hours)
+    with SyncSessionLocal() as db:
+        deleted = db.query(IdempotencyKey).filter(IdempotencyKey.created_at < threshold)\
+                    .delete(synchronize_session=False)
+        db.commit()
+    return {"deleted": deleted}
+
+
+@celery_app.task
+def reap_stuck_essays():
+    """
+    Reaper (beat): эссе в GENERATING без heartbeat дольше
+    ESSAY_HEARTBEAT_TIMEOUT_SECONDS — их воркер умер (OOM, перезапуск).
+
+    Такое эссе ставится в очередь заново: generate_essay догенерирует только
+    разделы без чекпоинта. После ESSAY_MAX_ATTEMPTS попыток эссе помечается
+    FAILED, и пользователь может запустить его снова. Эссе выбираются пачками
+    по ESSAY_REAPER_BATCH через FOR UPDATE SKIP LOCKED (индекс
+    (status, updated_at)), поэтому несколько reaper не берут одно эссе.
+    """
+    threshold = _now() - timedelta(seconds=settings.celery.essay_heartbeat_timeout_seconds)
+    batch = settings.celery.essay_reaper_batch
+    requeued, failed = [], []
+    while True:
+        with SyncSessionLocal() as db:
+            essays = db.query(Essay).filter(
+                Essay.status == EnumStatus.GENERATING, Essay.updated_at < threshold,
+            ).order_by(Essay.updated_at).limit(batch).with_for_update(skip_locked=True).all()
+            for essay in essays:
+                if (essay.attempts or 0) >= settings.celery.essay_max_attempts:
+                    essay.status = EnumStatus.FAILED
+                    _fail_running_sections(db, essay.id)
+                    failed.append(essay.id)
+                else:
+                    # Новая задача публикуется через outbox вместе с этим commit
+                    essay.attempts = (essay.attempts or 0) + 1
+                    essay.task_id = enqueue_task(db, generate_essay, (essay.id,),
+                                                 essay_route(essay.page_count, essay.chapter_count).options())
+                    requeued.append(essay.id)
+                essay_changed(db, essay.id)
+            db.commit()
+        if len(essays) < batch:
+            break
+    if failed:
+        release_queued_essays()
+    return {"requeued": requeued, "failed": failed}
+
+
+# Ключ pg_advisory_xact_lock: слоты между процессами раздаёт один планировщик за раз
+SCHEDULER_LOCK_KEY = 0x72656661
+_scheduler_lock = threading.Lock()
+
+
+@celery_app.task
+def release_queued_essays():
+    """
+    Планировщик (beat, API после запуска, воркер после завершения эссе):
+    переводит эссе из QUEUED в GENERATING, пока есть свободные слоты.
+
+    Одновременно генерируется не больше SCHEDULER_MAX_IN_FLIGHT эссе и не
+    больше лимита тарифа на пользователя (USER_MAX_IN_FLIGHT,
+    SUPERUSER_MAX_IN_FLIGHT); слоты раздаются по кругу между пользователями
+    (fair_release). Задача generate_essay попадает в outbox в одной
+    транзакции со сменой статуса и публикуется сразу после commit.
+    """
+    released = []
+    with _scheduler_lock, SyncSessionLocal() as db:
+        if db.get_bind().dialect.name == "postgresql":
+            db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEDULER_LOCK_KEY})
+        running = dict(db.query(Essay.user_id, func.count(Essay.id))
+                         .filter(Essay.status == EnumStatus.GENERATING).group_by(Essay.user_id).all())
+        capacity = settings.celery.scheduler_max_in_flight - sum(running.values())
+        if capacity <= 0:
+            return {"released": released}
+        queued = db.query(Essay.id, Essay.user_id, Essay.page_count, Essay.chapter_count, User.is_superuser)\
+                   .join(User, User.id == Essay.user_id).filter(Essay.status == EnumStatus.QUEUED)\
+                   .order_by(Essay.updated_at, Essay.id).all()
+        limits = {row.user_id: in_flight_limit(row.is_superuser) for row in queued}
+        routes = {row.id: essay_route(row.page_count, row.chapter_count) for row in queued}
+        for essay_id in fair_release([(row.id, row.user_id) for row in queued], running, limits, capacity):
+            # Условный UPDATE: эссе, которое успели перезапустить или удалить, пропускается
+            claimed = db.execute(update(Essay).where(Essay.id == essay_id, Essay.status == EnumStatus.QUEUED)
+                                 .values(status=EnumStatus.GENERATING)).rowcount
+            if not claimed:
+                continue
+            task_id = enqueue_task(db, generate_essay, (essay_id,), routes[essay_id].options())
+            db.execute(update(Essay).where(Essay.id == essay_id).values(task_id=task_id))
+            essay_changed(db, essay_id)
+            released.append(essay_id)
+        db.commit()
+    if released:
+        relay_outbox()
+    return {"released": released}
+
+
+@celery_app.task
+def finalize_essay(essay_id: int):
+    _set_status(essay_id, EnumStatus.GENERATED)
+    return {"essay_id": essay_id, "status": EnumStatus.GENERATED}
+
+
+@celery_app.task
+def mark_essay_failed(essay_id: int):
+    print(f"[ERROR] Failed to generate essay {essay_id}: section task failed")
+    _set_status(essay_id, EnumStatus.FAILURE)
+    return {"essay_id": essay_id, "status": EnumStatus.FAILURE}
+
+
+def generate_essay_inline(essay_id: int):
+    """
+    Генерирует всё эссе в текущей задаче (без chord).
+
+    Эссе читается в короткой сессии, соединение возвращается в пул на время
+    вызовов LLM, а каждый раздел сохраняется своей транзакцией вместе
+    с чекпоинтом — при повторном запуске генерируются только недостающие.
+    """
+    agents = SectionAgents()
+
+    try:
+        with SyncSessionLocal() as db:
+            essay = _load_essay(db, essay_id)
+            if not essay:
+                return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": "Essay not found"}
+
+            # Задания на недостающие части эссе и главы
+            adopt_drafts(db, essay)
+            sections = group_front_matter(pending_sections(db, essay), essay.page_count)
+            jobs = build_section_jobs(essay, sections, agents)
+            essay.status = EnumStatus.GENERATING
+            for job in jobs:
+                for name in job.members:
+                    queue_section(db, essay_id, name)
+            essay_changed(db, essay_id)
+            db.commit()
+
+        max_in_flight = settings.refagent.section_max_in_flight \
+            if settings.refagent.concurrent_generation else 1
+        with EssayHeartbeat(essay_id):
+            run_section_jobs(jobs, lambda job, content: save_section(essay_id, job, content), max_in_flight,
+                             start=lambda job: begin_section_job(essay_id, job))
+
+        # Обновление статуса
+        _set_status(essay_id, EnumStatus.GENERATED)
+        return {"essay_id": essay_id, "status": EnumStatus.GENERATED}
+
+    except Exception as e:
+        # Логирование через logger или self.logger
+        print(f"[ERROR] Failed to generate essay {essay_id}: {e}")
+        # Готовые разделы уже сохранены; повторный запуск догенерирует остальные
+        fail_sections(essay_id)
+        _set_status(essay_id, EnumStatus.FAILURE)
+        return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": str(e)}
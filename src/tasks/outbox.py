@@ -0,0 +1,70 @@
+import json
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from src.celery_app import celery_app
+from src.config import settings
+from src.database import SyncSessionLocal
+from src.models.outbox import TaskOutbox
+
+
+# Relay одного процесса (фоновые задачи API) работают по очереди;
+# между процессами строки делит FOR UPDATE SKIP LOCKED
+_relay_lock = threading.Lock()
+
+
+def enqueue_task(db, task, args: tuple | list, options: dict) -> str:
+    """
+    Добавляет задачу в outbox в текущей транзакции (Session или AsyncSession)
+    и возвращает её task_id. Опубликует задачу relay_outbox после commit;
+    если транзакция откатится, задачи не будет.
+    """
+    task_id = str(uuid.uuid4())
+    db.add(TaskOutbox(
+        task_name=task.name,
+        task_id=task_id,
+        args=json.dumps(list(args)),
+        options=json.dumps(options),
+    ))
+    return task_id
+
+
+@celery_app.task
+def relay_outbox():
+    """
+    Публикует задачи из outbox пачками по OUTBOX_BATCH (beat и API после ответа).
+
+    Строки выбираются FOR UPDATE SKIP LOCKED, поэтому несколько relay не
+    публикуют одну задачу дважды. С confirm_publish публикация считается
+    успешной только после подтверждения брокера; при ошибке строка остаётся
+    в outbox до следующего прохода. Доставка — at least once: задача с тем же
+    task_id может прийти повторно, если relay упал между публикацией и commit.
+    """
+    with _relay_lock:
+        return _relay_batches(settings.celery.outbox_batch)
+
+
+def _relay_batches(batch: int) -> dict:
+    published, failed = 0, 0
+    while True:
+        with SyncSessionLocal() as db:
+            messages = db.query(TaskOutbox).filter(TaskOutbox.published_at.is_(None))\
+                         .order_by(TaskOutbox.id).limit(batch).with_for_update(skip_locked=True).all()
+            for message in messages:
+                try:
+                    celery_app.tasks[message.task_name].apply_async(
+                        args=json.loads(message.args), task_id=message.task_id, **json.loads(message.options)
+                    )
+                except Exception as e:
+                    # Брокер недоступен: остальное — в следующий проход
+                    message.attempts = (message.attempts or 0) + 1
+                    message.last_error = str(e)
+                    failed += 1
+                    print(f"[ERROR] Failed to publish task {message.task_id} ({message.task_name}): {e}")
+                    break
+                message.published_at = datetime.now(timezone.utc)
+                published += 1
+            db.commit()
+        if failed or len(messages) < batch:
+            return {"published": published, "failed": failed}
@@ -0,0 +1,68 @@
+from sqlalchemy.orm import selectinload
+
+from src.models.essay import Chapter, EnumStatus, Essay
+from src.celery_app import celery_app
+from src.database import SyncSessionLocal
+from src.notifications import notify_essay
+from src.refagent.agents.plan_agent import PlanAgent
+from src.refagent.utils import build_plan_layout
+from src.tasks.essay import dispatch_section_drafts
+
+
+@celery_app.task(bind=True)
+def generate_plan_task(self, essay_id: int, chapters_count: int | None = None):
+    """
+    Генерирует план для эссе, созданного в статусе PLAN_PENDING:
+    вызывает PlanAgent, распределяет страницы и создаёт главы.
+    """
+    with SyncSessionLocal() as db:
+        essay = db.query(Essay).options(selectinload(Essay.chapters))\
+                  .filter(Essay.id == essay_id).first()
+        if not essay:
+            return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": "Essay not found"}
+        if essay.status != EnumStatus.PLAN_PENDING:
+            return {"essay_id": essay.id, "status": essay.status}
+
+        topic, language, page_count = essay.topic, essay.language, essay.page_count
+
+    try:
+        plan = PlanAgent().generate_plan(
+            topic=topic,
+            chapters_count=chapters_count or 1,
+            language=language
+        )
+        layout = build_plan_layout(plan, page_count, chapters_count)
+    except Exception as e:
+        print(f"[ERROR] Failed to generate plan for essay {essay_id}: {e}")
+        with SyncSessionLocal() as db:
+            essay = db.get(Essay, essay_id)
+            if essay:
+                essay.status = EnumStatus.FAILURE
+                notify_essay(db, essay_id)
+                db.commit()
+        return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": str(e)}
+
+    with SyncSessionLocal() as db:
+        essay = db.get(Essay, essay_id)
+        if not essay:
+            return {"essay_id": essay_id, "status": EnumStatus.FAILURE, "message": "Essay not found"}
+
+        plan_list = layout["plan_list"]
+        essay.plan = plan
+        essay.chapter_count = len(plan_list)
+        essay.introduction_chars_count = layout["introduction_chars"]
+        essay.conclusion_chars_count = layout["conclusion_chars"]
+        essay.references_chars_count = layout["references_chars"]
+        for idx, (plan_title, chapter_chars) in enumerate(zip(plan_list, layout["chapters_chars"]), start=1):
+            db.add(Chapter(
+                title=plan_title or f"Глава {idx}",
+                position=idx,
+                chars=chapter_chars,
+                essay_id=essay.id
+            ))
+        essay.status = EnumStatus.PLAN_GENERATED
+        dispatch_section_drafts(db, essay_id, essay.page_count, essay.chapter_count)
+        notify_essay(db, essay_id)
+        db.commit()
+
+    return {"essay_id": essay_id, "status": EnumStatus.PLAN_GENERATED}
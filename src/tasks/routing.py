@@ -0,0 +1,102 @@
+from collections import deque
+from dataclasses import dataclass
+
+from kombu import Exchange, Queue
+
+from src.config import settings
+
+
+# Приоритеты RabbitMQ: чем больше, тем раньше задача уходит воркеру
+PRIORITY_MAX = 9
+# Сколько условных единиц стоимости (страниц + глав) снижают приоритет на 1
+COST_PER_PRIORITY_STEP = 10
+
+
+@dataclass(frozen=True)
+class Route:
+    """Очередь и приоритет, с которыми публикуется задача."""
+    queue: str
+    priority: int
+
+    def options(self) -> dict:
+        return {"queue": self.queue, "priority": self.priority}
+
+
+def essay_cost(page_count: int | None, chapter_count: int | None = 0) -> int:
+    """Оценка стоимости эссе: страницы плюс по единице на вызов LLM для главы."""
+    return (page_count or 0) + (chapter_count or 0)
+
+
+def is_short(page_count: int | None) -> bool:
+    return (page_count or 0) <= settings.celery.short_max_pages
+
+
+def plan_route() -> Route:
+    """План — один вызов LLM, пользователь ждёт ответа: короткая очередь, высший приоритет."""
+    return Route(settings.celery.short_queue, PRIORITY_MAX)
+
+
+def essay_route(page_count: int | None, chapter_count: int | None = 0,
+                section: str | None = None) -> Route:
+    """
+    Маршрут для задачи генерации эссе или его раздела.
+
+    Маленькие эссе (до CELERY_SHORT_MAX_PAGES страниц) идут в короткую
+    очередь, остальные — в длинную. Внутри очереди дешёвые задачи получают
+    более высокий приоритет; введение, заключение и список литературы
+    короче глав и идут на ступень выше.
+    """
+    queue = settings.celery.short_queue if is_short(page_count) else settings.celery.long_queue
+    priority = PRIORITY_MAX - 1 - essay_cost(page_count, chapter_count) // COST_PER_PRIORITY_STEP
+    if section is not None and not section.startswith("chapter:"):
+        priority += 1
+    return Route(queue, min(max(priority, 1), PRIORITY_MAX - 1))
+
+
+def draft_route(page_count: int | None, chapter_count: int | None = 0) -> Route:
+    """Спекулятивные черновики — в очереди эссе, но после любой обязательной работы."""
+    return Route(essay_route(page_count, chapter_count).queue, 0)
+
+
+def in_flight_limit(is_superuser: bool) -> int:
+    """Сколько эссе пользователь может генерировать одновременно (по тарифу)."""
+    return settings.celery.superuser_max_in_flight if is_superuser else settings.celery.user_max_in_flight
+
+
+def fair_release(queued: list[tuple[int, int]], running: dict[int, int],
+                 limits: dict[int, int], capacity: int) -> list[int]:
+    """
+    Какие эссе из очереди запустить: по кругу между пользователями.
+
+    queued — пары (эссе, пользователь) от старых к новым; running — сколько
+    эссе пользователя уже генерируется; limits — его лимит. За круг каждый
+    пользователь со свободным слотом получает одно эссе, начиная с того,
+    чьё эссе ждёт дольше всех, пока не кончится общая ёмкость capacity.
+    Поэтому один пользователь с сотней эссе не задерживает остальных.
+    """
+    waiting: dict[int, deque] = {}
+    for essay_id, user_id in queued:
+        waiting.setdefault(user_id, deque()).append(essay_id)
+    running = dict(running)
+    released = []
+    while capacity > 0 and waiting:
+        for user_id in list(waiting):
+            if capacity == 0:
+                break
+            if running.get(user_id, 0) >= limits[user_id]:
+                del waiting[user_id]
+                continue
+            released.append(waiting[user_id].popleft())
+            running[user_id] = running.get(user_id, 0) + 1
+            capacity -= 1
+            if not waiting[user_id]:
+                del waiting[user_id]
+    return released
+
+
+def task_queues() -> list[Queue]:
+    exchange = Exchange("refagent", type="direct")
+    return [
+        Queue(name, exchange, routing_key=name, queue_arguments={"x-max-priority": PRIORITY_MAX})
+        for name in (settings.celery.short_queue, settings.celery.long_queue)
+    ]
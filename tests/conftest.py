@@ -1,15 +1,21 @@
+import json
+import threading
+import time
 import uuid
 
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 from httpx import ASGITransport, AsyncClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.pool import StaticPool
 
 from src.auth.services import get_current_user, get_current_user_refresh
 from src.auth.utils import hash_password
+from src.config import settings
 from src.database import get_async_session
 from src.db_base import Base
 from src.main import app
@@ -26,6 +32,14 @@ engine = create_engine(
 SessionFactory = sessionmaker(bind=engine, expire_on_commit=False, autoflush=False)
 
 
+@event.listens_for(engine, "connect")
+def _register_sqlite_functions(dbapi_connection, connection_record):
+    # server_default=NOW() в db_base: в SQLite такой функции нет
+    dbapi_connection.create_function(
+        "NOW", 0, lambda: datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+    )
+
+
 class AsyncSessionStub:
     def __init__(self, sync_session: Session):
         self._session = sync_session
@@ -72,6 +86,88 @@ def anyio_backend() -> str:
     return "asyncio"
 
 
+class _StubProvider:
+    """Локальный OpenAI-совместимый сервер: задержка и код ответа задаются в тесте."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latency = 0.0
+        self.status = 200
+        self.calls = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.calls += 1
+                time.sleep(stub.latency)
+                if stub.status != 200:
+                    body = {"error": {"message": "boom", "type": "server_error"}}
+                else:
+                    body = {
+                        "id": "chatcmpl-1", "object": "chat.completion", "created": 0, "model": "stub",
+                        "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                            "role": "assistant", "content": f"<document><content><p>{stub.name}</p></content></document>",
+                        }}],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+                    }
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(stub.status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                try:
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    # Клиент отменил запрос (проигравший дубль)
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/v1"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_providers(monkeypatch):
+    """Два локальных endpoint (alpha, beta) в пуле OPENAI_ENDPOINTS с равными весами."""
+    from src.refagent import providers
+
+    servers = {name: _StubProvider(name) for name in ("alpha", "beta")}
+    monkeypatch.setattr(settings.refagent, "openai_endpoints", ";".join(
+        f"{name}|{server.base_url}|key|1" for name, server in servers.items()
+    ))
+    monkeypatch.setattr(providers, "_pools", {})
+    yield servers
+    for server in servers.values():
+        server.close()
+
+
+@pytest.fixture(autouse=True)
+def model_route_stats(tmp_path, monkeypatch):
+    """Статистика маршрутов моделей пишется во временный файл, а не в cache/ проекта."""
+    from src.refagent import model_routing
+
+    monkeypatch.setattr(settings.refagent, "model_stats_path", tmp_path / "model_routes.sqlite3")
+    monkeypatch.setattr(model_routing, "_route_stats", {})
+
+
+@pytest.fixture(autouse=True)
+def no_status_listener(monkeypatch):
+    """В тестах нет Postgres: ожидание изменений эссе идёт опросом БД."""
+    monkeypatch.setattr(settings.celery, "status_listen", False)
+
+
 @pytest.fixture
 async def db_session():
     Base.metadata.drop_all(bind=engine)
@@ -84,6 +180,25 @@ async def db_session():
         await async_session.close()
 
 
+@pytest.fixture
+def sync_session_factory(db_session):
+    return SessionFactory
+
+
+@pytest.fixture
+def pooled_engine(tmp_path):
+    """Файловая SQLite с обычным QueuePool: можно считать выданные соединения."""
+    pooled = create_engine(
+        f"sqlite+pysqlite:///{tmp_path / 'pooled.sqlite3'}",
+        connect_args={"check_same_thread": False},
+        future=True,
+    )
+    event.listen(pooled, "connect", _register_sqlite_functions)
+    Base.metadata.create_all(pooled)
+    yield pooled
+    pooled.dispose()
+
+
 @pytest.fixture
 async def client(db_session) -> AsyncClient: # type: ignore
     async def _get_session():
@@ -147,7 +262,6 @@ def user_factory(db_session):
                 "group": "A1",
                 "city": "Moscow",
                 "phone_number": "1234567890",
-                "avatar_url": None,
             }
             if profile_overrides:
                 defaults.update(profile_overrides)
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_openai import ChatOpenAI
+
+from src.config import settings
+from src.refagent.agents.base import aclose_agents
+from src.refagent.agents.chapter_agent import ChapterAgent
+from src.refagent.agents.conclusion_agent import ConclusionAgent
+from src.refagent.agents.front_matter_agent import FrontMatterAgent
+from src.refagent.agents.introduction_agent import IntroductionAgent
+from src.refagent.agents.plan_agent import PlanAgent
+from src.refagent.agents.references_agent import ReferencesAgent
+from src.refagent.http import get_async_http_client, get_http_client
+from src.refagent.validation import parse_document
+
+
+def test_agents_share_model_and_http_pool():
+    introduction = IntroductionAgent()
+    chapter = ChapterAgent()
+    references = ReferencesAgent()
+
+    assert introduction.model is chapter.model
+    assert introduction.model is IntroductionAgent().model
+    for agent in (introduction, chapter, references):
+        assert agent.model.http_client is get_http_client()
+
+
+@pytest.mark.anyio
+async def test_async_agents_share_loop_http_pool():
+    introduction = IntroductionAgent()
+    plan = PlanAgent()
+
+    assert introduction.model is plan.model
+    assert introduction.model.http_async_client is get_async_http_client()
+    assert introduction.model.http_client is get_http_client()
+
+
+def test_async_client_is_not_reused_across_event_loops():
+    async def _client():
+        return PlanAgent().model.http_async_client
+
+    first = asyncio.run(_client())
+    second = asyncio.run(_client())
+
+    assert first is not second
+
+
+@pytest.mark.anyio
+async def test_agents_get_fresh_clients_after_shutdown():
+    old_model = PlanAgent().model
+
+    await aclose_agents()
+    model = PlanAgent().model
+
+    assert old_model.http_async_client.is_closed
+    assert model is not old_model
+    assert not model.http_client.is_closed
+    assert not model.http_async_client.is_closed
+
+
+@pytest.mark.anyio
+async def test_async_api_uses_ainvoke(monkeypatch):
+    prompts = []
+
+    async def _ainvoke(self, prompt, *args, **kwargs):
+        prompts.append(prompt)
+        return AIMessage(content="<document><content><p>ok</p></content></document>")
+
+    def _invoke(self, prompt, *args, **kwargs):
+        raise AssertionError("sync invoke must not be called from the async API")
+
+    monkeypatch.setattr(ChatOpenAI, "ainvoke", _ainvoke)
+    # Короткий ответ заглушки не должен запускать продолжение текста
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    assert "ok" in await IntroductionAgent().awrite("Тема", "ru", 1500)
+    assert "ok" in await ConclusionAgent().awrite("Тема", "ru", 1500)
+    assert "ok" in await ReferencesAgent().awrite("Тема", "ru", 5)
+    assert "ok" in await ChapterAgent().awrite_chapter("Тема", "Глава 1", 1, "ru")
+    assert "ok" in await PlanAgent().agenerate_plan("Тема", "ru", 3)
+    assert len(prompts) == 5
+    assert 'Глава: "Глава 1"' in prompts[3]
+
+
+def test_front_matter_agent_splits_combined_answer(monkeypatch):
+    answer = """
+    <sections>
+        <introduction><document><content><p>Введение</p></content><formulas></formulas></document></introduction>
+        <references><document><content><ol><li>Иванов И. И.</li></ol></content></document></references>
+        <conclusion><document><content></content></document></conclusion>
+    </sections>
+    """
+    prompts = []
+
+    def _invoke(self, prompt, *args, **kwargs):
+        prompts.append(prompt)
+        return AIMessage(content=answer)
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    parts = FrontMatterAgent().write("Тема", "ru", {"introduction": 1500, "conclusion": 1500, "references": 2500})
+
+    # Пустое заключение не принимается: его догенерирует ConclusionAgent
+    assert sorted(parts) == ["introduction", "references"]
+    assert parts["introduction"].startswith("<document>") and "<formulas" in parts["introduction"]
+    assert "Иванов" in parts["references"]
+    assert len(prompts) == 1 and "из 10 реальных" in prompts[0]
+
+
+def test_long_chapter_is_written_as_parallel_parts(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "chars", 1500)
+    monkeypatch.setattr(settings.refagent, "chapter_part_max_pages", 5)
+    monkeypatch.setattr(settings.refagent, "section_max_in_flight", 4)
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+    state = {"in_flight": 0, "max_in_flight": 0, "prompts": []}
+    lock = threading.Lock()
+
+    def _invoke(self, prompt, *args, **kwargs):
+        with lock:
+            state["prompts"].append(prompt)
+        if "составляет план главы" in prompt:
+            return AIMessage(content="<ul><li>Основы</li><li>Методы</li><li>Практика</li></ul>")
+        with lock:
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        time.sleep(0.1)
+        with lock:
+            state["in_flight"] -= 1
+        title = prompt.split("Напиши только подраздел ", 1)[1].split(":", 1)[0]
+        return AIMessage(content=(
+            f'<document><content><h3>{title}</h3><p>текст <formula id="f1"/></p></content>'
+            f'<formulas><latex id="f1">x_{title}</latex></formulas></document>'
+        ))
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    text = ChapterAgent().write_chapter("Тема", "Глава 1", 1, "ru", chars=15 * 1500, full_chars=15 * 2000)
+
+    assert len(state["prompts"]) == 4
+    assert state["max_in_flight"] == 3
+    root = parse_document(text)
+    assert [h3.text for h3 in root.iter("h3")] == ["1", "2", "3"]
+    assert [latex.get("id") for latex in root.find("formulas")] == ["f1", "f2", "f3"]
+    assert [ref.get("id") for ref in root.find("content").iter("formula")] == ["f1", "f2", "f3"]
+    assert "Основы" in state["prompts"][1]
+
+
+def test_short_chapter_is_written_in_one_call(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "chapter_part_max_pages", 5)
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+    prompts = []
+
+    def _invoke(self, prompt, *args, **kwargs):
+        prompts.append(prompt)
+        return AIMessage(content="<document><content><p>ok</p></content><formulas/></document>")
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    assert "ok" in ChapterAgent().write_chapter("Тема", "Глава 1", 1, "ru", chars=4500, full_chars=6000)
+    assert len(prompts) == 1
+    assert ChapterAgent.parse_outline("<ul><li>Одна</li></ul>", 2) == ["Часть 1", "Часть 2"]
+
+
+def test_chapter_streams_chunks_and_validates_result(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+
+    def _stream(self, prompt, *args, **kwargs):
+        yield AIMessageChunk(content="<document><content><p>Пер")
+        yield AIMessageChunk(content="вый абзац</p></content>")
+
+    monkeypatch.setattr(ChatOpenAI, "stream", _stream)
+    chunks = []
+
+    text = ChapterAgent().write_chapter("Тема", "Глава 1", 1, "ru", chars=1500, on_chunk=chunks.append)
+
+    assert "".join(chunks) == "<document><content><p>Первый абзац</p></content>"
+    root = parse_document(text)
+    assert root.find("content/p").text == "Первый абзац" and root.find("formulas") is not None
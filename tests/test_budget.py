@@ -0,0 +1,90 @@
+import xml.etree.ElementTree as ET
+
+import pytest
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_openai import ChatOpenAI
+
+import src.refagent.budget as budget_module
+from src.config import settings
+from src.models.essay import EnumLanguage
+from src.refagent.agents.chapter_agent import ChapterAgent
+from src.refagent.budget import MIN_CALIBRATION_TOKENS, close_document, token_budget
+
+
+@pytest.fixture(autouse=True)
+def calibration_path(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings.refagent, "token_calibration_path", tmp_path / "calibration.sqlite3")
+    monkeypatch.setattr(budget_module, "_calibrations", {})
+
+
+def test_budget_depends_on_language_and_margin(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "token_budget_margin", 0.25)
+    ru = token_budget(EnumLanguage.RU, 1500)
+    en = token_budget("en", 1500)
+
+    assert ru.language == "ru"
+    assert ru.target_chars == 2000
+    assert ru.max_chars == 2500
+    assert ru.max_tokens > en.max_tokens
+
+
+def test_budget_is_calibrated_from_past_generations():
+    before = token_budget("kg", 3000)
+    ru_before = token_budget("ru", 3000)
+
+    budget_module.get_calibration().record("kg", chars=MIN_CALIBRATION_TOKENS * 4, tokens=MIN_CALIBRATION_TOKENS)
+
+    after = token_budget("kg", 3000)
+    assert after.max_tokens < before.max_tokens
+    assert token_budget("ru", 3000) == ru_before
+
+
+def test_agent_call_is_bounded_and_feeds_calibration(monkeypatch):
+    calls = []
+
+    def _invoke(self, prompt, *args, **kwargs):
+        calls.append(kwargs)
+        return AIMessage(
+            content="<document><content><p>" + "т" * 400 + "</p></content></document>",
+            usage_metadata={"input_tokens": 100, "output_tokens": 150, "total_tokens": 250},
+        )
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+    # Короткий ответ заглушки не должен запускать продолжение текста
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+
+    ChapterAgent().write_chapter("Тема", "Глава 1", 1, "ru", chars=3000, full_chars=4000)
+
+    assert calls[0]["max_tokens"] == token_budget("ru", 3000, 4000).max_tokens
+    calibration = budget_module.get_calibration()
+    with calibration._connect() as conn:
+        assert conn.execute("SELECT tokens FROM token_calibration WHERE language = 'ru'").fetchone() == (150,)
+
+
+def test_streaming_stops_at_budget_and_closes_document(monkeypatch):
+    consumed = []
+
+    def _stream(self, prompt, *args, **kwargs):
+        yield AIMessageChunk(content="<document><content>")
+        for idx in range(1000):
+            consumed.append(idx)
+            yield AIMessageChunk(content=f"<p>{'слово ' * 20}</p>")
+        yield AIMessageChunk(content="</content><formulas></formulas></document>")
+
+    monkeypatch.setattr(ChatOpenAI, "stream", _stream)
+    budget = token_budget("ru", 1500)
+    chunks = []
+
+    text = ChapterAgent().invoke_streaming("prompt", budget, on_chunk=chunks.append)
+
+    assert len(consumed) < 30
+    assert len(chunks) == len(consumed) + 1
+    root = ET.fromstring(text)
+    assert root.find("content") is not None and root.find("formulas") is not None
+
+
+def test_close_document_drops_unfinished_paragraph():
+    text = close_document("<document><content><p>Готово.</p><p>Обор")
+
+    assert "Обор" not in text
+    assert ET.fromstring(text).find("content/p").text == "Готово."
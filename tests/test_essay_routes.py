@@ -1,28 +1,50 @@
+import asyncio
+import time
 from types import SimpleNamespace
 
+import anyio
 import pytest
 from sqlalchemy import select
 
 import src.routes.essay as essay_routes
-from src.models.essay import Chapter, EnumStatus, Essay
+import src.tasks.essay as essay_tasks
+import src.tasks.outbox as outbox_tasks
+from src.config import settings
+from src.models.essay import Chapter, EnumStatus, Essay, EssaySection
+from src.models.outbox import TaskOutbox
 from src.refagent.utils import chars_to_page, distribute_pages_with_priority
 
 
+def _plan_xml(chapters_count: int) -> str:
+    items = "".join(f"<li><h2>Глава {idx}</h2></li>" for idx in range(1, chapters_count + 1))
+    return f"<document><content><ul>{items}</ul></content></document>"
+
+
+@pytest.fixture(autouse=True)
+def outbox_session(monkeypatch, sync_session_factory):
+    """Планировщик и relay_outbox, которые маршруты запускают после ответа, пишут в тестовую БД."""
+    monkeypatch.setattr(outbox_tasks, "SyncSessionLocal", sync_session_factory)
+    monkeypatch.setattr(essay_tasks, "SyncSessionLocal", sync_session_factory)
+
+
 @pytest.fixture
 def stub_plan_agent(monkeypatch):
-    def _generate(self, topic, chapters_count, language):
-        items = "".join(f"<li><h2>Глава {idx}</h2></li>" for idx in range(1, chapters_count + 1))
-        return f"<document><content><ul>{items}</ul></content></document>"
+    async def _agenerate(self, topic, chapters_count, language):
+        return _plan_xml(chapters_count)
 
-    monkeypatch.setattr("src.refagent.agents.plan_agent.PlanAgent.generate_plan", _generate)
+    monkeypatch.setattr("src.refagent.agents.plan_agent.PlanAgent.agenerate_plan", _agenerate)
 
 
 @pytest.fixture
 def stub_celery_delay(monkeypatch):
-    def fake_delay(essay_id: int):
-        return SimpleNamespace(id=f"task-{essay_id}")
+    published = []
+
+    def fake_apply_async(args, **options):
+        published.append((args, options))
+        return SimpleNamespace(id=f"task-{args[0]}")
 
-    monkeypatch.setattr(essay_routes.generate_essay, "delay", fake_delay)
+    monkeypatch.setattr(essay_tasks.generate_essay, "apply_async", fake_apply_async)
+    return published
 
 
 @pytest.mark.anyio
@@ -99,10 +121,16 @@ async def test_generate_essay_endpoint_updates_status(
 
     generate_response = await client.post(f"/api/v1/essays/{essay_id}/generate")
     assert generate_response.status_code == 200
-    assert generate_response.json()["task_id"] == f"task-{essay_id}"
+    assert generate_response.json()["status"] == EnumStatus.QUEUED
 
+    # После ответа планировщик выпускает эссе, relay_outbox публикует задачу с заранее выданным id
     essay = await db_session.get(Essay, essay_id)
+    task_id = essay.task_id
     assert essay.status == EnumStatus.GENERATING
+    assert stub_celery_delay == [([essay_id], {"task_id": task_id, "queue": settings.celery.long_queue,
+                                               "priority": stub_celery_delay[0][1]["priority"]})]
+    message = (await db_session.execute(select(TaskOutbox).where(TaskOutbox.task_id == task_id))).scalars().one()
+    assert message.published_at is not None
 
 
 @pytest.mark.anyio
@@ -133,6 +161,344 @@ async def test_status_endpoint_returns_current_state(
     essay.status = EnumStatus.GENERATED
     await db_session.commit()
 
+    db_session.add(EssaySection(essay_id=essay_id, section="introduction", status=EnumStatus.GENERATED,
+                                attempts=1, chars=1480, model="gpt-4o-mini"))
+    db_session.add(EssaySection(essay_id=essay_id, section="conclusion", status=EnumStatus.GENERATING, attempts=2))
+    await db_session.commit()
+
     status_response = await client.get(f"/api/v1/essays/{essay_id}/status")
     assert status_response.status_code == 200
     assert status_response.json()["status"] == EnumStatus.GENERATED
+    progress = status_response.json()["progress"]
+    assert (progress["done"], progress["total"]) == (1, 2)
+    assert progress["sections"][0] | {"started_at": None, "finished_at": None} == {
+        "section": "introduction", "status": "GENERATED", "attempts": 1,
+        "started_at": None, "finished_at": None, "chars": 1480, "model": "gpt-4o-mini",
+    }
+    assert progress["sections"][1]["status"] == "GENERATING"
+    assert status_response.json()["queue"] == {
+        "queued": 0, "in_flight": 0, "limit": settings.celery.user_max_in_flight,
+    }
+
+
+@pytest.mark.anyio
+async def test_other_endpoints_stay_responsive_during_plan_generation(
+    client,
+    user_factory,
+    auth_override,
+    db_session,
+    monkeypatch,
+):
+    plan_delay = 0.5
+    in_flight = {"current": 0, "max": 0}
+
+    async def _slow_agenerate(self, topic, chapters_count, language):
+        in_flight["current"] += 1
+        in_flight["max"] = max(in_flight["max"], in_flight["current"])
+        await asyncio.sleep(plan_delay)
+        in_flight["current"] -= 1
+        return _plan_xml(chapters_count)
+
+    monkeypatch.setattr("src.refagent.agents.plan_agent.PlanAgent.agenerate_plan", _slow_agenerate)
+    monkeypatch.setattr(settings.refagent, "plan_max_concurrency", 10)
+    # В тестовой БД одно соединение на всех: relay из потоков мешал бы запросам
+    monkeypatch.setattr(essay_routes, "relay_outbox", lambda: None)
+
+    user = await user_factory()
+    auth_override(user)
+    essay = Essay(
+        topic="Пробный",
+        page_count=20,
+        status=EnumStatus.PLAN_GENERATED,
+        chapter_count=2,
+        introduction_chars_count=1500,
+        conclusion_chars_count=1500,
+        references_chars_count=1500,
+        user_id=user.id,
+    )
+    db_session.add(essay)
+    await db_session.commit()
+
+    payload = {
+        "topic": "Нагрузка",
+        "checked_by": "Преподаватель",
+        "subject": "Информатика",
+        "page_count": 20,
+        "chapters_count": 3,
+        "language": "ru",
+    }
+    plan_requests = [
+        asyncio.create_task(client.post("/api/v1/essays/plan/generate", json=payload))
+        for _ in range(50)
+    ]
+    await asyncio.sleep(0.05)
+
+    # Каждый замер — отдельная задача: если генерация плана блокирует event
+    # loop, задача зонда ждёт своей очереди и это попадает в латентность.
+    latencies = []
+    with anyio.fail_after(30):
+        while not all(task.done() for task in plan_requests):
+            started = time.perf_counter()
+            probe = asyncio.create_task(client.get(f"/api/v1/essays/{essay.id}/status"))
+            response = await probe
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200
+            # Stub-сессия не уступает управление, поэтому отдаём его явно
+            await asyncio.sleep(0.01)
+
+        plan_responses = await asyncio.gather(*plan_requests)
+    assert all(response.status_code == 200 for response in plan_responses)
+    assert in_flight["max"] == 10
+
+    assert len(latencies) > 10
+    latencies.sort()
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    assert p99 < plan_delay / 2
+
+
+@pytest.mark.anyio
+async def test_queued_plan_returns_pending_essay_immediately(
+    client,
+    user_factory,
+    auth_override,
+    db_session,
+    monkeypatch,
+):
+    queued = []
+
+    def fake_apply_async(args, **options):
+        essay_id, chapters_count = args
+        queued.append((essay_id, chapters_count, options["queue"]))
+        return SimpleNamespace(id=f"plan-{essay_id}")
+
+    async def _must_not_run(self, *args, **kwargs):
+        raise AssertionError("plan must be generated by the worker")
+
+    monkeypatch.setattr(essay_routes.generate_plan_task, "apply_async", fake_apply_async)
+    monkeypatch.setattr("src.refagent.agents.plan_agent.PlanAgent.agenerate_plan", _must_not_run)
+    user = await user_factory()
+    auth_override(user)
+
+    response = await client.post(
+        "/api/v1/essays/plan/generate",
+        json={
+            "topic": "Экономика Кыргызстана",
+            "checked_by": "Преподаватель",
+            "subject": "Экономика",
+            "page_count": 20,
+            "chapters_count": 3,
+            "language": "ru",
+            "queued": True,
+        },
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == EnumStatus.PLAN_PENDING
+    assert queued == [(data["essay_id"], 3, settings.celery.short_queue)]
+
+    essay = await db_session.get(Essay, data["essay_id"])
+    assert (essay.status, essay.task_id) == (EnumStatus.PLAN_PENDING, data["task_id"])
+
+    status_response = await client.get(f"/api/v1/essays/{data['essay_id']}/status")
+    assert status_response.json()["status"] == EnumStatus.PLAN_PENDING
+
+
+@pytest.mark.anyio
+async def test_speculative_mode_queues_intro_and_references_after_plan(
+    client,
+    user_factory,
+    auth_override,
+    stub_plan_agent,
+    monkeypatch,
+):
+    drafts = []
+
+    def fake_apply_async(args, **options):
+        drafts.append((args, options["priority"]))
+
+    monkeypatch.setattr(settings.celery, "speculative_sections", True)
+    monkeypatch.setattr(essay_tasks.generate_section_draft, "apply_async", fake_apply_async)
+    user = await user_factory()
+    auth_override(user)
+
+    response = await client.post(
+        "/api/v1/essays/plan/generate",
+        json={
+            "topic": "Программирование",
+            "checked_by": "Преподаватель",
+            "subject": "Информатика",
+            "page_count": 8,
+            "chapters_count": 2,
+            "language": "ru",
+        },
+    )
+
+    essay_id = response.json()["essay_id"]
+    assert drafts == [([essay_id, "introduction"], 0), ([essay_id, "references"], 0)]
+
+
+async def _planned_essay(client, chapters_count: int = 2) -> int:
+    response = await client.post(
+        "/api/v1/essays/plan/generate",
+        json={
+            "topic": "Алгоритмы",
+            "checked_by": "Научный руководитель",
+            "subject": "Информатика",
+            "page_count": 20,
+            "chapters_count": chapters_count,
+            "language": "ru",
+        },
+    )
+    return response.json()["essay_id"]
+
+
+@pytest.mark.anyio
+async def test_stream_endpoint_sends_progress_events(
+    client, user_factory, auth_override, stub_plan_agent, db_session,
+):
+    user = await user_factory()
+    auth_override(user)
+    essay_id = await _planned_essay(client)
+    essay = await db_session.get(Essay, essay_id)
+    essay.status = EnumStatus.GENERATED
+    chapter = (await db_session.execute(select(Chapter).where(Chapter.essay_id == essay_id))).scalars().first()
+    chapter.content = "<document>готово</document>"
+    db_session.add(EssaySection(essay_id=essay_id, section=f"chapter:{chapter.id}",
+                                status=EnumStatus.GENERATED, attempts=1))
+    await db_session.commit()
+
+    response = await client.get(f"/api/v1/essays/{essay_id}/stream")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [block.split("\n")[0] for block in response.text.strip().split("\n\n")]
+    assert events == ["event: status", "event: section", "event: delta", "event: done"]
+    assert "готово" in response.text
+
+    other = await user_factory()
+    auth_override(other)
+    assert (await client.get(f"/api/v1/essays/{essay_id}/stream")).status_code == 404
+
+
+@pytest.mark.anyio
+async def test_stream_sends_only_new_text_of_partial_chapter(
+    client, user_factory, auth_override, stub_plan_agent, db_session,
+):
+    user = await user_factory()
+    auth_override(user)
+    essay_id = await _planned_essay(client, chapters_count=1)
+    essay = await db_session.get(Essay, essay_id)
+    essay.status = EnumStatus.GENERATING
+    chapter = (await db_session.execute(select(Chapter).where(Chapter.essay_id == essay_id))).scalars().first()
+    chapter.content = "<document><content><p>Нача"
+    await db_session.commit()
+
+    events = essay_routes.essay_events(db_session, essay_id, poll_seconds=0)
+    assert "GENERATING" in await anext(events)
+    first = await anext(events)
+    assert "event: delta" in first and "Нача" in first
+
+    await db_session.execute(
+        Chapter.__table__.update().where(Chapter.id == chapter.id)
+        .values(content="<document><content><p>Начало текста")
+    )
+    await db_session.commit()
+    second = await anext(events)
+    assert '"text": "ло текста"' in second
+
+    await db_session.execute(Essay.__table__.update().where(Essay.id == essay_id).values(status=EnumStatus.GENERATED))
+    await db_session.commit()
+    assert "event: status" in await anext(events)
+    assert "event: done" in await anext(events)
+
+
+@pytest.mark.anyio
+async def test_status_long_poll_returns_on_change(
+    client, user_factory, auth_override, stub_plan_agent, db_session, monkeypatch,
+):
+    monkeypatch.setattr(settings.celery, "stream_poll_seconds", 0.05)
+    user = await user_factory()
+    auth_override(user)
+    essay_id = await _planned_essay(client)
+
+    # Клиент уже видел другой статус — ответ сразу
+    response = await client.get(f"/api/v1/essays/{essay_id}/status",
+                                params={"wait": 30, "since": "GENERATING"})
+    assert response.json()["status"] == EnumStatus.PLAN_GENERATED
+
+    async def _finish():
+        await asyncio.sleep(0.2)
+        await db_session.execute(
+            Essay.__table__.update().where(Essay.id == essay_id).values(status=EnumStatus.GENERATED)
+        )
+        await db_session.commit()
+
+    started = time.monotonic()
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(_finish)
+        response = await client.get(f"/api/v1/essays/{essay_id}/status",
+                                    params={"wait": 10, "since": "PLAN_GENERATED"})
+    assert response.json()["status"] == EnumStatus.GENERATED
+    assert time.monotonic() - started < 5
+
+    # Без изменений ожидание ограничено wait
+    started = time.monotonic()
+    response = await client.get(f"/api/v1/essays/{essay_id}/status", params={"wait": 0.2})
+    assert response.json()["status"] == EnumStatus.GENERATED
+    assert 0.2 <= time.monotonic() - started < 5
+
+
+@pytest.mark.anyio
+async def test_concurrent_generate_requests_dispatch_once(
+    client, user_factory, auth_override, stub_plan_agent, stub_celery_delay, db_session, monkeypatch,
+):
+    user = await user_factory()
+    auth_override(user)
+    essay_id = await _planned_essay(client)
+    # В тестовой БД одно соединение на всех: планировщик запускаем после запросов
+    monkeypatch.setattr(essay_routes, "release_queued_essays", lambda: None)
+
+    responses = await asyncio.gather(*(client.post(f"/api/v1/essays/{essay_id}/generate") for _ in range(3)))
+    essay_tasks.release_queued_essays()
+
+    assert [response.status_code for response in responses] == [200] * 3
+    assert {response.json()["status"] for response in responses} == {EnumStatus.QUEUED}
+    assert len(stub_celery_delay) == 1
+    essay = await db_session.get(Essay, essay_id)
+    assert (essay.status, essay.attempts) == (EnumStatus.GENERATING, 1)
+
+
+@pytest.mark.anyio
+async def test_idempotency_key_replays_original_response(
+    client, user_factory, auth_override, stub_plan_agent, stub_celery_delay, db_session,
+):
+    user = await user_factory()
+    auth_override(user)
+    body = {"topic": "Алгоритмы", "checked_by": "Научный руководитель", "subject": "Информатика",
+            "page_count": 20, "chapters_count": 2, "language": "ru"}
+
+    first = await client.post("/api/v1/essays/plan/generate", json=body, headers={"Idempotency-Key": "plan-1"})
+    retry = await client.post("/api/v1/essays/plan/generate", json=body, headers={"Idempotency-Key": "plan-1"})
+
+    assert retry.status_code == 200 and retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert len((await db_session.execute(select(Essay.id).where(Essay.user_id == user.id))).all()) == 1
+
+    reused = await client.post("/api/v1/essays/plan/generate", json=body | {"topic": "Другая"},
+                               headers={"Idempotency-Key": "plan-1"})
+    assert reused.status_code == 422
+
+    essay_id = first.json()["essay_id"]
+    url = f"/api/v1/essays/{essay_id}/generate"
+    assert (await client.post(url, headers={"Idempotency-Key": "gen-1"})).json()["status"] == EnumStatus.QUEUED
+    essay = await db_session.get(Essay, essay_id)
+    assert stub_celery_delay[0][1]["task_id"] == essay.task_id
+    essay.status = EnumStatus.FAILURE
+    await db_session.commit()
+    assert (await client.post(url, headers={"Idempotency-Key": "gen-1"})).json()["status"] == EnumStatus.QUEUED
+    assert len(stub_celery_delay) == 1
+
+    # Упавший запрос ключ не занимает: повтор выполняется заново
+    missing = "/api/v1/essays/999999/generate"
+    assert (await client.post(missing, headers={"Idempotency-Key": "gen-2"})).status_code == 404
+    assert (await client.post(missing, headers={"Idempotency-Key": "gen-2"})).status_code == 404
@@ -0,0 +1,651 @@
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy.orm import sessionmaker
+
+import src.tasks.essay as essay_tasks
+import src.tasks.outbox as outbox_tasks
+from src.celery_app import celery_app
+from src.config import settings
+from src.models.essay import Chapter, EnumLanguage, EnumStatus, Essay, EssaySection, SectionDraft
+
+
+SECTION_DELAY = 0.2
+
+
+@pytest.fixture
+def task_session(monkeypatch, sync_session_factory):
+    monkeypatch.setattr(essay_tasks, "SyncSessionLocal", sync_session_factory)
+    return sync_session_factory
+
+
+@pytest.fixture
+def inline_generation(monkeypatch):
+    monkeypatch.setattr(settings.celery, "essay_fan_out", False)
+
+
+@pytest.fixture
+def eager_celery(monkeypatch):
+    monkeypatch.setattr(settings.celery, "essay_fan_out", True)
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+
+
+@pytest.fixture
+def stub_agents(monkeypatch):
+    state = {"in_flight": 0, "max_in_flight": 0, "calls": []}
+    lock = threading.Lock()
+
+    def _track(text):
+        with lock:
+            state["calls"].append(text)
+            state["in_flight"] += 1
+            state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        time.sleep(SECTION_DELAY)
+        with lock:
+            state["in_flight"] -= 1
+        return f"<document><content><p>{text}</p></content><formulas></formulas></document>"
+
+    monkeypatch.setattr(
+        "src.refagent.agents.introduction_agent.IntroductionAgent.write",
+        lambda self, topic, language="ru", chars=1500: _track("intro"),
+    )
+    monkeypatch.setattr(
+        "src.refagent.agents.conclusion_agent.ConclusionAgent.write",
+        lambda self, topic, language="ru", chars=1500, *args, **kwargs: _track("conclusion"),
+    )
+    monkeypatch.setattr(
+        "src.refagent.agents.references_agent.ReferencesAgent.write",
+        lambda self, topic, language="ru", count=10: _track("references"),
+    )
+    monkeypatch.setattr(
+        "src.refagent.agents.chapter_agent.ChapterAgent.write_chapter",
+        lambda self, topic, chapter_title, position, **kwargs: _track(chapter_title),
+    )
+    monkeypatch.setattr(
+        "src.refagent.agents.front_matter_agent.FrontMatterAgent.write",
+        lambda self, topic, language, sections: {
+            name: _track(f"front_matter:{name}") for name in state["front_matter_returns"] or sections
+        },
+    )
+    state["front_matter_returns"] = None
+    # По умолчанию каждый раздел — отдельный вызов; объединение проверяется отдельно
+    monkeypatch.setattr(settings.refagent, "front_matter_max_pages", 0)
+    return state
+
+
+async def _create_essay(db_session, chapters: int = 3) -> int:
+    essay = Essay(
+        topic="Программирование",
+        page_count=20,
+        status=EnumStatus.PLAN_GENERATED,
+        language=EnumLanguage.RU,
+        chapter_count=chapters,
+        introduction_chars_count=1500,
+        conclusion_chars_count=1500,
+        references_chars_count=1500,
+    )
+    db_session.add(essay)
+    await db_session.flush()
+    for idx in range(1, chapters + 1):
+        db_session.add(Chapter(title=f"Глава {idx}", position=idx, chars=4500, essay_id=essay.id))
+    await db_session.commit()
+    return essay.id
+
+
+@pytest.mark.anyio
+async def test_generate_essay_runs_sections_concurrently(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", True)
+    monkeypatch.setattr(settings.refagent, "section_max_in_flight", 3)
+    essay_id = await _create_essay(db_session, chapters=3)
+    # Прогреваем кеш моделей, чтобы в замер не попало создание ChatOpenAI
+    essay_tasks.SectionAgents()
+
+    started = time.perf_counter()
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+    elapsed = time.perf_counter() - started
+
+    assert result["status"] == EnumStatus.GENERATED
+    assert stub_agents["max_in_flight"] == 3
+    sequential = SECTION_DELAY * 6
+    assert elapsed < sequential / 2
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert "intro" in essay.introduction
+    assert "conclusion" in essay.conclusion
+    assert "references" in essay.references
+    assert all(chapter.content and chapter.title in chapter.content for chapter in essay.chapters)
+
+
+@pytest.mark.anyio
+async def test_generate_essay_sequential_when_concurrency_disabled(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    essay_id = await _create_essay(db_session, chapters=2)
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.GENERATED
+    assert stub_agents["max_in_flight"] == 1
+
+
+def test_run_section_jobs_cancels_pending_calls_on_failure():
+    calls = []
+
+    def _fail():
+        calls.append("fail")
+        raise RuntimeError("LLM unavailable")
+
+    def _slow():
+        calls.append("slow")
+        time.sleep(SECTION_DELAY)
+        return "ok"
+
+    jobs = [essay_tasks.SectionJob("fail", Chapter, 1, "content", _fail)]
+    jobs += [essay_tasks.SectionJob(f"slow:{idx}", Chapter, 1, "content", _slow) for idx in range(6)]
+
+    with pytest.raises(RuntimeError):
+        essay_tasks.run_section_jobs(jobs, lambda job, content: None, max_in_flight=2)
+
+    assert calls[0] == "fail"
+    assert len(calls) < len(jobs)
+
+
+@pytest.mark.anyio
+async def test_generate_essay_fans_out_sections_through_chord(
+    db_session, task_session, eager_celery, stub_agents
+):
+    essay_id = await _create_essay(db_session, chapters=2)
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.GENERATING
+    assert result["sections"][:3] == ["introduction", "conclusion", "references"]
+    assert len(result["sections"]) == 5
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.GENERATED
+    assert essay.introduction and essay.conclusion and essay.references
+    assert all(chapter.content for chapter in essay.chapters)
+
+
+@pytest.mark.anyio
+async def test_failed_section_marks_essay_failed(
+    db_session, task_session, eager_celery, stub_agents, monkeypatch
+):
+    def _boom(self, *args, **kwargs):
+        raise RuntimeError("LLM unavailable")
+
+    monkeypatch.setattr("src.refagent.agents.references_agent.ReferencesAgent.write", _boom)
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    essay_tasks.generate_essay.apply(args=(essay_id,))
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.FAILURE
+    assert essay.introduction
+    assert essay.references is None
+
+
+@pytest.mark.anyio
+async def test_mark_essay_failed_errback_sets_failure(db_session, task_session):
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    essay_tasks.mark_essay_failed.apply(args=(essay_id,)).get()
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.FAILURE
+
+
+@pytest.mark.anyio
+async def test_chord_publish_failure_marks_essay_failed(
+    db_session, task_session, eager_celery, stub_agents, monkeypatch
+):
+    def _broken_chord(*args, **kwargs):
+        raise ConnectionError("broker unavailable")
+
+    monkeypatch.setattr(essay_tasks, "chord", _broken_chord)
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.FAILURE
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.FAILURE
+
+
+def test_deterministic_errors_are_not_retried():
+    retried = essay_tasks.generate_section.autoretry_for
+    assert ValueError not in retried and LookupError not in retried
+    assert not any(issubclass(ValueError, exc) for exc in retried)
+
+
+@pytest.mark.anyio
+async def test_generate_section_fails_for_missing_essay(task_session, eager_celery, db_session):
+    result = essay_tasks.generate_section.apply(args=(999, "introduction"))
+
+    assert result.failed()
+    assert isinstance(result.result, LookupError)
+
+
+@pytest.mark.anyio
+async def test_retry_generates_only_missing_sections(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    original_write = essay_tasks.ReferencesAgent.write
+
+    def _boom(self, *args, **kwargs):
+        raise RuntimeError("LLM unavailable")
+
+    monkeypatch.setattr("src.refagent.agents.references_agent.ReferencesAgent.write", _boom)
+    essay_id = await _create_essay(db_session, chapters=2)
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+    assert result["status"] == EnumStatus.FAILURE
+    assert stub_agents["calls"] == ["intro", "conclusion"]
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.FAILURE
+    assert essay.introduction and essay.conclusion
+
+    monkeypatch.setattr("src.refagent.agents.references_agent.ReferencesAgent.write", original_write)
+    stub_agents["calls"].clear()
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.GENERATED
+    assert stub_agents["calls"] == ["references", "Глава 1", "Глава 2"]
+    db_session.expire_all()
+    sections = (await db_session.execute(
+        EssaySection.__table__.select().where(EssaySection.essay_id == essay_id)
+    )).all()
+    assert len(sections) == 5
+    assert all(row.status == EnumStatus.GENERATED for row in sections)
+    assert {row.section: row.attempts for row in sections}["references"] == 2
+
+
+@pytest.mark.anyio
+async def test_fan_out_dispatches_only_pending_sections(
+    db_session, task_session, eager_celery, stub_agents
+):
+    essay_id = await _create_essay(db_session, chapters=1)
+    db_session.add(EssaySection(essay_id=essay_id, section="introduction",
+                                status=EnumStatus.GENERATED, attempts=1))
+    await db_session.commit()
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert "introduction" not in result["sections"]
+    assert "intro" not in stub_agents["calls"]
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.GENERATED
+
+
+@pytest.mark.anyio
+async def test_generate_section_skips_checkpointed_section(db_session, task_session, stub_agents):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay_tasks.generate_section.apply(args=(essay_id, "introduction")).get()
+
+    essay_tasks.generate_section.apply(args=(essay_id, "introduction")).get()
+
+    assert stub_agents["calls"] == ["intro"]
+
+
+@pytest.mark.parametrize("fan_out", [False, True])
+def test_no_connection_is_checked_out_during_agent_calls(pooled_engine, monkeypatch, fan_out):
+    session_factory = sessionmaker(bind=pooled_engine, autoflush=False)
+    monkeypatch.setattr(essay_tasks, "SyncSessionLocal", session_factory)
+    monkeypatch.setattr(settings.celery, "essay_fan_out", fan_out)
+    monkeypatch.setattr(celery_app.conf, "task_always_eager", True)
+    # Последовательно: при параллельных вызовах соседний раздел может в этот
+    # момент законно держать соединение для своей короткой записи
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    monkeypatch.setattr(settings.refagent, "front_matter_max_pages", 0)
+    checked_out = []
+
+    def _write(self, *args, **kwargs):
+        checked_out.append(pooled_engine.pool.checkedout())
+        return "<document><content><p>text</p></content><formulas></formulas></document>"
+
+    for path in ("introduction_agent.IntroductionAgent.write", "conclusion_agent.ConclusionAgent.write",
+                 "references_agent.ReferencesAgent.write", "chapter_agent.ChapterAgent.write_chapter"):
+        monkeypatch.setattr(f"src.refagent.agents.{path}", _write)
+
+    with session_factory() as db:
+        essay = Essay(topic="Программирование", page_count=20, status=EnumStatus.PLAN_GENERATED,
+                      language=EnumLanguage.RU, chapter_count=2, introduction_chars_count=1500,
+                      conclusion_chars_count=1500, references_chars_count=1500)
+        essay.chapters = [Chapter(title=f"Глава {idx}", position=idx, chars=4500) for idx in (1, 2)]
+        db.add(essay)
+        db.commit()
+        essay_id = essay.id
+
+    essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert checked_out == [0] * 5
+    with session_factory() as db:
+        assert db.get(Essay, essay_id).status == EnumStatus.GENERATED
+
+
+@pytest.mark.anyio
+async def test_speculative_drafts_are_adopted_by_generate_essay(
+    db_session, task_session, inline_generation, stub_agents
+):
+    essay_id = await _create_essay(db_session, chapters=1)
+    for section in essay_tasks.SPECULATIVE_SECTIONS:
+        essay_tasks.generate_section_draft.apply(args=(essay_id, section)).get()
+    assert sorted(stub_agents["calls"]) == ["intro", "references"]
+    stub_agents["calls"].clear()
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.GENERATED
+    assert sorted(stub_agents["calls"]) == ["conclusion", "Глава 1"]
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert "intro" in essay.introduction and "references" in essay.references
+    assert (await db_session.execute(SectionDraft.__table__.select())).all() == []
+
+
+@pytest.mark.anyio
+async def test_draft_for_changed_topic_is_discarded(
+    db_session, task_session, inline_generation, stub_agents
+):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay_tasks.generate_section_draft.apply(args=(essay_id, "introduction")).get()
+    essay = await db_session.get(Essay, essay_id)
+    essay.topic = "Другая тема"
+    await db_session.commit()
+    stub_agents["calls"].clear()
+
+    essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert "intro" in stub_agents["calls"]
+    assert (await db_session.execute(SectionDraft.__table__.select())).all() == []
+
+
+@pytest.mark.anyio
+async def test_draft_is_skipped_once_generation_started(db_session, task_session, stub_agents):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay = await db_session.get(Essay, essay_id)
+    essay.status = EnumStatus.GENERATING
+    await db_session.commit()
+
+    result = essay_tasks.generate_section_draft.apply(args=(essay_id, "introduction")).get()
+
+    assert result["status"] == "SKIPPED"
+    assert stub_agents["calls"] == []
+
+
+@pytest.mark.anyio
+async def test_stale_drafts_are_discarded(db_session, task_session):
+    essay_id = await _create_essay(db_session, chapters=1)
+    db_session.add_all([
+        SectionDraft(essay_id=essay_id, section="introduction", topic="t", language="ru", chars=1,
+                     content="old", created_at=datetime.now(timezone.utc) - timedelta(days=2)),
+        SectionDraft(essay_id=essay_id, section="references", topic="t", language="ru", chars=1,
+                     content="fresh"),
+    ])
+    await db_session.commit()
+
+    assert essay_tasks.discard_stale_section_drafts.apply().get() == {"deleted": 1}
+    rows = (await db_session.execute(SectionDraft.__table__.select())).all()
+    assert [row.content for row in rows] == ["fresh"]
+
+
+@pytest.mark.anyio
+async def test_short_essay_writes_small_sections_in_one_call(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "front_matter_max_pages", 20)
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["status"] == EnumStatus.GENERATED
+    assert stub_agents["calls"] == [
+        "front_matter:introduction", "front_matter:conclusion", "front_matter:references", "Глава 1",
+    ]
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert "front_matter:introduction" in essay.introduction
+    assert "front_matter:references" in essay.references
+    sections = (await db_session.execute(
+        EssaySection.__table__.select().where(EssaySection.essay_id == essay_id)
+    )).all()
+    assert len(sections) == 4
+    assert all(row.status == EnumStatus.GENERATED for row in sections)
+
+
+@pytest.mark.anyio
+async def test_missing_front_matter_part_falls_back_to_section_agent(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "front_matter_max_pages", 20)
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    stub_agents["front_matter_returns"] = ["introduction", "conclusion"]
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert stub_agents["calls"][:3] == ["front_matter:introduction", "front_matter:conclusion", "references"]
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert "references" in essay.references
+
+
+@pytest.mark.anyio
+async def test_fan_out_groups_small_sections_only_for_short_essays(
+    db_session, task_session, eager_celery, stub_agents, monkeypatch
+):
+    essay_id = await _create_essay(db_session, chapters=1)
+    db_session.add(EssaySection(essay_id=essay_id, section="introduction",
+                                status=EnumStatus.GENERATED, attempts=1))
+    await db_session.commit()
+
+    monkeypatch.setattr(settings.refagent, "front_matter_max_pages", 20)
+    result = essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert result["sections"][0] == "front_matter:conclusion,references"
+    assert "intro" not in stub_agents["calls"]
+    assert essay_tasks.group_front_matter(["introduction", "conclusion", "chapter:1"], 21) == \
+        ["introduction", "conclusion", "chapter:1"]
+    assert essay_tasks.group_front_matter(["introduction", "chapter:1"], 5) == ["introduction", "chapter:1"]
+
+
+@pytest.mark.anyio
+async def test_section_stream_flushes_partial_text_at_intervals(db_session, task_session):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay = await db_session.get(Essay, essay_id)
+    chapter_id = essay.chapters[0].id
+    now = [0.0]
+    stream = essay_tasks.SectionStream(essay_id, chapter_id, interval=2.0, clock=lambda: now[0])
+
+    stream("<document><content><p>Пер")
+    now[0] = 1.0
+    stream("вый")
+    db_session.expire_all()
+    assert (await db_session.get(Chapter, chapter_id)).content is None
+
+    now[0] = 2.5
+    stream(" абзац")
+    db_session.expire_all()
+    assert (await db_session.get(Chapter, chapter_id)).content == "<document><content><p>Первый абзац"
+
+
+@pytest.mark.anyio
+async def test_streaming_chapters_receive_chunk_callback(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.celery, "stream_sections", True)
+    received = []
+
+    def _write(self, topic, chapter_title, position, on_chunk=None, **kwargs):
+        received.append(on_chunk)
+        return "<document><content><p>ok</p></content><formulas></formulas></document>"
+
+    monkeypatch.setattr("src.refagent.agents.chapter_agent.ChapterAgent.write_chapter", _write)
+    essay_id = await _create_essay(db_session, chapters=2)
+
+    essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    assert len(received) == 2
+    assert all(isinstance(callback, essay_tasks.SectionStream) for callback in received)
+
+
+@pytest.mark.anyio
+async def test_section_progress_records_timing_size_and_model(
+    db_session, task_session, inline_generation, stub_agents, monkeypatch
+):
+    monkeypatch.setattr(settings.refagent, "concurrent_generation", False)
+    monkeypatch.setattr(settings.refagent, "model_name", "intro-model")
+
+    def _intro(self, topic, language="ru", chars=1500):
+        self._route("prompt", None)
+        return "<document><content><p>Введение</p></content></document>"
+
+    def _boom(self, *args, **kwargs):
+        raise RuntimeError("LLM unavailable")
+
+    monkeypatch.setattr("src.refagent.agents.introduction_agent.IntroductionAgent.write", _intro)
+    monkeypatch.setattr("src.refagent.agents.references_agent.ReferencesAgent.write", _boom)
+    essay_id = await _create_essay(db_session, chapters=1)
+
+    essay_tasks.generate_essay.apply(args=(essay_id,)).get()
+
+    db_session.expire_all()
+    rows = {row.section: row for row in (await db_session.execute(
+        EssaySection.__table__.select().where(EssaySection.essay_id == essay_id)
+    )).all()}
+    intro = rows["introduction"]
+    assert intro.status == EnumStatus.GENERATED
+    assert intro.chars == len("Введение") and intro.model == "intro-model"
+    assert intro.started_at <= intro.finished_at
+    assert rows["conclusion"].model is None
+    assert rows["references"].status == EnumStatus.FAILURE and rows["references"].finished_at
+    # Глава после упавшего раздела так и не начиналась
+    chapter = next(row for name, row in rows.items() if name.startswith("chapter:"))
+    assert chapter.status == EnumStatus.PENDING and chapter.started_at is None
+
+
+@pytest.mark.anyio
+async def test_reaper_requeues_stale_essays_and_fails_exhausted_ones(db_session, task_session, monkeypatch):
+    monkeypatch.setattr(settings.celery, "essay_reaper_batch", 1)
+    monkeypatch.setattr(outbox_tasks, "SyncSessionLocal", task_session)
+    published = []
+    monkeypatch.setattr(essay_tasks.generate_essay, "apply_async",
+                        lambda args, task_id, **options: published.append((args[0], task_id)))
+    stale = datetime.now(timezone.utc) - timedelta(seconds=settings.celery.essay_heartbeat_timeout_seconds + 60)
+
+    ids = [await _create_essay(db_session, chapters=1) for _ in range(3)]
+    for essay_id, attempts, updated_at in zip(ids, (1, settings.celery.essay_max_attempts, 1),
+                                              (stale, stale, datetime.now(timezone.utc))):
+        essay = await db_session.get(Essay, essay_id)
+        essay.status, essay.attempts, essay.updated_at = EnumStatus.GENERATING, attempts, updated_at
+    db_session.add(EssaySection(essay_id=ids[1], section="introduction", status=EnumStatus.GENERATING, attempts=1))
+    await db_session.commit()
+
+    result = essay_tasks.reap_stuck_essays.apply().get()
+    outbox_tasks.relay_outbox()
+
+    assert result == {"requeued": [ids[0]], "failed": [ids[1]]}
+    db_session.expire_all()
+    requeued, exhausted, alive = [await db_session.get(Essay, essay_id) for essay_id in ids]
+    assert published == [(ids[0], requeued.task_id)]
+    assert (requeued.status, requeued.attempts) == (EnumStatus.GENERATING, 2)
+    assert exhausted.status == EnumStatus.FAILED
+    section = (await db_session.execute(
+        EssaySection.__table__.select().where(EssaySection.essay_id == ids[1])
+    )).one()
+    assert section.status == EnumStatus.FAILURE
+    assert (alive.status, alive.attempts) == (EnumStatus.GENERATING, 1)
+
+    # Heartbeat обновлён при перезапуске — второй проход ничего не находит
+    assert essay_tasks.reap_stuck_essays.apply().get() == {"requeued": [], "failed": []}
+
+
+@pytest.mark.anyio
+async def test_heartbeat_refreshes_updated_at_while_task_runs(db_session, task_session):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay = await db_session.get(Essay, essay_id)
+    essay.updated_at = datetime.now(timezone.utc) - timedelta(hours=1)
+    await db_session.commit()
+
+    with essay_tasks.EssayHeartbeat(essay_id, interval=0.05):
+        time.sleep(0.2)
+
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.updated_at.replace(tzinfo=timezone.utc) > datetime.now(timezone.utc) - timedelta(minutes=1)
+
+
+@pytest.mark.anyio
+async def test_superseded_essay_task_is_skipped(db_session, task_session, eager_celery, stub_agents):
+    essay_id = await _create_essay(db_session, chapters=1)
+    essay = await db_session.get(Essay, essay_id)
+    essay.task_id = "current-task"
+    await db_session.commit()
+
+    result = essay_tasks.generate_essay.apply(args=(essay_id,), task_id="stale-task").get()
+
+    assert result["status"] == "SKIPPED"
+    assert stub_agents["calls"] == []
+    result = essay_tasks.generate_essay.apply(args=(essay_id,), task_id="current-task").get()
+    assert result["status"] == EnumStatus.GENERATING
+
+
+@pytest.mark.anyio
+async def test_scheduler_releases_queued_essays_round_robin_within_limits(
+    db_session, task_session, user_factory, monkeypatch,
+):
+    monkeypatch.setattr(outbox_tasks, "SyncSessionLocal", task_session)
+    monkeypatch.setattr(settings.celery, "scheduler_max_in_flight", 4)
+    monkeypatch.setattr(settings.celery, "user_max_in_flight", 2)
+    monkeypatch.setattr(settings.celery, "superuser_max_in_flight", 3)
+    published = []
+    monkeypatch.setattr(essay_tasks.generate_essay, "apply_async",
+                        lambda args, task_id, **options: published.append(args[0]))
+    heavy, light, admin = await user_factory(), await user_factory(), await user_factory()
+    admin.is_superuser = True
+    await db_session.commit()
+
+    # heavy поставил в очередь пять эссе раньше всех, light и admin — по два
+    owners = [heavy] * 5 + [light, admin, light, admin]
+    ids = [await _create_essay(db_session, chapters=1) for _ in owners]
+    queued_at = datetime.now(timezone.utc) - timedelta(minutes=10)
+    for position, (essay_id, owner) in enumerate(zip(ids, owners)):
+        essay = await db_session.get(Essay, essay_id)
+        essay.user_id, essay.status = owner.id, EnumStatus.QUEUED
+        essay.updated_at = queued_at + timedelta(seconds=position)
+    await db_session.commit()
+
+    result = essay_tasks.release_queued_essays.apply().get()
+
+    # По кругу: heavy, light, admin, снова heavy — и общий лимит 4 исчерпан
+    assert result == {"released": [ids[0], ids[5], ids[6], ids[1]]}
+    assert published == result["released"]
+    db_session.expire_all()
+    statuses = [(await db_session.get(Essay, essay_id)).status for essay_id in ids]
+    assert statuses.count(EnumStatus.GENERATING) == 4 and statuses.count(EnumStatus.QUEUED) == 5
+
+    # Эссе heavy завершилось: планировщик снова идёт по кругу с учётом лимитов
+    monkeypatch.setattr(settings.celery, "scheduler_max_in_flight", 10)
+    essay_tasks.finalize_essay.apply(args=(ids[0],)).get()
+    db_session.expire_all()
+    assert (await db_session.get(Essay, ids[0])).status == EnumStatus.GENERATED
+    assert published[4:] == [ids[2], ids[7], ids[8]]
+    # У heavy ещё два эссе в очереди, но он упёрся в свой лимит
+    assert essay_tasks.release_queued_essays.apply().get() == {"released": []}
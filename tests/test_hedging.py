@@ -0,0 +1,67 @@
+import time
+
+import pytest
+
+from src.config import settings
+from src.refagent import hedging
+from src.refagent.agents.plan_agent import PlanAgent
+from src.refagent.hedging import MIN_HEDGE_SAMPLES, get_hedger
+
+ROUTE = ("plan", "gpt-4o-mini")
+
+
+@pytest.fixture
+def hedged(stub_providers, monkeypatch):
+    """alpha почти всегда выбирается первым и отвечает медленно, beta — быстро."""
+    monkeypatch.setattr(settings.refagent, "openai_endpoints", ";".join(
+        f"{name}|{server.base_url}|key|{weight}"
+        for (name, server), weight in zip(stub_providers.items(), (10000, 1))
+    ))
+    monkeypatch.setattr(settings.refagent, "hedge_enabled", True)
+    monkeypatch.setattr(settings.refagent, "hedge_min_delay_seconds", 0.05)
+    monkeypatch.setattr(settings.refagent, "hedge_max_ratio", 1.0)
+    monkeypatch.setattr(hedging, "_hedgers", {})
+    stub_providers["alpha"].latency = 1.0
+    for _ in range(MIN_HEDGE_SAMPLES):
+        get_hedger().observe(ROUTE, 0.05)
+    return stub_providers
+
+
+def test_slow_call_is_hedged_to_other_endpoint(hedged):
+    started = time.perf_counter()
+    result = PlanAgent().generate_plan("Тема", "ru", 3)
+
+    assert "beta" in result
+    assert time.perf_counter() - started < 0.8
+    assert get_hedger().stats()["hedge_wins"] == 1
+
+
+def test_hedge_ratio_is_capped(hedged, monkeypatch):
+    monkeypatch.setattr(settings.refagent, "hedge_max_ratio", 0.0)
+    hedged["alpha"].latency = 0.2
+
+    result = PlanAgent().generate_plan("Тема", "ru", 3)
+
+    assert "alpha" in result
+    assert get_hedger().stats()["hedges"] == 0
+    assert hedged["beta"].calls == 0
+
+
+def test_no_hedge_without_latency_history(hedged, monkeypatch):
+    monkeypatch.setattr(hedging, "_hedgers", {})
+    hedged["alpha"].latency = 0.2
+
+    assert "alpha" in PlanAgent().generate_plan("Тема", "ru", 3)
+    assert get_hedger().stats() == {
+        "enabled": True, "requests": 1, "hedges": 0, "hedge_wins": 0, "hedge_ratio": 0.0,
+    }
+
+
+@pytest.mark.anyio
+async def test_async_hedge_cancels_loser(hedged):
+    started = time.perf_counter()
+    result = await PlanAgent().agenerate_plan("Тема", "ru", 3)
+
+    assert "beta" in result
+    assert time.perf_counter() - started < 0.8
+    assert get_hedger().stats()["hedge_wins"] == 1
@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import src.refagent.cache as cache_module
+from src.config import settings
+from src.refagent.agents.base import BaseAgent
+from src.refagent.cache import LLMCache, cache_key
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+@pytest.fixture
+def llm_cache(tmp_path, clock):
+    return LLMCache(tmp_path / "llm_cache.sqlite3", max_entries=2, ttl_seconds=60, clock=clock)
+
+
+def test_cache_key_depends_on_model_temperature_and_prompt():
+    key = cache_key("gpt-4o", 0.7, "Программирование")
+    assert key == cache_key("gpt-4o", 0.7, "Программирование")
+    assert key != cache_key("gpt-4o-mini", 0.7, "Программирование")
+    assert key != cache_key("gpt-4o", None, "Программирование")
+    assert key != cache_key("gpt-4o", 0.7, "Экономика Кыргызстана")
+
+
+def test_get_counts_hits_and_misses(llm_cache):
+    assert llm_cache.get("a") is None
+    llm_cache.set("a", "answer")
+    assert llm_cache.get("a") == "answer"
+
+    assert llm_cache.stats() == {"hits": 1, "misses": 1, "coalesced": 0, "entries": 1}
+
+
+def test_entries_expire_after_ttl(llm_cache, clock):
+    llm_cache.set("a", "answer")
+    clock.now += 61
+
+    assert llm_cache.get("a") is None
+    assert llm_cache.stats()["entries"] == 0
+
+
+def test_least_recently_used_entry_is_evicted(llm_cache, clock):
+    llm_cache.set("a", "1")
+    clock.now += 1
+    llm_cache.set("b", "2")
+    clock.now += 1
+    llm_cache.get("a")
+    clock.now += 1
+    llm_cache.set("c", "3")
+
+    assert llm_cache.get("b") is None
+    assert llm_cache.get("a") == "1"
+    assert llm_cache.get("c") == "3"
+
+
+def test_concurrent_duplicates_share_one_call(llm_cache):
+    calls = []
+    barrier = threading.Barrier(4)
+    results = []
+
+    def _call():
+        calls.append(1)
+        time.sleep(0.2)
+        return "answer"
+
+    def _worker():
+        barrier.wait()
+        results.append(llm_cache.get_or_call("a", _call))
+
+    threads = [threading.Thread(target=_worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ["answer"] * 4
+    assert len(calls) == 1
+    assert llm_cache.stats()["coalesced"] == 3
+
+
+def test_failed_call_is_not_cached(llm_cache):
+    def _boom():
+        raise RuntimeError("LLM unavailable")
+
+    with pytest.raises(RuntimeError):
+        llm_cache.get_or_call("a", _boom)
+
+    assert llm_cache.get_or_call("a", lambda: "answer") == "answer"
+
+
+@pytest.mark.anyio
+async def test_async_duplicates_share_one_call(llm_cache):
+    calls = []
+
+    async def _call():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return "answer"
+
+    results = await asyncio.gather(*(llm_cache.aget_or_call("a", _call) for _ in range(3)))
+
+    assert results == ["answer"] * 3
+    assert len(calls) == 1
+    assert await llm_cache.aget_or_call("a", _call) == "answer"
+    assert len(calls) == 1
+
+
+class _StubAgent(BaseAgent):
+    cache_name = "stub"
+
+    def __init__(self):
+        self.model_name = "gpt-4o"
+        self.routed = False
+        self.temperature = 0.7
+        self.calls = 0
+
+    def _call(self, prompt: str, budget=None, choice=None) -> str:
+        self.calls += 1
+        return f"answer:{prompt}"
+
+
+@pytest.fixture
+def enabled_cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(settings.refagent, "llm_cache_enabled", True)
+    monkeypatch.setattr(settings.refagent, "llm_cache_path", tmp_path / "llm_cache.sqlite3")
+    monkeypatch.setattr(cache_module, "_caches", {})
+
+
+def test_agent_uses_cache_only_when_opted_in(enabled_cache, monkeypatch):
+    agent = _StubAgent()
+
+    monkeypatch.setattr(settings.refagent, "llm_cache_agents", "plan")
+    agent.invoke("topic")
+    agent.invoke("topic")
+    assert agent.calls == 2
+
+    monkeypatch.setattr(settings.refagent, "llm_cache_agents", "plan, stub")
+    agent.invoke("topic")
+    agent.invoke("topic")
+    assert agent.calls == 3
+
+
+@pytest.mark.anyio
+async def test_llm_cache_metrics_requires_superuser(client, user_factory, auth_override, db_session):
+    user = await user_factory()
+    auth_override(user)
+
+    response = await client.get("/api/v1/metrics/llm-cache")
+    assert response.status_code == 403
+
+    user.is_superuser = True
+    await db_session.commit()
+    response = await client.get("/api/v1/metrics/llm-cache")
+    assert response.status_code == 200
@@ -0,0 +1,109 @@
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+
+from src.config import settings
+from src.refagent.agents.chapter_agent import ChapterAgent
+from src.refagent.agents.base import track_models
+from src.refagent.agents.plan_agent import PlanAgent
+from src.refagent.budget import token_budget
+from src.refagent.model_routing import (
+    RouteChoice,
+    get_route_stats,
+    match_route,
+    parse_routes,
+    select_model,
+)
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "model_name", "big")
+    monkeypatch.setattr(settings.refagent, "model_fallback", "fast")
+    monkeypatch.setattr(settings.refagent, "model_latency_slo_seconds", 30.0)
+    monkeypatch.setattr(settings.refagent, "model_routes", "plan=small,chapter:3000=small,chapter=big")
+
+
+def test_routes_pick_narrowest_band(routes):
+    assert [route.name for route in parse_routes(settings.refagent.model_routes)] == \
+        ["plan", "chapter:3000", "chapter"]
+    assert match_route("chapter", token_budget("ru", 1500), "big").model == "small"
+    assert match_route("chapter", token_budget("ru", 9000), "big").name == "chapter"
+    assert match_route("introduction", token_budget("ru", 1500), "big").model == "big"
+
+    with pytest.raises(ValueError):
+        parse_routes("chapter:3000")
+
+
+def test_slow_route_falls_back_to_fast_model(routes, monkeypatch):
+    budget = token_budget("ru", 9000)
+    assert select_model("chapter", budget, "big") == RouteChoice("chapter", "big")
+
+    assert select_model("chapter", budget, "big", queue_wait=31) == RouteChoice("chapter", "fast", fallback=True)
+
+    get_route_stats().record(RouteChoice("chapter", "big"), latency=40)
+    assert select_model("chapter", budget, "big").model == "fast"
+    # Маршрут, который уже ведёт на запасную модель, не переключается
+    monkeypatch.setattr(settings.refagent, "model_fallback", "small")
+    assert select_model("plan", None, "big", queue_wait=60) == RouteChoice("plan", "small")
+
+
+def test_route_stats_accumulate_latency_and_cost(routes, monkeypatch):
+    monkeypatch.setattr(settings.refagent, "model_prices", "big=2/10")
+    stats = get_route_stats()
+
+    stats.record(RouteChoice("chapter", "big"), 2.0, input_tokens=1000, output_tokens=500)
+    stats.record(RouteChoice("chapter", "big", fallback=True), 4.0, input_tokens=1000, output_tokens=500)
+
+    [row] = stats.stats()
+    assert row["calls"] == 2 and row["fallbacks"] == 1
+    assert row["mean_latency_seconds"] == 3.0
+    assert row["cost_usd"] == pytest.approx(2 * (1000 * 2 + 500 * 10) / 1_000_000)
+
+
+def test_agents_call_routed_model(routes, monkeypatch):
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+    models = []
+
+    def _invoke(self, prompt, *args, **kwargs):
+        models.append(self.model_name)
+        return AIMessage(content="<document><content><p>ok</p></content></document>",
+                         usage_metadata={"input_tokens": 10, "output_tokens": 5, "total_tokens": 15})
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    PlanAgent().generate_plan("Тема", "ru", 3)
+    ChapterAgent().write_chapter("Тема", "Глава", 1, "ru", chars=1500, full_chars=2000)
+    ChapterAgent().write_chapter("Тема", "Глава", 1, "ru", chars=6000, full_chars=8000)
+    ChapterAgent(model="pinned").write_chapter("Тема", "Глава", 1, "ru", chars=1500, full_chars=2000)
+
+    assert models == ["small", "small", "big", "pinned"]
+    assert {(row["route"], row["model"]) for row in get_route_stats().stats()} == {
+        ("plan", "small"), ("chapter:3000", "small"), ("chapter", "big"), ("chapter", "pinned"),
+    }
+
+
+@pytest.mark.anyio
+async def test_model_route_metrics_requires_superuser(client, user_factory, auth_override, db_session, routes):
+    user = await user_factory()
+    auth_override(user)
+
+    response = await client.get("/api/v1/metrics/model-routes")
+    assert response.status_code == 403
+
+    user.is_superuser = True
+    await db_session.commit()
+    response = await client.get("/api/v1/metrics/model-routes")
+    assert response.status_code == 200
+    assert response.json()["routes"][0] == {"route": "plan", "model": "small"}
+
+
+def test_track_models_collects_routed_models(routes, monkeypatch):
+    monkeypatch.setattr(ChatOpenAI, "invoke", lambda self, prompt, *args, **kwargs: AIMessage(
+        content="<document><content><ul><li><h2>Глава</h2></li></ul></content></document>"))
+
+    with track_models() as models:
+        PlanAgent().generate_plan("Тема", "ru", 3)
+    PlanAgent().generate_plan("Тема", "ru", 3)
+
+    assert models == ["small"]
@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+
+from src.config import settings
+from src.notifications import EssayListener, notify_essay, wait_for_essay_change
+
+
+@pytest.mark.anyio
+async def test_listener_resolves_subscribers_of_notified_essay():
+    listener = EssayListener("postgresql://unused")
+    first, other = listener.subscribe(1), listener.subscribe(2)
+
+    listener._on_notify(None, 0, "essay_events", "1")
+    listener._on_notify(None, 0, "essay_events", "garbage")
+
+    assert first.done() and not other.done()
+    listener.unsubscribe(2, other)
+    assert listener._waiters == {}
+
+
+@pytest.mark.anyio
+async def test_wait_uses_listener_notification(monkeypatch):
+    listener = EssayListener("postgresql://unused")
+
+    async def _connect():
+        return True
+
+    monkeypatch.setattr(listener, "connect", _connect)
+    monkeypatch.setattr(settings.celery, "status_listen", True)
+    monkeypatch.setattr("src.notifications.get_essay_listener", lambda: listener)
+    snapshots = []
+
+    async def _snapshot():
+        snapshots.append(1)
+        return "same"
+
+    waiting = asyncio.ensure_future(wait_for_essay_change(7, 10, "same", _snapshot))
+    await asyncio.sleep(0.05)
+    listener._on_notify(None, 0, "essay_events", "7")
+
+    assert await waiting is True
+    # Снимок проверяется один раз — после подписки, дальше только уведомления
+    assert snapshots == [1]
+
+
+@pytest.mark.anyio
+async def test_notify_is_noop_outside_postgres(sync_session_factory):
+    with sync_session_factory() as db:
+        notify_essay(db, 1)
+        assert db.execute(text("SELECT 1")).scalar() == 1
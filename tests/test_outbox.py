@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+import src.tasks.outbox as outbox_tasks
+from src.config import settings
+from src.models.outbox import TaskOutbox
+from src.tasks.essay import generate_essay
+from src.tasks.plan import generate_plan_task
+
+
+@pytest.fixture
+def relay(monkeypatch, sync_session_factory):
+    monkeypatch.setattr(outbox_tasks, "SyncSessionLocal", sync_session_factory)
+    published = []
+
+    def _publisher(name):
+        def _apply_async(args, task_id, **options):
+            if published and published[-1] == "broker down":
+                raise ConnectionError("broker down")
+            published.append((name, args, task_id, options))
+        return _apply_async
+
+    monkeypatch.setattr(generate_essay, "apply_async", _publisher("essay"))
+    monkeypatch.setattr(generate_plan_task, "apply_async", _publisher("plan"))
+    return published
+
+
+@pytest.mark.anyio
+async def test_relay_publishes_committed_tasks_in_batches(relay, sync_session_factory, monkeypatch):
+    monkeypatch.setattr(settings.celery, "outbox_batch", 2)
+    with sync_session_factory() as db:
+        ids = [outbox_tasks.enqueue_task(db, generate_essay, (idx,), {"queue": "q", "priority": idx})
+               for idx in range(3)]
+        ids.append(outbox_tasks.enqueue_task(db, generate_plan_task, (9, 3), {"queue": "short"}))
+        db.commit()
+    with sync_session_factory() as db:
+        # Откатившаяся транзакция не оставляет задачи
+        outbox_tasks.enqueue_task(db, generate_essay, (99,), {})
+        db.rollback()
+
+    assert outbox_tasks.relay_outbox() == {"published": 4, "failed": 0}
+    assert [(name, task_id) for name, _, task_id, _ in relay] == \
+        [("essay", ids[0]), ("essay", ids[1]), ("essay", ids[2]), ("plan", ids[3])]
+    assert relay[0][3] == {"queue": "q", "priority": 0}
+    assert relay[3][1] == [9, 3]
+    assert outbox_tasks.relay_outbox() == {"published": 0, "failed": 0}
+
+
+@pytest.mark.anyio
+async def test_failed_publish_stays_in_outbox(relay, sync_session_factory):
+    with sync_session_factory() as db:
+        first = outbox_tasks.enqueue_task(db, generate_essay, (1,), {})
+        second = outbox_tasks.enqueue_task(db, generate_essay, (2,), {})
+        db.commit()
+    relay.append("broker down")
+
+    assert outbox_tasks.relay_outbox() == {"published": 0, "failed": 1}
+
+    with sync_session_factory() as db:
+        rows = {row.task_id: row for row in db.query(TaskOutbox)}
+        assert rows[first].attempts == 1 and "broker down" in rows[first].last_error
+        assert rows[second].attempts == 0 and rows[second].published_at is None
+
+    relay.clear()
+    assert outbox_tasks.relay_outbox() == {"published": 2, "failed": 0}
+    assert [json.dumps(args) for _, args, _, _ in relay] == ["[1]", "[2]"]
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import select
+
+import src.tasks.plan as plan_tasks
+from src.models.essay import Chapter, EnumLanguage, EnumStatus, Essay
+from src.refagent.utils import build_plan_layout
+
+
+PLAN = (
+    "<document><content><ul>"
+    "<li><h2>1. Основы</h2></li><li><h2>2. Практика</h2></li><li><h2>3. Итоги</h2></li>"
+    "</ul></content></document>"
+)
+
+
+@pytest.fixture
+def task_session(monkeypatch, sync_session_factory):
+    monkeypatch.setattr(plan_tasks, "SyncSessionLocal", sync_session_factory)
+    return sync_session_factory
+
+
+async def _pending_essay(db_session, page_count: int = 20) -> int:
+    essay = Essay(
+        topic="Программирование",
+        page_count=page_count,
+        status=EnumStatus.PLAN_PENDING,
+        language=EnumLanguage.RU,
+        chapter_count=3,
+        introduction_chars_count=0,
+        conclusion_chars_count=0,
+        references_chars_count=0,
+    )
+    db_session.add(essay)
+    await db_session.commit()
+    return essay.id
+
+
+@pytest.mark.anyio
+async def test_generate_plan_task_fills_pending_essay(db_session, task_session, monkeypatch):
+    monkeypatch.setattr(
+        "src.refagent.agents.plan_agent.PlanAgent.generate_plan",
+        lambda self, topic, language="ru", chapters_count=3: PLAN,
+    )
+    essay_id = await _pending_essay(db_session)
+
+    result = plan_tasks.generate_plan_task.apply(args=(essay_id, 3)).get()
+
+    assert result["status"] == EnumStatus.PLAN_GENERATED
+    layout = build_plan_layout(PLAN, 20, 3)
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.plan == PLAN
+    assert essay.introduction_chars_count == layout["introduction_chars"]
+    chapters = (await db_session.execute(
+        select(Chapter).where(Chapter.essay_id == essay_id).order_by(Chapter.position)
+    )).scalars().all()
+    assert [chapter.title for chapter in chapters] == ["1. Основы", "2. Практика", "3. Итоги"]
+    assert [chapter.chars for chapter in chapters] == layout["chapters_chars"]
+
+
+@pytest.mark.anyio
+async def test_generate_plan_task_marks_failure_when_pages_do_not_fit(
+    db_session, task_session, monkeypatch
+):
+    monkeypatch.setattr(
+        "src.refagent.agents.plan_agent.PlanAgent.generate_plan",
+        lambda self, topic, language="ru", chapters_count=3: PLAN,
+    )
+    essay_id = await _pending_essay(db_session, page_count=4)
+
+    result = plan_tasks.generate_plan_task.apply(args=(essay_id, 3)).get()
+
+    assert result["status"] == EnumStatus.FAILURE
+    db_session.expire_all()
+    essay = await db_session.get(Essay, essay_id)
+    assert essay.status == EnumStatus.FAILURE
@@ -0,0 +1,73 @@
+import random
+
+import openai
+import pytest
+
+from src.config import settings
+from src.refagent import providers
+from src.refagent.agents.plan_agent import PlanAgent
+from src.refagent.providers import Endpoint, ProviderPool, get_provider_pool, parse_endpoints
+
+
+def test_parse_endpoints_defaults_to_openai(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "openai_api_key", "sk-test")
+
+    assert parse_endpoints("") == [Endpoint("openai", None, "sk-test")]
+    assert parse_endpoints("gw|http://gw/v1||3") == [Endpoint("gw", "http://gw/v1", "sk-test", 3.0)]
+    with pytest.raises(ValueError):
+        parse_endpoints("gw")
+
+
+def test_weighted_selection_and_ejection():
+    now = [0.0]
+    pool = ProviderPool(
+        [Endpoint("a", "http://a", "k", 3), Endpoint("b", "http://b", "k", 1)],
+        clock=lambda: now[0], rng=random.Random(1),
+    )
+
+    picks = [pool.choose().name for _ in range(400)]
+    assert 250 < picks.count("a") < 350
+
+    for _ in range(providers.MIN_HEALTH_SAMPLES):
+        pool.record(pool.endpoints[0], ok=False, latency=0.1)
+    assert {pool.choose().name for _ in range(50)} == {"b"}
+    assert pool.stats()[0]["ejected"] is True
+
+    # Все исключены — берётся тот, кто вернётся раньше
+    assert pool.choose(exclude=["b"]).name == "a"
+
+    now[0] += settings.refagent.provider_eject_seconds
+    assert "a" in {pool.choose().name for _ in range(50)}
+    assert pool.stats()[0]["error_rate"] == 0.0
+
+
+def test_agent_fails_over_to_healthy_endpoint(stub_providers):
+    stub_providers["alpha"].status = 500
+
+    results = [PlanAgent().generate_plan("Тема", "ru", 3) for _ in range(16)]
+
+    assert all("beta" in result for result in results)
+    stats = {row["endpoint"]: row for row in get_provider_pool().stats()}
+    assert stats["beta"]["errors"] == 0
+    assert stats["alpha"]["errors"] == stub_providers["alpha"].calls > 0
+
+
+def test_slow_endpoint_is_ejected(stub_providers, monkeypatch):
+    monkeypatch.setattr(settings.refagent, "provider_max_p95_seconds", 0.1)
+    stub_providers["alpha"].latency = 0.2
+
+    for _ in range(40):
+        PlanAgent().generate_plan("Тема", "ru", 3)
+
+    stats = {row["endpoint"]: row for row in get_provider_pool().stats()}
+    assert stats["alpha"]["ejected"] is True
+    assert stub_providers["alpha"].calls == providers.MIN_HEALTH_SAMPLES
+
+
+def test_error_is_raised_when_every_endpoint_fails(stub_providers):
+    for server in stub_providers.values():
+        server.status = 503
+
+    with pytest.raises(openai.InternalServerError):
+        PlanAgent().generate_plan("Тема", "ru", 3)
+    assert [server.calls for server in stub_providers.values()] == [1, 1]
@@ -0,0 +1,86 @@
+import httpx
+import openai
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+from sqlalchemy import create_engine
+
+from src.config import settings
+from src.refagent.agents.introduction_agent import IntroductionAgent
+from src.refagent.ratelimit import REQUESTS_BUCKET, TOKENS_BUCKET, RateLimiter, SqlRateLimitBackend
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return tmp_path / "rate_limit.sqlite3"
+
+
+def _limiter(db_path, clock, rpm=60, tpm=6000):
+    backend = SqlRateLimitBackend(create_engine(f"sqlite+pysqlite:///{db_path}"))
+    return RateLimiter(backend, rpm, tpm, clock=clock, sleep=clock.sleep)
+
+
+def test_acquire_waits_for_refill_instead_of_failing(db_path, clock):
+    limiter = _limiter(db_path, clock, rpm=2)
+
+    limiter.acquire(10)
+    limiter.acquire(10)
+    assert clock.slept == []
+
+    limiter.acquire(10)
+    assert sum(clock.slept) == pytest.approx(30.0)
+
+
+def test_budget_is_shared_between_limiters(db_path, clock):
+    # Отдельные engine — как разные процессы воркера на одном хранилище
+    first = _limiter(db_path, clock, tpm=6000)
+    second = _limiter(db_path, clock, tpm=6000)
+
+    first.acquire(4000)
+    second.acquire(4000)
+
+    assert sum(clock.slept) == pytest.approx(20.0)
+    buckets = {row["bucket"]: row for row in second.stats()}
+    assert buckets[TOKENS_BUCKET]["acquired"] == 8000
+    assert buckets[TOKENS_BUCKET]["throttled"] == 1
+    assert buckets[REQUESTS_BUCKET]["requests"] == 2
+
+
+def test_agent_queues_after_429(db_path, clock, monkeypatch):
+    limiter = _limiter(db_path, clock, rpm=60)
+    monkeypatch.setattr("src.refagent.agents.base.get_rate_limiter", lambda: limiter)
+    responses = iter(["429", "ok"])
+
+    def _invoke(self, prompt, *args, **kwargs):
+        if next(responses) == "429":
+            response = httpx.Response(429, request=httpx.Request("POST", "https://api.openai.com"))
+            raise openai.RateLimitError("Rate limit reached", response=response, body=None)
+        return AIMessage(content="<document><content><p>ok</p></content></document>")
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+    # Короткий ответ заглушки не должен запускать продолжение текста
+    monkeypatch.setattr(settings.refagent, "validation_length_tolerance", 1.0)
+
+    assert "ok" in IntroductionAgent().write("Тема", "ru", 1500)
+    # После 429 бюджет запросов обнулён для всех, второй вызов дождался пополнения
+    assert sum(clock.slept) == pytest.approx(1.0)
+    buckets = {row["bucket"]: row for row in limiter.stats()}
+    assert buckets[REQUESTS_BUCKET]["requests"] == 2
@@ -0,0 +1,87 @@
+import src.tasks.essay as essay_tasks
+from src.celery_app import celery_app
+from src.config import settings
+from src.tasks.routing import PRIORITY_MAX, Route, essay_route, fair_release, in_flight_limit, plan_route
+
+
+def test_small_essays_use_short_lane_and_large_ones_long_lane():
+    assert essay_route(5, 2).queue == settings.celery.short_queue
+    assert essay_route(settings.celery.short_max_pages, 3).queue == settings.celery.short_queue
+    assert essay_route(80, 10).queue == settings.celery.long_queue
+
+
+def test_cheaper_work_gets_higher_priority():
+    assert plan_route() == Route(settings.celery.short_queue, PRIORITY_MAX)
+    assert essay_route(5, 2).priority > essay_route(80, 10).priority
+    assert essay_route(40, 4, "introduction").priority > essay_route(40, 4, "chapter:1").priority
+    assert all(1 <= essay_route(pages, 20, "chapter:1").priority < PRIORITY_MAX
+               for pages in (1, 100, 1000))
+
+
+def test_fair_release_round_robins_across_users():
+    # Пользователь 1 поставил в очередь много эссе раньше остальных
+    queued = [(1, 1), (2, 1), (3, 1), (4, 2), (5, 1), (6, 3), (7, 2)]
+
+    assert fair_release(queued, {}, {1: 5, 2: 5, 3: 5}, 4) == [1, 4, 6, 2]
+    # Лимит пользователя учитывает уже генерирующиеся эссе
+    assert fair_release(queued, {1: 2}, {1: 2, 2: 5, 3: 5}, 10) == [4, 6, 7]
+    assert fair_release(queued, {}, {1: 2, 2: 1, 3: 1}, 10) == [1, 4, 6, 2]
+    assert fair_release(queued, {}, {1: 5, 2: 5, 3: 5}, 0) == []
+
+
+def test_in_flight_limit_depends_on_tier(monkeypatch):
+    monkeypatch.setattr(settings.celery, "user_max_in_flight", 2)
+    monkeypatch.setattr(settings.celery, "superuser_max_in_flight", 8)
+
+    assert (in_flight_limit(False), in_flight_limit(True)) == (2, 8)
+
+
+def test_celery_declares_priority_queues_for_both_lanes():
+    queues = {queue.name: queue for queue in celery_app.conf.task_queues}
+
+    assert set(queues) == {settings.celery.short_queue, settings.celery.long_queue}
+    assert all(queue.queue_arguments["x-max-priority"] == PRIORITY_MAX for queue in queues.values())
+    assert celery_app.conf.task_default_queue == settings.celery.short_queue
+
+
+def test_section_subtasks_are_published_to_the_essay_lane(monkeypatch):
+    published = []
+
+    def _chord(header):
+        published.extend(header.tasks)
+        return lambda callback: None
+
+    monkeypatch.setattr(settings.celery, "essay_fan_out", True)
+    monkeypatch.setattr(essay_tasks, "_chords_supported", lambda: True)
+    monkeypatch.setattr(essay_tasks, "chord", _chord)
+    monkeypatch.setattr(essay_tasks, "_load_essay", lambda db, essay_id: _StubEssay())
+    monkeypatch.setattr(essay_tasks, "pending_sections", lambda db, essay: ["introduction", "chapter:1"])
+    monkeypatch.setattr(essay_tasks, "adopt_drafts", lambda db, essay: [])
+    monkeypatch.setattr(essay_tasks, "queue_section", lambda db, essay_id, section: None)
+    monkeypatch.setattr(essay_tasks, "essay_changed", lambda db, essay_id: None)
+    monkeypatch.setattr(essay_tasks, "SyncSessionLocal", _StubSession)
+
+    essay_tasks.generate_essay.run(1)
+
+    assert [task.options["queue"] for task in published] == [settings.celery.long_queue] * 2
+    assert published[0].options["priority"] > published[1].options["priority"]
+
+
+class _StubEssay:
+    page_count = 60
+    chapters = [object()] * 6
+    status = None
+
+
+class _StubSession:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
@@ -0,0 +1,116 @@
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_openai import ChatOpenAI
+from lxml import etree
+
+from src.config import settings
+from src.refagent.agents.introduction_agent import IntroductionAgent
+from src.refagent.budget import TokenBudget
+from src.refagent.validation import (
+    InvalidDocument,
+    content_chars,
+    ensure_valid_document,
+    merge_documents,
+    parse_document,
+    validate_document,
+)
+
+
+BUDGET = TokenBudget(language="ru", target_chars=1000, max_chars=1250, max_tokens=600)
+
+
+def _document(text: str, formulas: str = "") -> str:
+    return f"<document><content>{text}</content><formulas>{formulas}</formulas></document>"
+
+
+def _fail(*args):
+    raise AssertionError("must not be called")
+
+
+def test_output_without_envelope_is_rewrapped():
+    result = validate_document("```xml\n<p>Текст введения.</p>\n```", check_length=False)
+
+    assert result.ok
+    assert result.root.find("content/p").text == "Текст введения."
+    assert result.root.find("formulas") is not None
+
+
+def test_inconsistent_formula_ids_are_fixed_locally():
+    text = _document(
+        '<p>Энергия <formula id="f1"/> и <formula id="f2"/> конец</p>',
+        '<latex id="f1">E=mc^2</latex><latex id="f3">a^2</latex>',
+    )
+
+    root = validate_document(text, check_length=False).root
+
+    assert [ref.get("id") for ref in root.iter("formula")] == ["f1"]
+    assert [latex.get("id") for latex in root.iter("latex")] == ["f1"]
+    assert "конец" in "".join(root.find("content").itertext())
+
+
+def test_short_output_is_continued_instead_of_regenerated():
+    prompts = []
+
+    def _continue(prompt, missing):
+        prompts.append((prompt, missing))
+        return _document("<p>" + "б" * 600 + "</p>")
+
+    text = ensure_valid_document(
+        _document("<p>" + "а" * 400 + "</p>"), BUDGET, check_length=True,
+        continue_text=_continue, regenerate=_fail,
+    )
+
+    assert len(prompts) == 1
+    assert prompts[0][1] == 600
+    assert "а" * 100 in prompts[0][0]
+    assert content_chars(parse_document(text)) == 1000
+
+
+def test_broken_output_is_regenerated_as_last_resort(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "validation_max_retries", 2)
+    attempts = iter(["", _document("<p>" + "в" * 900 + "</p>")])
+
+    text = ensure_valid_document("", BUDGET, check_length=True,
+                                 continue_text=_fail, regenerate=lambda: next(attempts))
+
+    assert "в" * 900 in text
+
+
+def test_retries_are_bounded(monkeypatch):
+    monkeypatch.setattr(settings.refagent, "validation_max_retries", 2)
+    calls = []
+
+    def _regenerate():
+        calls.append(1)
+        return ""
+
+    with pytest.raises(InvalidDocument):
+        ensure_valid_document("", BUDGET, check_length=True, continue_text=_fail, regenerate=_regenerate)
+    assert len(calls) == 2
+
+
+def test_merge_documents_renumbers_formulas():
+    first = parse_document(_document('<p>A <formula id="f1"/></p>', '<latex id="f1">a</latex>'))
+    second = parse_document(_document('<p>B <formula id="f1"/></p>', '<latex id="f1">b</latex>'))
+
+    merged = merge_documents([first, second])
+
+    assert [ref.get("id") for ref in merged.iter("formula")] == ["f1", "f2"]
+    assert [(latex.get("id"), latex.text) for latex in merged.iter("latex")] == [("f1", "a"), ("f2", "b")]
+
+
+def test_agent_validates_and_continues_short_section(monkeypatch):
+    prompts = []
+
+    def _invoke(self, prompt, *args, **kwargs):
+        prompts.append(prompt)
+        return AIMessage(content=_document("<p>" + "г" * 700 + "</p>"))
+
+    monkeypatch.setattr(ChatOpenAI, "invoke", _invoke)
+
+    text = IntroductionAgent().write("Тема", "ru", 1500)
+
+    assert len(prompts) == 2
+    assert "продолж" in prompts[1]
+    root = etree.fromstring(text.encode())
+    assert content_chars(root) == 1400